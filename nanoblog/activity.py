@@ -0,0 +1,42 @@
+"""
+Denormalized activity fields on BlogPost: comment_count and last_activity
+(the time of the latest comment, None for posts without comments, whose
+last activity is their own datetime).
+
+record_comment keeps them up to date as comments are added, with atomic
+UPDATEs that are safe against concurrent comments on the same post.
+reconcile recomputes them from the Comment table (see the
+reconcile_activity management command).
+"""
+
+from django.db.models import F, Q, Count, Max
+
+from nanoblog.models import BlogPost
+
+def record_comment(comment):
+    """ Count the new `comment` on its post. Call this in the transaction
+    that saves the comment.
+    """
+    post_id = comment.post_id
+    BlogPost.objects.filter(id=post_id).update(comment_count=F('comment_count') + 1)
+    # Only move last_activity forward, in case a concurrent comment got there first
+    BlogPost.objects.filter(Q(last_activity__lt=comment.datetime) |
+                            Q(last_activity__isnull=True),
+                            id=post_id).update(last_activity=comment.datetime)
+
+def reconcile(posts=None):
+    """ Recompute comment_count and last_activity of `posts` (a BlogPost
+    queryset, all posts by default). Returns the number of posts fixed.
+    """
+    if posts is None:
+        posts = BlogPost.objects.all()
+    posts = posts.annotate(actual_count=Count('comment'),
+                           latest_comment=Max('comment__datetime'))
+    fixed = 0
+    for post in posts.iterator():
+        last_activity = post.latest_comment and max(post.datetime, post.latest_comment)
+        if post.comment_count != post.actual_count or post.last_activity != last_activity:
+            BlogPost.objects.filter(id=post.id).update(comment_count=post.actual_count,
+                                                       last_activity=last_activity)
+            fixed += 1
+    return fixed
@@ -0,0 +1,214 @@
+"""
+Version 1 of the JSON API for the streams, used by stream.js to refresh and
+page through streams and render them in the browser.
+
+Every response is a JSON object with these components:
+- version: the API version (1)
+- users: an object mapping each user id mentioned in the response to
+         {"username", "picture", "thumb", "card", "srcset", "following"}:
+         the URLs of the profile picture (null if there is none) at full,
+         comment thumbnail and post thumbnail size, a srcset of all sizes
+         (may be empty), and whether the logged in user follows them
+- posts: a list of posts in reverse chronological order, each of them
+         {"id", "user", "text", "datetime", "last_updated", "comment_count",
+         "comments"}, where last_updated is when the post entered the stream
+         (its datetime, or that of the comment that put it in a tag or
+         mentions stream) and comments is a chronological list of
+         {"id", "user", "text", "datetime"}
+- synced: the value to pass as comments_since on the next refresh
+
+The request parameters are the same as for the HTML streams (see
+nanoblog.views.stream_html). A refresh (GET["last_updated"]) also returns
+- comments: a chronological list of new comments on the posts the client
+            already shows, each of them {"id", "post", "user", "text", "datetime"}
+while a page request returns
+- older_cursor: the cursor for the next older page, or null on the last page
+
+Search results (api/v1/search?q=...&page=...) have "users" and "posts" too,
+with posts best match first, and "has_next" telling whether there is a next
+page (see nanoblog.views.search_posts).
+
+Trending topics (api/v1/trending?window=hour|day) have "users" and "posts",
+most commented first, each post with its "activity" (comments in the
+window), and "tags": a list of {"name", "count"}, most used first (see
+nanoblog.trending).
+"""
+
+import json
+
+from django.shortcuts               import get_object_or_404
+from django.http                    import HttpResponse, Http404
+from django.utils                   import timezone
+from django.core.exceptions         import ObjectDoesNotExist
+from django.contrib.auth.models     import User
+from django.contrib.auth.decorators import login_required
+
+from nanoblog.models import BlogPost, PostTag, Mention
+from nanoblog.pagination import stream_datetime
+from nanoblog.views  import comments_for_posts, poll_stream, stream_page
+from nanoblog import timeline, pubsub, conditional, follow_graph, search, tags, trending
+from nanoblog.replicas import replica_reads
+
+API_VERSION = 1
+
+class StreamSerializer(object):
+    """ Turns posts and comments into API records, collecting their authors
+    so each one is written out only once per response.
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.users = {}
+
+    def user(self, user):
+        if user.id not in self.users:
+            record = {'username': user.username, 'picture': None,
+                      'thumb': None, 'card': None, 'srcset': ''}
+            try:
+                blogger = user.blogger
+            except ObjectDoesNotExist: # e.g. users made with createsuperuser
+                blogger = None
+            if blogger and blogger.profile_picture_url:
+                record.update(picture=blogger.profile_picture_url,
+                              thumb=blogger.thumb_picture_url,
+                              card=blogger.card_picture_url,
+                              srcset=blogger.profile_picture_srcset)
+            self.users[user.id] = record
+        return user.id
+
+    def comment(self, comment, with_post=False):
+        record = {
+            'id': comment.id,
+            'user': self.user(comment.user),
+            'text': comment.text,
+            'datetime': comment.datetime.isoformat(),
+        }
+        if with_post:
+            record['post'] = comment.post_id
+        return record
+
+    def post(self, post, comments):
+        return {
+            'id': post.id,
+            'user': self.user(post.user),
+            'text': post.text,
+            'datetime': post.datetime.isoformat(),
+            'last_updated': stream_datetime(post).isoformat(),
+            'comment_count': post.comment_count,
+            'comments': [self.comment(comment) for comment in comments],
+        }
+
+    def posts(self, posts):
+        return [self.post(pac['post'], pac['comments'])
+                for pac in comments_for_posts(posts)]
+
+    def user_records(self):
+        """ Get the records of the users seen so far, with whether the viewer
+        follows each of them.
+        """
+        following = follow_graph.following_many(self.viewer.id, self.users.keys())
+        for user_id, record in self.users.items():
+            record['following'] = following[user_id]
+        return self.users
+
+def stream_json(request, blog_posts, channel):
+    """ Answer an API request for the stream made of `blog_posts`.
+    Refreshes that don't wait may be answered with 304 Not Modified
+    (see nanoblog.conditional).
+    """
+    if "last_updated" in request.GET:
+        return conditional.refresh_response(
+            request, channel, lambda: render_stream_json(request, blog_posts, channel))
+    return render_stream_json(request, blog_posts, channel)
+
+def render_stream_json(request, blog_posts, channel):
+    """ Build the response to an API request (see stream_json). """
+    serializer = StreamSerializer(request.user)
+    response = {'version': API_VERSION}
+
+    if "last_updated" in request.GET:
+        posts, comments, synced = poll_stream(request, blog_posts, channel)
+        response['posts'] = serializer.posts(posts)
+        response['comments'] = [serializer.comment(comment, with_post=True)
+                                for comment in comments]
+    else:
+        synced = str(timezone.now())
+        posts, older_cursor = stream_page(request, blog_posts)
+        response['posts'] = serializer.posts(posts)
+        response['older_cursor'] = older_cursor
+
+    response['users'] = serializer.user_records()
+    response['synced'] = synced
+    response_json = json.dumps(response)
+    return HttpResponse(response_json, content_type='application/json')
+
+@login_required
+@replica_reads
+def global_stream(request):
+    """ Posts from all users. """
+    return stream_json(request, BlogPost.objects.all(), pubsub.global_channel())
+
+@login_required
+@replica_reads
+def following(request):
+    """ Posts by users whom the logged in user follows. """
+    return stream_json(request, timeline.timeline_entries(request.user),
+                       pubsub.following_channel(request.user.id))
+
+@login_required
+@replica_reads
+def user(request, username=None):
+    """ Posts by user with username `username`. """
+    profile_user = get_object_or_404(User, username=username)
+    return stream_json(request, BlogPost.objects.filter(user=profile_user),
+                       pubsub.user_channel(profile_user.id))
+
+@login_required
+@replica_reads
+def tag(request, name=None):
+    """ Posts using the tag #`name`. """
+    name = tags.normalize(name)
+    return stream_json(request, PostTag.objects.filter(tag__name=name),
+                       pubsub.tag_channel(name))
+
+@login_required
+@replica_reads
+def mentions(request):
+    """ Posts mentioning the logged in user. """
+    return stream_json(request, Mention.objects.filter(user=request.user),
+                       pubsub.mentions_channel(request.user.id))
+
+@login_required
+def search_posts(request):
+    """ Posts matching GET["q"], best matches first. """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        raise Http404
+    posts, has_next = search.search(query, page) if query else ([], False)
+    serializer = StreamSerializer(request.user)
+    response = {'version': API_VERSION}
+    response['posts'] = serializer.posts(posts)
+    response['users'] = serializer.user_records()
+    response['has_next'] = has_next
+    response_json = json.dumps(response)
+    return HttpResponse(response_json, content_type='application/json')
+
+@login_required
+def trending_topics(request):
+    """ The most used tags and most commented posts over GET["window"]. """
+    window = request.GET.get('window', 'hour')
+    if window not in dict(trending.WINDOWS):
+        raise Http404
+    top_posts = trending.top_posts(window)
+    serializer = StreamSerializer(request.user)
+    response = {'version': API_VERSION, 'window': window}
+    response['posts'] = serializer.posts([post for post, count in top_posts])
+    for record, (post, count) in zip(response['posts'], top_posts):
+        record['activity'] = count
+    response['tags'] = [{'name': name, 'count': count}
+                        for name, count in trending.top_tags(window)]
+    response['users'] = serializer.user_records()
+    response_json = json.dumps(response)
+    return HttpResponse(response_json, content_type='application/json')
@@ -0,0 +1,123 @@
+"""
+Optional write coalescing ("group commit") for new posts and comments.
+
+Normally every new post or comment is committed in its own transaction. With
+settings.WRITE_COALESCING_DELAY set, writes that arrive within that many
+seconds of each other are committed together instead, so a burst of N posts
+costs the database one commit instead of N.
+
+There is no writer thread. The first request to submit a write becomes the
+batch leader: it waits for WRITE_COALESCING_DELAY, takes up to
+WRITE_BATCH_SIZE pending writes (its own included) and runs them all in one
+transaction, on its own database connection. The other requests wait until
+their write has committed, and then get its result (e.g. the new row's id is
+set) or its exception, as if they had written it themselves. Each write runs
+in a savepoint, so one failing write doesn't take the rest of the batch down.
+Writes left over when a batch is full are led by the oldest of them.
+
+Django can't return the ids of rows made by bulk_create on every database,
+so rows are still INSERTed one by one; what the batch shares is the commit.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+class PendingWrite(object):
+    """ A function waiting to be run by a WriteBatcher. """
+
+    def __init__(self, function):
+        self.function = function
+        self.result = None
+        self.error = None
+        # Set when the write is done, or when it has to lead the next batch
+        self.wakeup = threading.Event()
+        self.leads = False
+        self.done = False
+
+class WriteBatcher(object):
+    """ Runs the functions given to write() in shared transactions. """
+
+    def __init__(self, delay, max_size):
+        self.delay = delay
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.leader_active = False
+
+    def write(self, function):
+        """ Call `function` in a transaction shared with other writes.
+        Returns its result once committed, or raises its exception.
+        """
+        write = PendingWrite(function)
+        with self.lock:
+            self.pending.append(write)
+            if not self.leader_active:
+                self.leader_active = True
+                write.leads = True
+        while not write.done:
+            if write.leads:
+                write.leads = False
+                self.lead()
+            else:
+                write.wakeup.wait()
+                write.wakeup.clear()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def lead(self):
+        """ Collect a batch of pending writes and commit it. """
+        time.sleep(self.delay)
+        with self.lock:
+            batch = self.pending[:self.max_size]
+            del self.pending[:self.max_size]
+            if self.pending:
+                successor = self.pending[0]
+                successor.leads = True
+                successor.wakeup.set()
+            else:
+                self.leader_active = False
+        try:
+            self.commit(batch)
+        finally:
+            for write in batch:
+                write.done = True
+                write.wakeup.set()
+
+    def commit(self, batch):
+        try:
+            with transaction.atomic():
+                for write in batch:
+                    try:
+                        with transaction.atomic():
+                            write.result = write.function()
+                    except Exception as e:
+                        write.error = e
+        except Exception as e:
+            # The commit itself failed: so did every write
+            for write in batch:
+                write.error = e
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    """ Get the process-wide WriteBatcher for the current settings. """
+    global _batcher
+    config = (settings.WRITE_COALESCING_DELAY, settings.WRITE_BATCH_SIZE)
+    with _batcher_lock:
+        if _batcher is None or (_batcher.delay, _batcher.max_size) != config:
+            _batcher = WriteBatcher(*config)
+        return _batcher
+
+def write(function):
+    """ Call `function` in a transaction, shared with other concurrent writes
+    if write coalescing is on. Returns its result once it is committed.
+    """
+    if not settings.WRITE_COALESCING_DELAY:
+        with transaction.atomic():
+            return function()
+    return get_batcher().write(function)
@@ -0,0 +1,290 @@
+"""
+Helpers for the benchmark management commands: seeding a database with a
+synthetic data set, timing things, and driving the stream endpoints, either
+in process through the Django test client or over HTTP with concurrent
+clients (see the benchmark_streams command).
+
+Seeding writes lots of rows. Only point the benchmarks at a scratch database.
+"""
+
+import cookielib
+import itertools
+import math
+import random
+import threading
+import time
+import urllib
+import urllib2
+from contextlib import contextmanager
+from datetime   import timedelta
+
+from django.conf  import settings
+from django.db    import connection, transaction
+from django.test  import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+from nanoblog.models import BlogPost, Blogger, Comment
+from nanoblog import timeline, activity, search
+
+BATCH_SIZE = 1000
+
+def bulk_create(model, objs):
+    """ Insert `objs` in batches of at most BATCH_SIZE rows. """
+    for start in range(0, len(objs), BATCH_SIZE):
+        model.objects.bulk_create(objs[start:start + BATCH_SIZE])
+
+@contextmanager
+def explicit_datetimes():
+    """ Let BlogPost and Comment rows be saved with the datetime they are
+    given, instead of the time they were saved.
+    """
+    fields = [model._meta.get_field('datetime') for model in (BlogPost, Comment)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+def seed(users=100, posts=10000, comments_per_post=2, follows_per_user=20,
+         days=30, prefix='bench', random_seed=0):
+    """
+    Fill the database with a synthetic data set: `users` users named
+    <prefix><n> (all with password <prefix>), each following
+    `follows_per_user` random others, `posts` posts spread over the last
+    `days` days, and on average `comments_per_post` comments per post.
+    Timelines are rebuilt to match. Returns the list of new Users.
+    """
+    rand = random.Random(random_seed)
+    now = timezone.now()
+    span = timedelta(days=days).total_seconds()
+
+    with transaction.atomic():
+        template = User(username=prefix)
+        template.set_password(prefix)
+        bulk_create(User,
+            [User(username='%s%d' % (prefix, i), password=template.password,
+                  email='%s%d@example.com' % (prefix, i))
+             for i in range(users)])
+        new_users = list(User.objects.filter(username__startswith=prefix)
+                                     .exclude(blogger__isnull=False)
+                                     .order_by('id'))
+        bulk_create(Blogger, [Blogger(user=user) for user in new_users])
+
+        Follow = Blogger.following.through
+        follows = []
+        new_bloggers = Blogger.objects.filter(user__username__startswith=prefix)
+        for blogger in new_bloggers:
+            followed = rand.sample(new_users, min(follows_per_user, len(new_users)))
+            follows.extend(Follow(blogger_id=blogger.id, user_id=user.id)
+                           for user in followed if user.id != blogger.user_id)
+        bulk_create(Follow, follows)
+
+        with explicit_datetimes():
+            bulk_create(BlogPost,
+                [BlogPost(user=rand.choice(new_users), text='Synthetic post %d' % i,
+                          datetime=now - timedelta(seconds=rand.uniform(0, span)))
+                 for i in range(posts)])
+
+            new_posts = (BlogPost.objects.filter(user__username__startswith=prefix)
+                                         .values_list('id', 'datetime'))
+            comments = []
+            for post_id, post_datetime in new_posts.iterator():
+                for i in range(rand.randint(0, 2 * comments_per_post)):
+                    age = (now - post_datetime).total_seconds()
+                    comments.append(Comment(
+                        user=rand.choice(new_users), post_id=post_id,
+                        text='Synthetic comment %d' % i,
+                        datetime=post_datetime + timedelta(seconds=rand.uniform(0, age))))
+            bulk_create(Comment, comments)
+        seeded_posts = BlogPost.objects.filter(user__username__startswith=prefix)
+        activity.reconcile(seeded_posts)
+        search.rebuild(seeded_posts)
+
+        for blogger in new_bloggers.select_related('user'):
+            timeline.rebuild(blogger)
+
+    return new_users
+
+def time_calls(function, repeat):
+    """ Call `function` `repeat` times. Returns the list of durations in ms. """
+    durations = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        durations.append((time.time() - started) * 1000)
+    return durations
+
+def percentile(values, fraction):
+    """ Get the value below which `fraction` of `values` fall (nearest rank). """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(len(values), max(rank, 1)) - 1]
+
+class Scenario(object):
+    """
+    A request to benchmark: `method` ('GET' or 'POST') on `path`, with the
+    parameters returned by `data`, a function called before each request so
+    POSTs can differ from one another. `ajax` requests are sent with
+    X-Requested-With, like stream.js does.
+    """
+
+    def __init__(self, name, method, path, data=None, ajax=False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data or (lambda: {})
+        self.ajax = ajax
+
+def stream_scenarios(user, random_seed=0):
+    """ Get the Scenarios of a user of the seeded data set browsing the
+    streams, refreshing them, posting and commenting, as `user`.
+    """
+    rand = random.Random(random_seed)
+    page_size = settings.STREAM_PAGE_SIZE
+    post_ids = list(BlogPost.objects.order_by('-datetime', '-id')
+                                    .values_list('id', flat=True)[:page_size])
+    # A refresh from a client that is half a page behind
+    newest = list(BlogPost.objects.order_by('-datetime', '-id')
+                                  .values_list('datetime', flat=True)[:page_size // 2 + 1])
+    last_updated = str(newest[-1] if newest else timezone.now())
+    counter = itertools.count()
+    return [
+        Scenario('global_stream', 'GET', '/'),
+        Scenario('following', 'GET', '/following'),
+        Scenario('user', 'GET', '/user/%s' % user.username),
+        Scenario('refresh', 'GET', '/', lambda: {'last_updated': last_updated}, ajax=True),
+        Scenario('add', 'POST', '/add',
+                 lambda: {'text': 'Benchmark post %d' % next(counter)}, ajax=True),
+        Scenario('add_comment', 'POST', '/add_comment',
+                 lambda: {'post': rand.choice(post_ids),
+                          'text': 'Benchmark comment %d' % next(counter)}, ajax=True),
+    ]
+
+def summary(scenario, mode, durations, elapsed, errors=0, queries=None):
+    """ Get the machine readable result of running `scenario`: latencies in
+    ms, throughput in requests per second, and the mean number of database
+    queries per request when they were counted.
+    """
+    return {
+        'scenario': scenario.name,
+        'mode': mode,
+        'requests': len(durations),
+        'errors': errors,
+        'p50_ms': percentile(durations, 0.5),
+        'p99_ms': percentile(durations, 0.99),
+        'mean_ms': sum(durations) / len(durations) if durations else None,
+        'throughput_rps': len(durations) / elapsed if elapsed else None,
+        'queries_per_request': float(sum(queries)) / len(queries) if queries else None,
+    }
+
+def run_client(scenario, client, repeat):
+    """ Send `scenario`'s request `repeat` times with the Django test
+    `client`, counting queries. Returns its summary().
+    """
+    durations = []
+    queries = []
+    errors = 0
+    extra = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'} if scenario.ajax else {}
+    send = client.post if scenario.method == 'POST' else client.get
+    started = time.time()
+    for i in range(repeat):
+        data = scenario.data()
+        with CaptureQueriesContext(connection) as captured:
+            request_started = time.time()
+            response = send(scenario.path, data, **extra)
+            durations.append((time.time() - request_started) * 1000)
+        queries.append(len(captured))
+        if response.status_code >= 400:
+            errors += 1
+    return summary(scenario, 'client', durations, time.time() - started, errors, queries)
+
+def logged_in_client(username, password):
+    """ Get a test Client logged in as `username`. """
+    client = Client()
+    if not client.login(username=username, password=password):
+        raise ValueError('Could not log in as %s' % username)
+    return client
+
+class HttpSession(object):
+    """ A logged in user of the site at `base_url`, over real HTTP. Safe to
+    share between threads.
+    """
+
+    def __init__(self, base_url, username, password, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookies))
+        self.open('GET', '/login')
+        self.open('POST', '/login', {'username': username, 'password': password})
+        if 'sessionid' not in self.cookie_values():
+            raise ValueError('Could not log in to %s as %s' % (self.base_url, username))
+
+    def cookie_values(self):
+        return dict((cookie.name, cookie.value) for cookie in self.cookies)
+
+    def open(self, method, path, data=None, ajax=False):
+        """ Send a request. Returns the HTTP status. """
+        url = self.base_url + path
+        headers = {'Referer': url}
+        if ajax:
+            headers['X-Requested-With'] = 'XMLHttpRequest'
+        body = None
+        data = dict(data or {})
+        if method == 'POST':
+            token = self.cookie_values().get('csrftoken', '')
+            data['csrfmiddlewaretoken'] = token
+            headers['X-CSRFToken'] = token
+            body = urllib.urlencode(data)
+        elif data:
+            url += '?' + urllib.urlencode(data)
+        try:
+            response = self.opener.open(urllib2.Request(url, body, headers),
+                                        timeout=self.timeout)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as e:
+            # 304 Not Modified and redirects after POSTs are fine
+            return e.code
+
+def run_http(scenario, session, concurrency, requests):
+    """ Send `scenario`'s request `requests` times over `session`, from
+    `concurrency` threads at once. Returns its summary().
+    """
+    durations = []
+    errors = []
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                data = scenario.data()
+            request_started = time.time()
+            try:
+                status = session.open(scenario.method, scenario.path, data, scenario.ajax)
+            except Exception:
+                status = None
+            duration = (time.time() - request_started) * 1000
+            with lock:
+                durations.append(duration)
+                if status is None or status >= 400:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summary(scenario, 'http', durations, time.time() - started, len(errors))
+
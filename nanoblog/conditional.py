@@ -0,0 +1,94 @@
+"""
+Conditional GET (ETag / Last-Modified / 304 Not Modified) for stream refreshes.
+
+Each Blogger has a stream_changed marker, set whenever a post or comment
+shows up in their user stream (see nanoblog.events). The time a stream last
+changed is then one cheap lookup on Blogger, made without touching BlogPost
+or Comment:
+- a user stream: that user's marker
+- the global stream: the newest marker of all (an index lookup)
+- a following stream: the newest marker of the users followed
+
+Markers are set after the post or comment is committed, so a client holding
+a validator taken before a change can never be told its copy is current.
+"""
+
+import calendar
+import hashlib
+import time
+
+from django.db.models import Max
+from django.http      import HttpResponseNotModified
+from django.utils     import timezone
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+
+from nanoblog.models import Blogger
+
+def mark_changed(user_ids):
+    """ Record that the user streams of `user_ids` (and so the global
+    stream and their followers' following streams) just changed.
+    """
+    Blogger.objects.filter(user_id__in=user_ids).update(stream_changed=timezone.now())
+
+def last_changed(channel):
+    """ Get the time the stream with pubsub channel `channel` last changed,
+    or None if it is not known.
+    """
+    kind, _, user_id = channel.partition(':')
+    if kind == 'global':
+        bloggers = Blogger.objects.all()
+    elif kind == 'user':
+        bloggers = Blogger.objects.filter(user_id=user_id)
+    elif kind == 'following':
+        bloggers = Blogger.objects.filter(user__followers__user_id=user_id)
+    else:
+        return None
+    return bloggers.aggregate(changed=Max('stream_changed'))['changed']
+
+def refresh_response(request, channel, respond):
+    """
+    Answer an incremental refresh of the stream with pubsub channel `channel`,
+    calling respond() to build the response unless the client's copy (as told
+    by If-None-Match or If-Modified-Since) is still current, in which case the
+    answer is 304 Not Modified.
+
+    Long-polls (see nanoblog.views.is_long_poll) are always passed through:
+    they wait for a change instead.
+    """
+    from nanoblog.views import is_long_poll # views imports this module
+
+    if is_long_poll(request):
+        return respond()
+    changed = last_changed(channel)
+    if changed is None:
+        return respond()
+
+    # The response depends on the stream's state, the user and the part of
+    # the stream the client shows. Not on comments_since: with the stream
+    # unchanged, there are no comments the client's last response lacked.
+    params = request.GET.copy()
+    comments_since = params.pop('comments_since', None)
+    etag = hashlib.md5('%s|%s|%s|%s|%s' % (changed.isoformat(), request.user.id, request.path,
+                                           sorted(params.lists()),
+                                           bool(comments_since))).hexdigest()
+    # Everything that changed before now is in the response. Anything that
+    # changes from this second on makes a later If-Modified-Since fail.
+    fetched = int(time.time())
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        not_modified = etag in etags or '*' in etags
+    elif if_modified_since:
+        not_modified = calendar.timegm(changed.utctimetuple()) < if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = respond()
+        response['Last-Modified'] = http_date(fetched)
+    response['ETag'] = quote_etag(etag)
+    return response
@@ -0,0 +1,38 @@
+"""
+Work to do once a new post, comment, follow or profile change has been saved.
+
+The views that create posts and comments call these after their transaction
+commits, so anyone woken up by a notification is guaranteed to see the new
+rows.
+"""
+
+from nanoblog.models import TimelineEntry
+from nanoblog import pubsub, fragments, conditional, follow_graph, tags, trending
+
+def post_created(post, follower_ids):
+    """ `post` was written and copied into the timelines of `follower_ids`. """
+    conditional.mark_changed([post.user_id])
+    channels = pubsub.stream_channels(post.user_id, follower_ids)
+    channels.extend(tags.new_post_channels(post))
+    pubsub.publish(channels)
+    trending.record_post(post)
+
+def comment_created(comment):
+    """ `comment` was written. Its post's streams now have something new. """
+    post = comment.post
+    fragments.invalidate_posts([post.id])
+    conditional.mark_changed([post.user_id])
+    timeline_owner_ids = (TimelineEntry.objects.filter(post=post)
+                                               .values_list('owner_id', flat=True))
+    channels = pubsub.stream_channels(post.user_id, timeline_owner_ids)
+    channels.extend(tags.post_channels(post))
+    pubsub.publish(channels)
+    trending.record_comment(comment)
+
+def follow_changed(follower, followed):
+    """ `follower` started or stopped following `followed`. """
+    follow_graph.invalidate(follower.id, followed.id)
+
+def profile_updated(user):
+    """ `user` changed their profile, e.g. their picture. """
+    fragments.invalidate_user(user)
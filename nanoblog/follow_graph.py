@@ -0,0 +1,126 @@
+"""
+Cached view of the follow graph (Blogger.following).
+
+For every user the cache holds the set of ids of the users they follow, and
+their number of followers. Checking whether someone follows someone else,
+or a whole page of authors at once, is then two cache reads. Entries are
+recomputed from the primary database, as a replica may not have the latest
+follows yet (see nanoblog.replicas).
+
+As for the post cards (see nanoblog.fragments), each entry is cached under
+a key holding a version token, which is replaced when a follow or unfollow
+commits (see nanoblog.events). Deleting the entry instead would let a
+reader that queried the database before the commit store its stale result
+after the delete, where it would stay until it timed out.
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+
+from nanoblog.models import Blogger
+from nanoblog import metrics, replicas
+
+def get_cache():
+    return caches[settings.FOLLOW_GRAPH_CACHE]
+
+def _following_version_key(user_id):
+    return 'follow-graph:following-version:%d' % user_id
+
+def _follower_count_version_key(user_id):
+    return 'follow-graph:followers-version:%d' % user_id
+
+def _following_key(user_id, version):
+    return 'follow-graph:following:%d:%s' % (user_id, version)
+
+def _follower_count_key(user_id, version):
+    return 'follow-graph:followers:%d:%s' % (user_id, version)
+
+def _new_version():
+    return uuid.uuid4().hex
+
+def _versions(version_keys):
+    """ Get a dict of the version tokens under `version_keys`, making new
+    ones for the keys that have none.
+    """
+    cache = get_cache()
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            version = _new_version()
+            # Not set(): a token set by invalidate() since our get_many()
+            # must win, or what we then cache would be current again
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return versions
+
+def following_ids(user_id):
+    """ Get the set of ids of the users `user_id` follows. """
+    version_key = _following_version_key(user_id)
+    key = _following_key(user_id, _versions([version_key])[version_key])
+    ids = get_cache().get(key)
+    metrics.count_cache('follow_graph', int(ids is not None), int(ids is None))
+    if ids is None:
+        with replicas.reading_from(None):
+            ids = frozenset(Blogger.following.through.objects
+                                   .filter(blogger__user_id=user_id)
+                                   .values_list('user_id', flat=True))
+        get_cache().set(key, ids, settings.FOLLOW_GRAPH_TIMEOUT)
+    return ids
+
+def is_following(user_id, other_id):
+    """ Whether `user_id` follows `other_id`. """
+    return other_id in following_ids(user_id)
+
+def following_many(user_id, other_ids):
+    """ Get a dict telling, for each of `other_ids`, whether `user_id` follows them. """
+    ids = following_ids(user_id)
+    return dict((other_id, other_id in ids) for other_id in other_ids)
+
+def following_count(user_id):
+    """ Get the number of users `user_id` follows. """
+    return len(following_ids(user_id))
+
+def follower_counts(user_ids):
+    """ Get a dict of the number of followers of each of `user_ids`. """
+    user_ids = list(user_ids)
+    cache = get_cache()
+    versions = _versions([_follower_count_version_key(user_id) for user_id in user_ids])
+    keys = dict((user_id, _follower_count_key(
+                    user_id, versions[_follower_count_version_key(user_id)]))
+                for user_id in user_ids)
+    cached = cache.get_many(keys.values())
+    metrics.count_cache('follow_graph', len(cached), len(user_ids) - len(cached))
+    counts = {}
+    missing = []
+    for user_id in user_ids:
+        count = cached.get(keys[user_id])
+        if count is None:
+            missing.append(user_id)
+        else:
+            counts[user_id] = count
+    if missing:
+        found = dict.fromkeys(missing, 0)
+        with replicas.reading_from(None):
+            found.update(Blogger.following.through.objects.filter(user_id__in=missing)
+                                                          .values_list('user_id')
+                                                          .annotate(Count('blogger'))
+                                                          .order_by())
+        cache.set_many(dict((keys[user_id], count) for user_id, count in found.items()),
+                       settings.FOLLOW_GRAPH_TIMEOUT)
+        counts.update(found)
+    return counts
+
+def follower_count(user_id):
+    """ Get the number of followers of `user_id`. """
+    return follower_counts([user_id])[user_id]
+
+def invalidate(follower_id, followed_id):
+    """ Drop what the cache knows about the edge from `follower_id` to
+    `followed_id`. Call this after a follow or unfollow commits.
+    """
+    get_cache().set_many({_following_version_key(follower_id): _new_version(),
+                          _follower_count_version_key(followed_id): _new_version()}, None)
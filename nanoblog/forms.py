@@ -4,6 +4,7 @@ from django.core.exceptions   import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.core.validators import validate_email, RegexValidator
 from models import BlogPost, Blogger, Comment
+from nanoblog import imaging
 
 MAX_UPLOAD_SIZE = 2500000
 
@@ -73,7 +74,9 @@ class CommentForm(forms.ModelForm):
 class ProfileForm(forms.ModelForm):
     class Meta:
         model = Blogger
-        exclude = ('user', 'following', 'profile_picture_url')
+        # Only what users edit. The rest of Blogger is written by the app
+        # (see edit_profile in nanoblog.views).
+        fields = ('bio', 'age')
         widgets = {
             'bio': forms.Textarea(attrs={
                 'rows': 4,
@@ -82,12 +85,19 @@ class ProfileForm(forms.ModelForm):
         }
     profile_picture = forms.FileField(required=False)
 
-    def clean_picture(self):
-        picture = self.cleaned_data['picture']
+    def clean_profile_picture(self):
+        picture = self.cleaned_data['profile_picture']
         if not picture:
             return None
         if not picture.content_type or not picture.content_type.startswith('image'):
             raise forms.ValidationError('File type is not image')
         if picture.size > MAX_UPLOAD_SIZE:
             raise forms.ValidationError('File too big (max size is {0} bytes)'.format(MAX_UPLOAD_SIZE))
+        # The picture is resized later on (see nanoblog.uploads); make sure
+        # it looks decodable before accepting it.
+        try:
+            imaging.check(picture.read())
+        except imaging.ImageError as e:
+            raise forms.ValidationError(str(e))
+        picture.seek(0)
         return picture
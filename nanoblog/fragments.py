@@ -0,0 +1,115 @@
+"""
+Cache of rendered post cards (nanoblog/postcard.html).
+
+A card only changes when someone comments on the post or when the author of
+the post or of one of its comments changes their profile. Each post has a
+version token in the cache, and its rendered card is cached under a key made
+of the post id, its creation time and that token. Invalidating a card is
+just replacing its version token; the stale HTML is never read again and
+ages out of the cache. Including the creation time means a database that
+reuses the id of a deleted post can never serve the old post's card.
+Cards are rendered from the primary database, as a replica may not have
+the comment that invalidated them yet (see nanoblog.replicas). For the same
+reason, the comment count of a post read from a replica isn't trusted to
+skip looking for its comments.
+
+The cache used is settings.FRAGMENT_CACHE, an alias in settings.CACHES.
+"""
+
+import calendar
+import uuid
+
+from django.conf               import settings
+from django.core.cache         import caches
+from django.template.loader    import render_to_string
+from django.utils.safestring   import mark_safe
+
+from nanoblog.models import BlogPost, Comment
+from nanoblog.forms  import CommentForm
+from nanoblog.pagination import stream_datetime
+from nanoblog import metrics, replicas
+
+def get_cache():
+    return caches[settings.FRAGMENT_CACHE]
+
+def _version_key(post_id):
+    return 'postcard-version:%d' % post_id
+
+def _timestamp(value):
+    return '%d.%06d' % (calendar.timegm(value.utctimetuple()), value.microsecond)
+
+def _card_key(post, version):
+    key = 'postcard:%d:%s:%s' % (post.id, _timestamp(post.datetime), version)
+    # The card holds the time the post entered its stream
+    entered = stream_datetime(post)
+    if entered != post.datetime:
+        key += ':' + _timestamp(entered)
+    return key
+
+def _new_version():
+    return uuid.uuid4().hex
+
+def render_postcard(pac):
+    """ Render the card for one entry of comments_for_posts. """
+    return render_to_string("nanoblog/postcard.html",
+                            {'pac': pac, 'comment_form': CommentForm()})
+
+def postcards(posts):
+    """
+    Given a sequence of BlogPost objects, get a list of dictionaries like the
+    ones views.comments_for_posts returns, but with the rendered card of the
+    post in an "html" component instead of its comments. Cards come from the
+    cache when possible; comments are only fetched for the posts whose card
+    has to be rendered.
+    """
+    from nanoblog.views import comments_for_posts # views imports this module
+
+    cache = get_cache()
+    posts = list(posts)
+
+    versions = cache.get_many([_version_key(post.id) for post in posts])
+    new_versions = {}
+    card_keys = {}
+    for post in posts:
+        version = versions.get(_version_key(post.id))
+        if version is None:
+            version = new_versions[_version_key(post.id)] = _new_version()
+        card_keys[post.id] = _card_key(post, version)
+    if new_versions:
+        cache.set_many(new_versions, None)
+
+    cards = cache.get_many(card_keys.values())
+    missing = [post for post in posts if card_keys[post.id] not in cards]
+    metrics.count_cache('fragments', len(posts) - len(missing), len(missing))
+    rendered = {}
+    # A replica's comment counts may predate the comments that invalidated
+    # the cards
+    trust_counts = replicas.current() is None
+    with replicas.reading_from(None):
+        for pac in comments_for_posts(missing, trust_counts):
+            rendered[card_keys[pac['post'].id]] = render_postcard(pac)
+    if rendered:
+        cache.set_many(rendered)
+        cards.update(rendered)
+
+    posts_and_comments = []
+    for post in posts:
+        group = {}
+        group["post"] = post
+        group["last_updated"] = str(stream_datetime(post))
+        group["html"] = mark_safe(cards[card_keys[post.id]])
+        posts_and_comments.append(group)
+    return posts_and_comments
+
+def invalidate_posts(post_ids):
+    """ Drop the cached cards of the posts with ids `post_ids`. """
+    get_cache().set_many(dict((_version_key(post_id), _new_version())
+                              for post_id in post_ids), None)
+
+def invalidate_user(user):
+    """ Drop the cached cards showing `user`'s profile, i.e. those of their
+    posts and of the posts they commented on.
+    """
+    post_ids = set(BlogPost.objects.filter(user=user).values_list('id', flat=True))
+    post_ids.update(Comment.objects.filter(user=user).values_list('post_id', flat=True))
+    invalidate_posts(post_ids)
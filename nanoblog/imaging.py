@@ -0,0 +1,113 @@
+"""
+Resizing of profile pictures.
+
+An uploaded picture is decoded, turned upright according to its EXIF
+orientation and re-encoded as a progressive JPEG at each size in VARIANTS.
+Re-encoding drops the metadata (EXIF, GPS, comments) and whatever else was
+in the original file, and keeps the images the streams load small: post and
+comment thumbnails use the two small sizes, the user page the largest.
+"""
+
+from io import BytesIO
+
+from PIL import Image
+
+# (name, longest side in pixels), smallest first. The thumbnail fits the
+# comment thumbnails (95px), the card one the post thumbnails (150px).
+VARIANTS = (
+    ('thumb', 96),
+    ('card', 160),
+    ('full', 640),
+)
+VARIANT_NAMES = [name for name, size in VARIANTS]
+
+CONTENT_TYPE = 'image/jpeg'
+JPEG_QUALITY = 85
+
+# Refuse to decode images larger than this, however small the file
+MAX_PIXELS = 40 * 1000 * 1000
+
+# EXIF orientation tag values, and how to undo them
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSES = {
+    2: [Image.FLIP_LEFT_RIGHT],
+    3: [Image.ROTATE_180],
+    4: [Image.FLIP_TOP_BOTTOM],
+    5: [Image.ROTATE_270, Image.FLIP_LEFT_RIGHT],
+    6: [Image.ROTATE_270],
+    7: [Image.ROTATE_90, Image.FLIP_LEFT_RIGHT],
+    8: [Image.ROTATE_90],
+}
+
+class ImageError(ValueError):
+    """ The data is not an image we can use. """
+
+def _open(data, decode):
+    try:
+        image = Image.open(BytesIO(data))
+        if image.size[0] * image.size[1] > MAX_PIXELS:
+            raise ImageError('Image is too large (%dx%d)' % image.size)
+        if decode:
+            image.load()
+        else:
+            image.verify()
+    except ImageError:
+        raise
+    except Exception as e:
+        raise ImageError('Not a valid image: %s' % e)
+    return image
+
+def check(data):
+    """ Check that the string `data` looks like an image we can decode,
+    without decoding it. Raises ImageError if not.
+    """
+    _open(data, decode=False)
+
+def open_image(data):
+    """ Decode the image in the string `data`. Raises ImageError if it can't. """
+    return _open(data, decode=True)
+
+def upright(image):
+    """ Get `image` rotated and flipped the way its EXIF orientation says. """
+    try:
+        orientation = image._getexif().get(EXIF_ORIENTATION)
+    except Exception: # no EXIF data, or not a JPEG
+        orientation = None
+    for method in ORIENTATION_TRANSPOSES.get(orientation, []):
+        image = image.transpose(method)
+    return image
+
+def flatten(image):
+    """ Get `image` in RGB, with any transparency over a white background. """
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        return background
+    return image.convert('RGB')
+
+def encode(image):
+    """ Get `image` as a progressive JPEG, without any metadata. """
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+def variants(data):
+    """
+    Make the VARIANTS of the picture in the string `data`. Returns a list of
+    (name, width, JPEG data), smallest first. Pictures are shrunk to fit
+    each size, never enlarged. Raises ImageError if `data` isn't an image.
+    """
+    image = flatten(upright(open_image(data)))
+    results = []
+    for name, size in VARIANTS:
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.ANTIALIAS)
+        results.append((name, variant.size[0], encode(variant)))
+    return results
+
+def srcset(urls_and_widths):
+    """ Get the srcset attribute value for a list of (URL, width in pixels). """
+    return ', '.join('%s %dw' % (url, width) for url, width in urls_and_widths)
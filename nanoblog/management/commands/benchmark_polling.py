@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+from nanoblog import benchmarks
+
+class Command(BaseCommand):
+    help = ("Hold --pollers long-polling clients open on the global stream of "
+            "the server at --url, like that many open tabs, while timing page "
+            "loads from one more client. Run it against the server before and "
+            "after a change to its configuration, e.g. sync workers and the "
+            "gthread workers of webapps/gunicorn_conf.py, and compare how many "
+            "pollers per core it serves without slowing page loads down. Uses "
+            "the users seeded by the other benchmarks.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--url', default=None,
+                    help='URL of the server, e.g. http://localhost:8000 (required).'),
+        make_option('--pollers', type='int', default=50,
+                    help='Number of long-polling clients (default 50).'),
+        make_option('--duration', type='float', default=30,
+                    help='Seconds to run for (default 30).'),
+        make_option('--cores', type='int', default=1,
+                    help='Number of cores of the server, to report pollers per core (default 1).'),
+        make_option('--timeout', type='float', default=30,
+                    help='Seconds after which a page load counts as failed (default 30).'),
+        make_option('--prefix', default='bench',
+                    help='Username prefix of the synthetic users (default "bench").'),
+        make_option('--json', default=None,
+                    help='Write the results as JSON to this file ("-" for stdout).'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['url']:
+            raise CommandError('--url is required')
+        users = User.objects.filter(username__startswith=options['prefix']).order_by('id')
+        if not users.exists():
+            raise CommandError('No users named %s<n>; run benchmark_streams first'
+                               % options['prefix'])
+        session = benchmarks.HttpSession(options['url'], users[0].username, options['prefix'],
+                                         timeout=options['timeout'] + 30)
+        # Logged in before the pollers start, which may keep it from logging in
+        probe = benchmarks.HttpSession(options['url'], users[0].username, options['prefix'],
+                                       timeout=options['timeout'])
+        deadline = time.time() + options['duration']
+        lock = threading.Lock()
+        polls = []
+        poll_errors = []
+
+        def poller():
+            while time.time() < deadline:
+                started = time.time()
+                try:
+                    # Nothing is newer than now, so this waits for new posts
+                    status = session.open('GET', '/', {'last_updated': str(timezone.now()),
+                                                       'wait': 1}, ajax=True)
+                except Exception:
+                    status = None
+                with lock:
+                    polls.append(time.time() - started)
+                    if status is None or status >= 400:
+                        poll_errors.append(status)
+
+        threads = [threading.Thread(target=poller) for i in range(options['pollers'])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Let the polls settle in
+        time.sleep(min(2, options['duration'] / 4))
+
+        page_loads = []
+        page_errors = 0
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                status = probe.open('GET', '/')
+            except Exception:
+                status = None
+            page_loads.append((time.time() - started) * 1000)
+            if status is None or status >= 400:
+                page_errors += 1
+            time.sleep(0.5)
+        for thread in threads:
+            thread.join(options['timeout'] + 30)
+
+        result = {
+            'url': options['url'],
+            'pollers': options['pollers'],
+            'cores': options['cores'],
+            'pollers_per_core': float(options['pollers']) / options['cores'],
+            'polls_completed': len(polls),
+            'poll_errors': len(poll_errors),
+            'page_loads': len(page_loads),
+            'page_errors': page_errors,
+            'page_p50_ms': benchmarks.percentile(page_loads, 0.5),
+            'page_p99_ms': benchmarks.percentile(page_loads, 0.99),
+        }
+        line = ('%(pollers)d pollers (%(pollers_per_core).0f per core): %(polls_completed)d '
+                'polls, %(poll_errors)d failed; %(page_loads)d page loads, p50 %(page_p50_ms).0f ms, '
+                'p99 %(page_p99_ms).0f ms, %(page_errors)d failed' % result)
+        if options['json'] == '-':
+            self.stderr.write(line)
+            self.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+        else:
+            self.stdout.write(line)
+            if options['json']:
+                with open(options['json'], 'w') as f:
+                    json.dump(result, f, indent=2, sort_keys=True)
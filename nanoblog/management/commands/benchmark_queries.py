@@ -0,0 +1,109 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf  import settings
+from django.db    import connection
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+from nanoblog.models import BlogPost, Comment, TimelineEntry
+from nanoblog.pagination import with_authors
+from nanoblog import benchmarks, timeline
+
+# Models whose index_together holds the stream indexes, for --compare
+INDEXED_MODELS = (BlogPost, Comment, TimelineEntry)
+
+class Command(BaseCommand):
+    help = ("Seed a synthetic data set, then print the query plan and timings "
+            "of the queries behind the streams. Only run this on a scratch database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+                    help='Number of users to create (default 1000).'),
+        make_option('--posts', type='int', default=100000,
+                    help='Number of posts to create (default 100000).'),
+        make_option('--comments', type='int', default=2,
+                    help='Average number of comments per post (default 2).'),
+        make_option('--follows', type='int', default=50,
+                    help='Number of users each user follows (default 50).'),
+        make_option('--prefix', default='bench',
+                    help='Username prefix of the synthetic users (default "bench").'),
+        make_option('--no-seed', action='store_false', dest='seed', default=True,
+                    help='Reuse users with --prefix seeded by an earlier run.'),
+        make_option('--repeat', type='int', default=50,
+                    help='Number of times each query is timed (default 50).'),
+        make_option('--compare', action='store_true', default=False,
+                    help='Also time the queries with the stream indexes dropped.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.stdout.write('Seeding %(users)d users, %(posts)d posts...' % options)
+            benchmarks.seed(users=options['users'], posts=options['posts'],
+                            comments_per_post=options['comments'],
+                            follows_per_user=options['follows'],
+                            prefix=options['prefix'])
+
+        user = User.objects.filter(username__startswith=options['prefix']).order_by('id')[0]
+        queries = self.stream_queries(user)
+
+        if options['compare']:
+            self.stdout.write('\n=== Without stream indexes ===')
+            self.set_stream_indexes(False)
+            try:
+                self.run(queries, options['repeat'])
+            finally:
+                self.set_stream_indexes(True)
+            self.stdout.write('\n=== With stream indexes ===')
+        self.run(queries, options['repeat'])
+
+    def stream_queries(self, user):
+        """ Get (name, queryset) pairs for the queries the stream views make. """
+        page_size = settings.STREAM_PAGE_SIZE
+        newest_first = ('-datetime', '-id')
+        recent = timezone.now() - timedelta(hours=1)
+        page = BlogPost.objects.order_by(*newest_first)[:page_size]
+        page_ids = list(page.values_list('id', flat=True))
+        shown = BlogPost.objects.filter(datetime__gte=recent - timedelta(days=1),
+                                        datetime__lte=recent)
+        return [
+            ('global page', page),
+            ('global refresh', BlogPost.objects.filter(datetime__gt=recent)
+                                               .order_by('datetime', 'id')[:page_size]),
+            ('user page', BlogPost.objects.filter(user=user).order_by(*newest_first)[:page_size]),
+            # Paged on the entries' own (datetime, post), see nanoblog.pagination
+            ('following page', with_authors(timeline.timeline_entries(user))
+                                   .order_by('-datetime', '-post')[:page_size]),
+            ('page comments', Comment.objects.filter(post__in=page_ids)
+                                             .order_by('datetime', 'id')),
+            ('comment refresh', Comment.objects.filter(post__in=shown, datetime__gt=recent)
+                                               .order_by('datetime', 'id')),
+        ]
+
+    def run(self, queries, repeat):
+        for name, queryset in queries:
+            durations = benchmarks.time_calls(lambda: list(queryset.all()), repeat)
+            self.stdout.write('\n%s: median %.2f ms, p99 %.2f ms' % (
+                name, benchmarks.percentile(durations, 0.5),
+                benchmarks.percentile(durations, 0.99)))
+            for line in self.explain(queryset):
+                self.stdout.write('    ' + line)
+
+    def explain(self, queryset):
+        """ Get the database's query plan for `queryset`, as lines of text. """
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        return [' '.join(unicode(column) for column in row) for row in cursor.fetchall()]
+
+    def set_stream_indexes(self, present):
+        """ Create or drop the indexes in the index_together of INDEXED_MODELS. """
+        with connection.schema_editor() as editor:
+            for model in INDEXED_MODELS:
+                index_together = model._meta.index_together
+                if present:
+                    editor.alter_index_together(model, [], index_together)
+                else:
+                    editor.alter_index_together(model, index_together, [])
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nanoblog.models import BlogPost
+from nanoblog import benchmarks, search
+
+# Against the data made by benchmark_queries: a word in every post, a word
+# in a single post, and both
+DEFAULT_QUERIES = ['synthetic', '4321', 'synthetic 4321']
+
+class Command(BaseCommand):
+    args = '[query ...]'
+    help = ("Time searches against the current database, e.g. one seeded by "
+            "benchmark_queries (run rebuild_search_index first if needed).")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=20,
+                    help='Number of times each search is timed (default 20).'),
+    )
+
+    def handle(self, *queries, **options):
+        self.stdout.write('%d posts, %s index' % (BlogPost.objects.count(),
+                                                  type(search.get_index()).__name__))
+        for query in queries or DEFAULT_QUERIES:
+            durations = benchmarks.time_calls(lambda: search.search(query), options['repeat'])
+            self.stdout.write('%r: median %.2f ms, p99 %.2f ms' % (
+                query, benchmarks.percentile(durations, 0.5),
+                benchmarks.percentile(durations, 0.99)))
@@ -0,0 +1,55 @@
+import os
+import uuid
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from nanoblog import benchmarks
+
+class Command(BaseCommand):
+    help = ("Time uploads and deletes against a storage backend, on its own. "
+            "Files are written under a random prefix and deleted afterwards.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backend', default=None,
+                    help='Storage class to use (default: settings.UPLOAD_STORAGE).'),
+        make_option('--size', type='int', default=20000,
+                    help='Size of each file in bytes (default 20000).'),
+        make_option('--repeat', type='int', default=20,
+                    help='Number of files to upload (default 20).'),
+    )
+
+    def handle(self, *args, **options):
+        backend = options['backend'] or settings.UPLOAD_STORAGE
+        storage = import_string(backend)()
+        prefix = 'benchmark-%s/' % uuid.uuid4().hex
+        data = os.urandom(options['size'])
+        names = iter('%s%d' % (prefix, i) for i in range(options['repeat'] * 2 + 1))
+        uploaded = []
+
+        def upload():
+            name = next(names)
+            storage.upload(name, data, 'application/octet-stream')
+            uploaded.append(name)
+
+        # The first call opens the connection; time it separately
+        first = benchmarks.time_calls(upload, 1)[0]
+        self.stdout.write('%s, %d byte files' % (backend, options['size']))
+        self.stdout.write('first upload: %.2f ms' % first)
+        self.report('upload', benchmarks.time_calls(upload, options['repeat']))
+
+        def delete():
+            storage.delete(uploaded.pop())
+        self.report('delete', benchmarks.time_calls(delete, options['repeat']))
+
+        for i in range(options['repeat']):
+            upload()
+        remaining = len(uploaded)
+        durations = benchmarks.time_calls(lambda: storage.delete_many(uploaded), 1)
+        self.stdout.write('delete_many of %d: %.2f ms' % (remaining, durations[0]))
+
+    def report(self, name, durations):
+        self.stdout.write('%s: median %.2f ms, p99 %.2f ms' % (
+            name, benchmarks.percentile(durations, 0.5), benchmarks.percentile(durations, 0.99)))
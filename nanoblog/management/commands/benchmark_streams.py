@@ -0,0 +1,120 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db    import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django.contrib.auth.models import User
+from nanoblog.models import BlogPost
+from nanoblog import benchmarks
+
+class Command(BaseCommand):
+    help = ("Seed a synthetic data set, then time the stream endpoints, posting "
+            "and commenting through the Django test client, and with --url "
+            "over HTTP from concurrent clients. Prints p50/p99 latency, queries "
+            "per request and throughput, and with --json writes them as JSON "
+            "to compare between releases. Only run this on a scratch database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+                    help='Number of users to create (default 1000).'),
+        make_option('--posts', type='int', default=100000,
+                    help='Number of posts to create (default 100000).'),
+        make_option('--comments', type='int', default=2,
+                    help='Average number of comments per post (default 2).'),
+        make_option('--follows', type='int', default=50,
+                    help='Number of users each user follows (default 50).'),
+        make_option('--prefix', default='bench',
+                    help='Username prefix of the synthetic users (default "bench").'),
+        make_option('--no-seed', action='store_false', dest='seed', default=True,
+                    help='Reuse users with --prefix seeded by an earlier run.'),
+        make_option('--scenarios', default=None,
+                    help='Comma separated scenarios to run (default all: global_stream, '
+                         'following, user, refresh, add, add_comment).'),
+        make_option('--repeat', type='int', default=50,
+                    help='Requests per scenario through the test client (default 50).'),
+        make_option('--url', default=None,
+                    help='Also load test the server at this URL, e.g. http://localhost:8000, '
+                         'serving the same database.'),
+        make_option('--concurrency', type='int', default=8,
+                    help='Concurrent HTTP clients with --url (default 8).'),
+        make_option('--requests', type='int', default=500,
+                    help='HTTP requests per scenario with --url (default 500).'),
+        make_option('--json', default=None,
+                    help='Write the results as JSON to this file ("-" for stdout).'),
+    )
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.log(options, 'Seeding %(users)d users, %(posts)d posts...' % options)
+            benchmarks.seed(users=options['users'], posts=options['posts'],
+                            comments_per_post=options['comments'],
+                            follows_per_user=options['follows'],
+                            prefix=options['prefix'])
+
+        users = User.objects.filter(username__startswith=options['prefix']).order_by('id')
+        if not users.exists():
+            raise CommandError('No users named %s<n>; run without --no-seed' % options['prefix'])
+        user = users[0]
+        password = options['prefix']
+
+        scenarios = benchmarks.stream_scenarios(user)
+        if options['scenarios']:
+            names = options['scenarios'].split(',')
+            unknown = set(names) - set(scenario.name for scenario in scenarios)
+            if unknown:
+                raise CommandError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+            scenarios = [scenario for scenario in scenarios if scenario.name in names]
+
+        results = []
+        # The test client's host is "testserver", and rendering pages
+        # shouldn't need collectstatic to have run
+        with override_settings(ALLOWED_HOSTS=['*'],
+                               STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+            client = benchmarks.logged_in_client(user.username, password)
+            for scenario in scenarios:
+                results.append(benchmarks.run_client(scenario, client, options['repeat']))
+                self.report(options, results[-1])
+
+        if options['url']:
+            session = benchmarks.HttpSession(options['url'], user.username, password)
+            for scenario in scenarios:
+                results.append(benchmarks.run_http(scenario, session, options['concurrency'],
+                                                   options['requests']))
+                self.report(options, results[-1])
+
+        if options['json']:
+            output = {
+                'date': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'data_set': {
+                    'users': users.count(),
+                    'posts': BlogPost.objects.filter(user__username__startswith=options['prefix'])
+                                             .count(),
+                    'comments_per_post': options['comments'],
+                    'follows_per_user': options['follows'],
+                },
+                'concurrency': options['concurrency'] if options['url'] else None,
+                'results': results,
+            }
+            if options['json'] == '-':
+                self.stdout.write(json.dumps(output, indent=2, sort_keys=True))
+            else:
+                with open(options['json'], 'w') as f:
+                    json.dump(output, f, indent=2, sort_keys=True)
+
+    def log(self, options, message):
+        # Keep stdout machine readable with --json -
+        stream = self.stderr if options['json'] == '-' else self.stdout
+        stream.write(message)
+
+    def report(self, options, result):
+        line = '%(scenario)s (%(mode)s): %(requests)d requests, p50 %(p50_ms).2f ms, ' \
+               'p99 %(p99_ms).2f ms, %(throughput_rps).0f requests/s' % result
+        if result['queries_per_request'] is not None:
+            line += ', %.1f queries/request' % result['queries_per_request']
+        if result['errors']:
+            line += ', %d errors' % result['errors']
+        self.log(options, line)
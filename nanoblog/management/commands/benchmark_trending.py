@@ -0,0 +1,83 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nanoblog import benchmarks, trending
+
+class Command(BaseCommand):
+    help = ("Feed a day of synthetic posts and comments to the trending "
+            "counters and print the cost of updating and reading them. With "
+            "--snapshot, also time snapshots to the database; only do that "
+            "on a scratch database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--posts-per-minute', type='float', default=20,
+                    help='Posts made per minute (default 20).'),
+        make_option('--comments-per-post', type='float', default=2,
+                    help='Average comments per post (default 2).'),
+        make_option('--tags', type='int', default=1000,
+                    help='Number of distinct tags in use (default 1000).'),
+        make_option('--hours', type='float', default=24,
+                    help='Hours of activity fed to the counters (default 24).'),
+        make_option('--reads', type='int', default=1000,
+                    help='Number of times each read is timed (default 1000).'),
+        make_option('--snapshot', action='store_true', default=False,
+                    help='Also time snapshots to the database.'),
+    )
+
+    def handle(self, *args, **options):
+        rand = random.Random(0)
+        counters = trending.Trending(0)
+        end = time.time()
+        start = end - options['hours'] * 60 * 60
+        counters.load(start)
+
+        # A few tags are much more popular than the rest
+        def tag():
+            return 'tag%d' % (int(rand.paretovariate(1.0)) % options['tags'])
+
+        durations = []
+        def record(kind, key, timestamp):
+            started = time.time()
+            counters.record(kind, key, timestamp=timestamp)
+            durations.append((time.time() - started) * 1000000)
+
+        posts = int(options['hours'] * 60 * options['posts_per_minute'])
+        for post_id in range(posts):
+            timestamp = start + (end - start) * post_id / posts
+            record('tag', tag(), timestamp)
+            for i in range(rand.randint(0, int(2 * options['comments_per_post']))):
+                # Comments mostly go to recent posts
+                commented = max(0, post_id - int(rand.expovariate(0.01)))
+                record('post', commented, timestamp)
+                if rand.random() < 0.2:
+                    record('tag', tag(), timestamp)
+        self.stdout.write('%d updates: median %.1f us, p99 %.1f us' % (
+            len(durations), benchmarks.percentile(durations, 0.5),
+            benchmarks.percentile(durations, 0.99)))
+
+        for kind, window in [('tag', 'hour'), ('tag', 'day'), ('post', 'hour'), ('post', 'day')]:
+            reads = benchmarks.time_calls(
+                lambda: counters.top(kind, window, 10, timestamp=end), options['reads'])
+            self.stdout.write('top 10 %ss of the %s (%d counted): median %.3f ms, p99 %.3f ms' % (
+                kind, window, len(counters.counters[kind].totals[window]),
+                benchmarks.percentile(reads, 0.5), benchmarks.percentile(reads, 0.99)))
+
+        if options['snapshot']:
+            rows = len(counters.unsaved)
+            started = time.time()
+            counters.snapshot(end)
+            self.stdout.write('First snapshot, %d rows: %.1f ms' % (
+                rows, (time.time() - started) * 1000))
+            # What a process adds between two snapshots at this post rate
+            interval = 60
+            for post_id in range(int(options['posts_per_minute'] * interval / 60)):
+                counters.record('tag', tag(), timestamp=end)
+                counters.record('post', posts - 1 - post_id, timestamp=end)
+            rows = len(counters.unsaved)
+            started = time.time()
+            counters.snapshot(end + interval)
+            self.stdout.write('Snapshot of %d seconds, %d rows: %.1f ms' % (
+                interval, rows, (time.time() - started) * 1000))
@@ -0,0 +1,98 @@
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from django.contrib.auth.models import User
+from nanoblog.models import BlogPost, Comment
+from nanoblog import activity, batching, benchmarks, timeline
+
+def write_alone(function):
+    """ Commit `function` in its own transaction, like write coalescing off. """
+    with transaction.atomic():
+        return function()
+
+def save_post(post):
+    """ Get a function doing what the add view does with `post`. """
+    def save():
+        post.save()
+        timeline.fan_out(post)
+    return save
+
+def save_comment(comment):
+    """ Get a function doing what the add_comment view does with `comment`. """
+    def save():
+        comment.save()
+        activity.record_comment(comment)
+    return save
+
+class Command(BaseCommand):
+    help = ("Create posts and comments from many threads at once, committing "
+            "each on its own and then with write coalescing, and print the "
+            "throughput and latency of both. Only run this on a scratch database.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=8,
+                    help='Number of concurrent writers (default 8).'),
+        make_option('--writes', type='int', default=100,
+                    help='Writes per thread, half posts and half comments (default 100).'),
+        make_option('--delay', type='float', default=0.005,
+                    help='Coalescing delay in seconds (default 0.005).'),
+        make_option('--batch-size', type='int', default=100,
+                    help='Most writes per coalesced transaction (default 100).'),
+        make_option('--prefix', default='bench',
+                    help='Username prefix of the synthetic users (default "bench").'),
+        make_option('--no-seed', action='store_false', dest='seed', default=True,
+                    help='Reuse users with --prefix seeded by an earlier run.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            benchmarks.seed(users=max(options['threads'], 50), posts=0,
+                            prefix=options['prefix'])
+        users = list(User.objects.filter(username__startswith=options['prefix'])
+                                 .order_by('id')[:options['threads']])
+
+        batcher = batching.WriteBatcher(options['delay'], options['batch_size'])
+        for name, write in [('one transaction per write', write_alone),
+                            ('coalesced (%.1f ms)' % (options['delay'] * 1000), batcher.write)]:
+            self.run(name, write, users, options['writes'])
+
+    def run(self, name, write, users, writes):
+        durations = []
+        errors = []
+
+        def writer(user):
+            post = None
+            try:
+                for i in range(writes):
+                    if post is None or i % 2 == 0:
+                        post = BlogPost(user=user, text='Benchmark post %d' % i)
+                        function = save_post(post)
+                    else:
+                        function = save_comment(Comment(user=user, post=post,
+                                                        text='Benchmark comment %d' % i))
+                    try:
+                        durations.extend(benchmarks.time_calls(lambda: write(function), 1))
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(user,)) for user in users]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        self.stdout.write('\n%s: %d writes in %.2f s, %.0f writes/s' % (
+            name, len(durations), elapsed, len(durations) / elapsed))
+        if durations:
+            self.stdout.write('    latency: median %.2f ms, p99 %.2f ms' % (
+                benchmarks.percentile(durations, 0.5), benchmarks.percentile(durations, 0.99)))
+        if errors:
+            self.stdout.write('    %d failed, e.g. %r' % (len(errors), errors[0]))
@@ -0,0 +1,26 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nanoblog import uploads
+
+class Command(BaseCommand):
+    help = ("Upload the queued profile pictures. Run this periodically, or "
+            "with --forever as a worker process when UPLOAD_THREADS is 0.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--forever', action='store_true', default=False,
+                    help='Keep checking for new jobs instead of exiting.'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds between checks with --forever (default 1).'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            uploaded = uploads.process_pending()
+            if uploaded or not options['forever']:
+                self.stdout.write('Uploaded %d picture(s)' % uploaded)
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nanoblog import search
+
+class Command(BaseCommand):
+    help = "Reindex every post and comment for search."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            search.rebuild()
+        self.stdout.write('Rebuilt the search index')
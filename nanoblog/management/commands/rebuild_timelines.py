@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nanoblog.models import Blogger
+from nanoblog import timeline
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = ("Recompute the materialized following streams of the given users "
+            "(or of every user) from the follow graph.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--quiet', action='store_true', dest='quiet', default=False,
+                    help="Don't print a line for each rebuilt timeline."),
+    )
+
+    def handle(self, *usernames, **options):
+        bloggers = Blogger.objects.select_related('user')
+        if usernames:
+            bloggers = bloggers.filter(user__username__in=usernames)
+
+        count = 0
+        for blogger in bloggers.iterator():
+            # One transaction per user, so readers never see a half-built timeline
+            with transaction.atomic():
+                timeline.rebuild(blogger)
+            count += 1
+            if not options['quiet']:
+                self.stdout.write('Rebuilt timeline for %s' % blogger.user.username)
+        self.stdout.write('Rebuilt %d timeline(s)' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nanoblog import activity
+
+class Command(BaseCommand):
+    help = ("Recompute the comment_count and last_activity of every post "
+            "from its comments, fixing any that drifted.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            fixed = activity.reconcile()
+        self.stdout.write('Fixed %d post(s)' % fixed)
@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nanoblog import outbox
+
+class Command(BaseCommand):
+    help = ("Send the queued email. Run this periodically, or with --forever "
+            "as a worker process when EMAIL_BACKGROUND_SENDER is off.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--forever', action='store_true', default=False,
+                    help='Keep checking for new messages instead of exiting.'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds between checks with --forever (default 1).'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Messages sent per connection (default EMAIL_BATCH_SIZE).'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            sent = outbox.send_pending(options['batch_size'])
+            if sent or not options['forever']:
+                self.stdout.write('Sent %d message(s)' % sent)
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
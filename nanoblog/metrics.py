@@ -0,0 +1,279 @@
+"""
+Per-request instrumentation.
+
+MetricsMiddleware follows each request and records, under the name of the
+view that handled it:
+- the request's duration
+- the number of database queries it made and the time spent in them
+- the time spent rendering templates
+- cache hits and misses, as counted by count_cache() (the post card and
+  follow graph caches)
+- the time spent calling other services (S3, the mail server), in
+  external() blocks
+
+The totals are kept in memory, per process, and served in the Prometheus
+text format by the metrics view (/metrics), to Prometheus scraping with
+settings.METRICS_TOKEN and to staff users. With several worker processes
+each scrape sees one of them; the "pid" label tells which. With
+settings.METRICS_SERVER_TIMING on, every response also gets a Server-Timing
+header with its own numbers, which browser developer tools show.
+
+Database and template timings come from wrapping Django's CursorWrapper
+execute methods and Template.render, once, when the middleware is loaded
+(see install()). Work done outside of requests, e.g. by the upload
+threads, is only counted by external(), under the view "background".
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib  import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+# Upper bounds of the request duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Name, type and help text of everything exported
+METRICS = (
+    ('nanoblog_requests_total', 'counter', 'Requests handled.'),
+    ('nanoblog_request_seconds', 'histogram', 'Time spent handling requests.'),
+    ('nanoblog_db_queries_total', 'counter', 'Database queries made.'),
+    ('nanoblog_db_seconds_total', 'counter', 'Time spent in database queries.'),
+    ('nanoblog_template_seconds_total', 'counter', 'Time spent rendering templates.'),
+    ('nanoblog_cache_hits_total', 'counter', 'Cache lookups that found a value.'),
+    ('nanoblog_cache_misses_total', 'counter', 'Cache lookups that found nothing.'),
+    ('nanoblog_external_calls_total', 'counter', 'Calls to other services.'),
+    ('nanoblog_external_seconds_total', 'counter', 'Time spent calling other services.'),
+)
+
+class RequestMetrics(object):
+    """ What one request has done so far. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.view = 'unresolved'
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        # Nested templates ({% include %}) are part of their parent's time
+        self.template_depth = 0
+        self.cache_hits = defaultdict(int)
+        self.cache_misses = defaultdict(int)
+        self.external_calls = defaultdict(int)
+        self.external_seconds = defaultdict(float)
+
+    def server_timing(self, duration):
+        """ Get the value of the Server-Timing header for this request. """
+        entries = ['db;dur=%.1f;desc="%d queries"' % (self.db_seconds * 1000, self.db_queries),
+                   'tpl;dur=%.1f;desc="Templates"' % (self.template_seconds * 1000)]
+        if self.cache_hits or self.cache_misses:
+            entries.append('cache;desc="%d hits, %d misses"' % (
+                sum(self.cache_hits.values()), sum(self.cache_misses.values())))
+        for service, seconds in sorted(self.external_seconds.items()):
+            entries.append('%s;dur=%.1f' % (service, seconds * 1000))
+        entries.append('total;dur=%.1f' % (duration * 1000))
+        return ', '.join(entries)
+
+class Registry(object):
+    """ Process-wide totals, keyed by metric name and label values. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, where labels is a tuple of (name, value)
+        self.counters = defaultdict(float)
+        # labels -> [count in each of BUCKETS, count, sum]
+        self.histograms = {}
+
+    def add(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def record(self, metrics, duration):
+        """ Add up a finished request's RequestMetrics. """
+        view = (('view', metrics.view),)
+        with self.lock:
+            counters = self.counters
+            counters[('nanoblog_requests_total', view)] += 1
+            counters[('nanoblog_db_queries_total', view)] += metrics.db_queries
+            counters[('nanoblog_db_seconds_total', view)] += metrics.db_seconds
+            counters[('nanoblog_template_seconds_total', view)] += metrics.template_seconds
+            for cache, hits in metrics.cache_hits.items():
+                counters[('nanoblog_cache_hits_total', view + (('cache', cache),))] += hits
+            for cache, misses in metrics.cache_misses.items():
+                counters[('nanoblog_cache_misses_total', view + (('cache', cache),))] += misses
+            for service, calls in metrics.external_calls.items():
+                labels = view + (('service', service),)
+                counters[('nanoblog_external_calls_total', labels)] += calls
+                counters[('nanoblog_external_seconds_total', labels)] += \
+                    metrics.external_seconds[service]
+
+            histogram = self.histograms.get(view)
+            if histogram is None:
+                histogram = self.histograms[view] = [[0] * len(BUCKETS), 0, 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+
+    def export(self):
+        """ Get everything recorded, in the Prometheus text format. """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((labels, (list(buckets), count, total))
+                              for labels, (buckets, count, total) in self.histograms.items())
+        pid = (('pid', str(os.getpid())),)
+        lines = []
+        for name, kind, help_text in METRICS:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind == 'histogram':
+                for labels, (buckets, count, total) in sorted(histograms.items()):
+                    labels += pid
+                    for bound, bucket_count in zip(BUCKETS, buckets):
+                        lines.append('%s_bucket%s %d' % (
+                            name, _labels(labels + (('le', repr(bound)),)), bucket_count))
+                    lines.append('%s_bucket%s %d' % (
+                        name, _labels(labels + (('le', '+Inf'),)), count))
+                    lines.append('%s_count%s %d' % (name, _labels(labels), count))
+                    lines.append('%s_sum%s %r' % (name, _labels(labels), total))
+            else:
+                for (counter_name, labels), value in sorted(counters.items()):
+                    if counter_name == name:
+                        lines.append('%s%s %r' % (name, _labels(labels + pid), value))
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+registry = Registry()
+
+_local = threading.local()
+
+def current():
+    """ Get the RequestMetrics of the request this thread is handling, if any. """
+    return getattr(_local, 'metrics', None)
+
+def count_cache(cache, hits, misses):
+    """ Count `hits` and `misses` of a lookup in `cache` for the current request. """
+    metrics = current()
+    if metrics is not None:
+        metrics.cache_hits[cache] += hits
+        metrics.cache_misses[cache] += misses
+
+@contextmanager
+def external(service):
+    """ Time the block as a call to `service`. """
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        metrics = current()
+        if metrics is not None:
+            metrics.external_calls[service] += 1
+            metrics.external_seconds[service] += duration
+        else:
+            labels = (('view', 'background'), ('service', service))
+            registry.add('nanoblog_external_calls_total', labels)
+            registry.add('nanoblog_external_seconds_total', labels, duration)
+
+_installed = False
+_install_lock = threading.Lock()
+
+def install():
+    """ Wrap Django's cursors and templates so they report to the current
+    request's RequestMetrics. Only does anything the first time.
+    """
+    global _installed
+    from django.db.backends import utils
+    from django.template.base import Template
+
+    with _install_lock:
+        if _installed:
+            return
+        _installed = True
+
+    def timed_query(execute):
+        def wrapper(self, *args, **kwargs):
+            metrics = current()
+            if metrics is None:
+                return execute(self, *args, **kwargs)
+            started = time.time()
+            try:
+                return execute(self, *args, **kwargs)
+            finally:
+                metrics.db_queries += 1
+                metrics.db_seconds += time.time() - started
+        return wrapper
+
+    # CursorDebugWrapper calls these too, so queries are counted once
+    utils.CursorWrapper.execute = timed_query(utils.CursorWrapper.execute.im_func)
+    utils.CursorWrapper.executemany = timed_query(utils.CursorWrapper.executemany.im_func)
+
+    render = Template.render.im_func
+    def timed_render(self, context):
+        metrics = current()
+        if metrics is None:
+            return render(self, context)
+        metrics.template_depth += 1
+        started = time.time()
+        try:
+            return render(self, context)
+        finally:
+            metrics.template_depth -= 1
+            if not metrics.template_depth:
+                metrics.template_seconds += time.time() - started
+    Template.render = timed_render
+
+class MetricsMiddleware(object):
+    """ Records every request's RequestMetrics. Put it first in
+    MIDDLEWARE_CLASSES, so it sees the whole request.
+    """
+
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        _local.metrics = RequestMetrics()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = current()
+        if metrics is not None:
+            name = getattr(view_func, '__name__', type(view_func).__name__)
+            metrics.view = '%s.%s' % (view_func.__module__, name)
+
+    def process_response(self, request, response):
+        metrics = current()
+        if metrics is None:
+            return response
+        _local.metrics = None
+        duration = time.time() - metrics.started
+        registry.record(metrics, duration)
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing(duration)
+        return response
+
+def allowed(request):
+    """ Whether `request` carries settings.METRICS_TOKEN as a bearer token,
+    or comes from a logged in staff user.
+    """
+    if settings.METRICS_TOKEN:
+        given = request.META.get('HTTP_AUTHORIZATION', '')
+        if constant_time_compare(given, 'Bearer %s' % settings.METRICS_TOKEN):
+            return True
+    return request.user.is_active and request.user.is_staff
+
+def metrics_view(request):
+    """ Serve the metrics of this process to Prometheus, or to staff users
+    (see allowed()).
+    """
+    if not allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.export(), content_type='text/plain; version=0.0.4')
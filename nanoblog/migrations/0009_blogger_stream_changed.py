@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0008_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogger',
+            name='stream_changed',
+            field=models.DateTimeField(null=True, db_index=True),
+            preserve_default=True,
+        ),
+    ]
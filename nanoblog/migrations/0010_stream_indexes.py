@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0009_blogger_stream_changed'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='blogpost',
+            index_together=set([('user', 'datetime'), ('datetime', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='comment',
+            index_together=set([('post', 'datetime')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def fill_activity(apps, schema_editor):
+    """ Compute comment_count and last_activity for existing posts. """
+    BlogPost = apps.get_model('nanoblog', 'BlogPost')
+    posts = BlogPost.objects.annotate(actual_count=models.Count('comment'),
+                                      latest_comment=models.Max('comment__datetime'))
+    for post in posts.iterator():
+        BlogPost.objects.filter(id=post.id).update(
+            comment_count=post.actual_count,
+            last_activity=max(post.datetime, post.latest_comment or post.datetime))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0010_stream_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogpost',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='blogpost',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_activity, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0012_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogger',
+            name='profile_picture_card_url',
+            field=models.CharField(max_length=256, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='blogger',
+            name='profile_picture_srcset',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='blogger',
+            name='profile_picture_thumb_url',
+            field=models.CharField(max_length=256, blank=True),
+            preserve_default=True,
+        ),
+    ]
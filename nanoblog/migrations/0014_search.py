@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def add_search_vector(apps, schema_editor):
+    """ On PostgreSQL, posts are indexed in a tsvector column of their own
+    table instead of SearchTerm (see nanoblog.search). Run the
+    rebuild_search_index command to fill it in.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('ALTER TABLE nanoblog_blogpost ADD COLUMN search_vector tsvector')
+    schema_editor.execute('CREATE INDEX nanoblog_blogpost_search_vector '
+                          'ON nanoblog_blogpost USING gin(search_vector)')
+
+def remove_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('ALTER TABLE nanoblog_blogpost DROP COLUMN search_vector')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0013_blogger_picture_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('term', models.CharField(max_length=40)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('post', models.ForeignKey(related_name='search_terms', to='nanoblog.BlogPost')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchterm',
+            unique_together=set([('term', 'post')]),
+        ),
+        migrations.RunPython(add_search_vector, remove_search_vector),
+    ]
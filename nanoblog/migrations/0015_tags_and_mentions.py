@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nanoblog', '0014_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=50)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='PostTag',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('datetime', models.DateTimeField()),
+                ('post', models.ForeignKey(related_name='post_tags', to='nanoblog.BlogPost')),
+                ('tag', models.ForeignKey(related_name='post_tags', to='nanoblog.Tag')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='posttag',
+            unique_together=set([('tag', 'post')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='posttag',
+            index_together=set([('tag', 'datetime')]),
+        ),
+        migrations.CreateModel(
+            name='Mention',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('datetime', models.DateTimeField()),
+                ('comment', models.ForeignKey(related_name='mentions', to='nanoblog.Comment', null=True)),
+                ('post', models.ForeignKey(related_name='mentions', to='nanoblog.BlogPost')),
+                ('user', models.ForeignKey(related_name='mentions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='mention',
+            unique_together=set([('user', 'post')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='mention',
+            index_together=set([('user', 'datetime')]),
+        ),
+    ]
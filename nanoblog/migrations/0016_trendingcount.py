@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0015_tags_and_mentions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10)),
+                ('key', models.CharField(max_length=50)),
+                ('start', models.DateTimeField(db_index=True)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='trendingcount',
+            unique_together=set([('kind', 'key', 'start')]),
+        ),
+    ]
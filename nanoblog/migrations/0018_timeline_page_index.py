@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0017_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='timelineentry',
+            index_together=set([('owner', 'datetime', 'post')]),
+        ),
+    ]
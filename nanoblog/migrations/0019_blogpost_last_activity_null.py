@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def clear_activity(apps, schema_editor):
+    """ Posts without comments have no last_activity of their own. """
+    BlogPost = apps.get_model('nanoblog', 'BlogPost')
+    BlogPost.objects.filter(comment__isnull=True).update(last_activity=None)
+
+def fill_activity(apps, schema_editor):
+    BlogPost = apps.get_model('nanoblog', 'BlogPost')
+    BlogPost.objects.filter(last_activity__isnull=True).update(last_activity=models.F('datetime'))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0018_timeline_page_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blogpost',
+            name='last_activity',
+            field=models.DateTimeField(null=True, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(clear_activity, fill_activity),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nanoblog', '0019_blogpost_last_activity_null'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='posttag',
+            index_together=set([('tag', 'datetime', 'post')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='mention',
+            index_together=set([('user', 'datetime', 'post')]),
+        ),
+    ]
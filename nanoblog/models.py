@@ -1,5 +1,6 @@
 from django.db import models
 from django import forms
+from django.utils import timezone
 
 from django.contrib.auth.models import User
 
@@ -7,9 +8,19 @@ class BlogPost(models.Model):
     text = models.CharField(max_length=160)
     user = models.ForeignKey(User)
     datetime = models.DateTimeField(auto_now_add=True)
+    # Maintained when comments are added (see nanoblog.activity), so the
+    # streams don't have to look at Comment to know these. last_activity is
+    # the time of the latest comment, None (i.e. `datetime`) before the first.
+    comment_count = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, db_index=True)
     def __unicode__(self):
         return self.text
 
+    class Meta:
+        # Streams are read newest first, paged on (datetime, id). Databases
+        # scan these indexes backwards for the descending order.
+        index_together = [('user', 'datetime'), ('datetime', 'id')]
+
 class Blogger(models.Model):
 	""" Additional data linked to a User. Has a one-to-one relationship with a User. """
 	user = models.OneToOneField(User)
@@ -17,10 +28,169 @@ class Blogger(models.Model):
 	bio = models.CharField(max_length=430, null=True)
 	age = models.PositiveIntegerField(null=True)
 	profile_picture_url = models.CharField(null=True, max_length=256)
+	# Smaller versions of the picture, and a srcset of all of them (see
+	# nanoblog.imaging). Pictures uploaded before these existed have none.
+	profile_picture_thumb_url = models.CharField(max_length=256, blank=True)
+	profile_picture_card_url = models.CharField(max_length=256, blank=True)
+	profile_picture_srcset = models.TextField(blank=True)
+	# When a post or comment last showed up in this user's stream. Stream
+	# refreshes are answered with 304 Not Modified based on this (see
+	# nanoblog.conditional).
+	stream_changed = models.DateTimeField(null=True, db_index=True)
+
+	@property
+	def thumb_picture_url(self):
+		""" URL of the smallest version of the profile picture. """
+		return self.profile_picture_thumb_url or self.profile_picture_url
+
+	@property
+	def card_picture_url(self):
+		""" URL of the version of the profile picture shown on post cards. """
+		return self.profile_picture_card_url or self.profile_picture_url
 
 class Comment(models.Model):
 	text = models.CharField(max_length=160)
 	user = models.ForeignKey(User)
 	post = models.ForeignKey(BlogPost)
 	datetime = models.DateTimeField(auto_now_add=True)
-	
\ No newline at end of file
+
+	class Meta:
+		# Comments are fetched per post in chronological order
+		index_together = [('post', 'datetime')]
+
+class TimelineEntry(models.Model):
+	""" A post in the following stream of `owner`. Entries are written when the
+	post is made, one per follower of its author (see nanoblog.timeline), so
+	reading a following stream is a range scan on (owner, datetime, post).
+	"""
+	owner = models.ForeignKey(User, related_name='timeline_entries')
+	post = models.ForeignKey(BlogPost, related_name='timeline_entries')
+	# Copy of post.datetime, so the stream can be ordered without a join
+	datetime = models.DateTimeField()
+
+	class Meta:
+		unique_together = ('owner', 'post')
+		# Pages are ordered on (datetime, post), see nanoblog.pagination
+		index_together = [('owner', 'datetime', 'post')]
+
+class UploadJob(models.Model):
+	""" A profile picture waiting to be uploaded to storage, and then set as
+	`blogger`'s picture. Processed in the background (see nanoblog.uploads).
+	"""
+	PENDING = 'pending'
+	RUNNING = 'running'
+	DONE = 'done'
+	FAILED = 'failed'
+	STATUS_CHOICES = (
+		(PENDING, 'Pending'),
+		(RUNNING, 'Running'),
+		(DONE, 'Done'),
+		(FAILED, 'Failed'),
+	)
+
+	blogger = models.ForeignKey(Blogger, related_name='upload_jobs')
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+	# The file itself, cleared once it has been uploaded
+	data = models.BinaryField(null=True)
+	content_type = models.CharField(max_length=100)
+	# Name of the file in storage, and its URL once uploaded
+	name = models.CharField(max_length=100, blank=True)
+	url = models.CharField(max_length=256, blank=True)
+	attempts = models.PositiveIntegerField(default=0)
+	error = models.TextField(blank=True)
+	created = models.DateTimeField(auto_now_add=True)
+	updated = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		# Workers look for the oldest jobs in a given status
+		index_together = [('status', 'updated')]
+
+class OutboundEmail(models.Model):
+	""" A message waiting to be sent to the mail server (see nanoblog.outbox). """
+	PENDING = 'pending'
+	SENDING = 'sending'
+	SENT = 'sent'
+	FAILED = 'failed'
+	STATUS_CHOICES = (
+		(PENDING, 'Pending'),
+		(SENDING, 'Sending'),
+		(SENT, 'Sent'),
+		(FAILED, 'Failed'),
+	)
+
+	subject = models.CharField(max_length=200)
+	body = models.TextField()
+	from_email = models.CharField(max_length=254)
+	# Comma separated addresses
+	recipients = models.TextField()
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	error = models.TextField(blank=True)
+	# Not sent before this, after a failed attempt
+	next_attempt = models.DateTimeField(default=timezone.now)
+	created = models.DateTimeField(auto_now_add=True)
+	updated = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		# Workers look for the messages due in a given status
+		index_together = [('status', 'next_attempt')]
+
+class SearchTerm(models.Model):
+	""" An entry of the inverted index used for search where the database
+	doesn't provide one: `post` or its comments contain `term`, and `count`
+	is the weighted number of times they do (see nanoblog.search).
+	"""
+	term = models.CharField(max_length=40)
+	post = models.ForeignKey(BlogPost, related_name='search_terms')
+	count = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		# Also the index looking up a term's posts
+		unique_together = ('term', 'post')
+
+class Tag(models.Model):
+	""" A #hashtag used in posts or comments, lower-cased. """
+	name = models.CharField(max_length=50, unique=True)
+
+	def __unicode__(self):
+		return self.name
+
+class PostTag(models.Model):
+	""" `post` or one of its comments mentions `tag` (see nanoblog.tags). """
+	tag = models.ForeignKey(Tag, related_name='post_tags')
+	post = models.ForeignKey(BlogPost, related_name='post_tags')
+	# When the post entered the tag's stream: post.datetime, or the datetime
+	# of the comment using the tag. A tag's stream is a range scan on
+	# (tag, datetime, post), see nanoblog.pagination.
+	datetime = models.DateTimeField()
+
+	class Meta:
+		unique_together = ('tag', 'post')
+		index_together = [('tag', 'datetime', 'post')]
+
+class Mention(models.Model):
+	""" `post`, or its comment `comment`, mentions `user` as @username. """
+	user = models.ForeignKey(User, related_name='mentions')
+	post = models.ForeignKey(BlogPost, related_name='mentions')
+	comment = models.ForeignKey(Comment, null=True, related_name='mentions')
+	# When the post entered the user's mentions stream: post.datetime, or
+	# comment.datetime
+	datetime = models.DateTimeField()
+
+	class Meta:
+		unique_together = ('user', 'post')
+		index_together = [('user', 'datetime', 'post')]
+
+class TrendingCount(models.Model):
+	"""
+	Snapshot of the trending counters (see nanoblog.trending): `key` (a tag
+	name or a post id, by `kind`) was counted `count` times in the bucket
+	starting at `start`.
+	"""
+	kind = models.CharField(max_length=10)
+	key = models.CharField(max_length=50)
+	start = models.DateTimeField(db_index=True)
+	count = models.IntegerField(default=0)
+
+	class Meta:
+		unique_together = ('kind', 'key', 'start')
@@ -0,0 +1,158 @@
+"""
+Queue of outgoing email.
+
+Views don't talk to the mail server. queue() saves the message in an
+OutboundEmail row, in the view's transaction, so a message is only sent if
+what it is about was committed, and the view returns without waiting for
+SMTP. The messages are sent by send_pending(), in batches over one
+connection to the mail server, either from the background sender thread
+(with settings.EMAIL_BACKGROUND_SENDER) or from the send_queued_mail
+management command. The thread is started with the process (see start()),
+so messages queued before a restart are sent without waiting for new ones.
+
+A message that can't be sent is tried again later, waiting
+settings.EMAIL_RETRY_DELAY seconds after the first failure and twice as
+long after each of the next ones, until it has failed
+settings.EMAIL_MAX_ATTEMPTS times.
+"""
+
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from nanoblog.models import OutboundEmail
+from nanoblog import metrics
+
+logger = logging.getLogger(__name__)
+
+def queue(subject, body, from_email, recipients):
+    """ Save a message to be sent to the list of addresses `recipients`.
+    Call wake() once the transaction saving it has committed.
+    """
+    return OutboundEmail.objects.create(subject=subject, body=body, from_email=from_email,
+                                        recipients=','.join(recipients))
+
+def retry_delay(attempts):
+    """ Get how long to wait before trying a message again after its
+    `attempts`th failure.
+    """
+    return timedelta(seconds=settings.EMAIL_RETRY_DELAY * 2 ** (attempts - 1))
+
+def claim(limit):
+    """ Mark up to `limit` of the messages due to be sent as being sent by
+    this worker, oldest first. Returns them.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.EMAIL_STALE_AFTER)
+    # Messages whose worker has not been heard of in a while
+    (OutboundEmail.objects.filter(status=OutboundEmail.SENDING, updated__lt=stale)
+                          .update(status=OutboundEmail.PENDING, updated=now))
+    due = (OutboundEmail.objects.filter(status=OutboundEmail.PENDING, next_attempt__lte=now)
+                                .order_by('next_attempt', 'id').values_list('id', flat=True))
+    claimed = [email_id for email_id in list(due[:limit])
+               if OutboundEmail.objects.filter(id=email_id, status=OutboundEmail.PENDING)
+                                       .update(status=OutboundEmail.SENDING,
+                                               attempts=F('attempts') + 1,
+                                               updated=timezone.now())]
+    return list(OutboundEmail.objects.filter(id__in=claimed).order_by('next_attempt', 'id'))
+
+def send_batch(emails, connection):
+    """ Send the claimed `emails` over the mail server `connection`.
+    Returns the number of messages sent.
+    """
+    sent = 0
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email,
+                                   email.recipients.split(','), connection=connection)
+            try:
+                # Opens the connection the first time, and again after a
+                # failure; send_messages() then leaves it open
+                with metrics.external('smtp'):
+                    connection.open()
+                    connection.send_messages([message])
+            except Exception as e:
+                logger.exception('Sending email %d failed', email.id)
+                connection.close()
+                now = timezone.now()
+                if email.attempts < settings.EMAIL_MAX_ATTEMPTS:
+                    OutboundEmail.objects.filter(id=email.id).update(
+                        status=OutboundEmail.PENDING, error=repr(e), updated=now,
+                        next_attempt=now + retry_delay(email.attempts))
+                else:
+                    OutboundEmail.objects.filter(id=email.id).update(
+                        status=OutboundEmail.FAILED, error=repr(e), updated=now)
+                continue
+            OutboundEmail.objects.filter(id=email.id).update(
+                status=OutboundEmail.SENT, error='', updated=timezone.now())
+            sent += 1
+    finally:
+        connection.close()
+    return sent
+
+def send_pending(batch_size=None):
+    """ Send the messages that are due, settings.EMAIL_BATCH_SIZE (or
+    `batch_size`) per connection to the mail server. Returns the number of
+    messages sent.
+    """
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    sent = 0
+    while True:
+        emails = claim(batch_size)
+        if not emails:
+            return sent
+        sent += send_batch(emails, get_connection())
+
+class Sender(object):
+    """ A thread sending the queued mail when woken up, and every
+    settings.EMAIL_RETRY_DELAY seconds for the messages to retry.
+    """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        thread = threading.Thread(target=self.work, name='mail-sender')
+        thread.daemon = True
+        thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def work(self):
+        while True:
+            self.wakeup.wait(settings.EMAIL_RETRY_DELAY)
+            self.wakeup.clear()
+            try:
+                # Like uploads.UploadPool, treat each round like a request
+                close_old_connections()
+                send_pending()
+            except Exception:
+                logger.exception('Sending queued mail failed')
+            finally:
+                close_old_connections()
+
+_sender = None
+_sender_lock = threading.Lock()
+
+def start():
+    """ Start the background sender, if there is one, and have it send
+    the messages already queued.
+    """
+    wake()
+
+def wake():
+    """ Have the background sender send the queued mail now, if there is
+    one, starting it the first time.
+    """
+    global _sender
+    if not settings.EMAIL_BACKGROUND_SENDER:
+        return
+    with _sender_lock:
+        if _sender is None:
+            _sender = Sender()
+    _sender.wake()
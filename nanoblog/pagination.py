@@ -0,0 +1,107 @@
+"""
+Keyset (cursor) pagination for the blog post streams.
+
+A page is described by the (datetime, id) of the last post the client has
+seen. The next page is everything strictly older than that pair, so fetching
+any page is an index range scan that costs the same no matter how many posts
+are in the table. Cursors are handed to the client as opaque url-safe tokens.
+
+A stream is either a BlogPost queryset, or a queryset of entries of a table
+listing the posts of many streams, with the post in `post` and the time it
+entered the stream in `datetime` (TimelineEntry, PostTag, Mention). Entries
+are paged on their own (datetime, post), so a page is a range scan on the
+entry table's index, and their posts are fetched in the same query. That
+time is usually the post's, but a post tagged or mentioned in a comment
+enters those streams when the comment is made; see stream_datetime().
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.db.models       import Q
+from django.utils.dateparse import parse_datetime
+
+from nanoblog.models import BlogPost
+
+def post_field(rows):
+    """ Get the name of the field of the stream `rows` holding the post id. """
+    return 'id' if rows.model is BlogPost else 'post'
+
+def with_authors(rows):
+    """ Have the stream `rows` fetch its posts with their authors and their
+    profiles, which post cards show.
+    """
+    if rows.model is BlogPost:
+        return rows.select_related('user__blogger')
+    return rows.select_related('post__user__blogger')
+
+def _posts(rows):
+    posts = []
+    for row in rows:
+        post = row if isinstance(row, BlogPost) else row.post
+        post.stream_datetime = row.datetime
+        posts.append(post)
+    return posts
+
+def stream_datetime(post):
+    """ Get the time `post` entered the stream it was fetched from, which
+    clients page and refresh on.
+    """
+    return getattr(post, 'stream_datetime', post.datetime)
+
+def encode_cursor(row):
+    """ Get an opaque token pointing just past `row` (a post, or an entry)
+    in a stream.
+    """
+    post_id = row.id if isinstance(row, BlogPost) else row.post_id
+    raw = '%s|%d' % (row.datetime.isoformat(), post_id)
+    return urlsafe_b64encode(raw).rstrip('=')
+
+def decode_cursor(token):
+    """ Inverse of encode_cursor. Returns a (datetime, id) pair.
+    Raises ValueError if the token was not produced by encode_cursor.
+    """
+    try:
+        raw = urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        datetime_str, id_str = raw.split('|')
+        post_datetime = parse_datetime(datetime_str)
+        post_id = int(id_str)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor: %r' % token)
+    if post_datetime is None:
+        raise ValueError('Invalid cursor: %r' % token)
+    return post_datetime, post_id
+
+def older_page(rows, page_size, cursor=None):
+    """
+    Get one page of the stream `rows` in reverse chronological order, starting
+    just after `cursor` (or at the newest post if cursor is None).
+
+    Returns a (posts, older_cursor) pair. posts is a list of at most page_size
+    BlogPosts; older_cursor is the token for the following page, or None if
+    this is the last one.
+    """
+    field = post_field(rows)
+    rows = rows.order_by('-datetime', '-' + field)
+    if cursor is not None:
+        post_datetime, post_id = decode_cursor(cursor)
+        rows = rows.filter(Q(datetime__lt=post_datetime) |
+                           Q(**{'datetime': post_datetime, field + '__lt': post_id}))
+
+    # Fetch one extra row to find out whether there is another page.
+    rows = list(rows[:page_size + 1])
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return _posts(rows), encode_cursor(rows[-1])
+    return _posts(rows), None
+
+def newer_page(rows, page_size, last_updated):
+    """
+    Get at most page_size posts of the stream `rows` made after
+    `last_updated`, in reverse chronological order. The oldest new posts are
+    returned first, so a client that has been away for a while catches up
+    over several refreshes without leaving a gap in its stream.
+    """
+    rows = rows.filter(datetime__gt=last_updated).order_by('datetime', post_field(rows))
+    posts = _posts(rows[:page_size])
+    posts.reverse()
+    return posts
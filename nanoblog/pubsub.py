@@ -0,0 +1,137 @@
+"""
+Change notifications for the streams, used to hold long-poll requests open
+until something new arrives.
+
+Every stream has a channel (see the *_channel functions below) with a
+version number that is bumped whenever a post or comment shows up in that
+stream. A waiting request remembers the version it saw before querying the
+database, and sleeps until the version moves on.
+
+The backend is chosen by settings.PUBSUB_BACKEND:
+- LocalPubSub keeps versions in memory and wakes waiters immediately, but
+  only sees events published by the same process. It is used for tests and
+  single process deployments.
+- CachePubSub keeps versions in the Django cache, so it works across worker
+  processes whenever the cache is shared (memcached, redis, ...). Waiters
+  poll the cache, which is much cheaper than re-running a stream query.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+def global_channel():
+    return 'global'
+
+def user_channel(user_id):
+    """ Channel for the stream of posts written by a user. """
+    return 'user:%d' % user_id
+
+def following_channel(user_id):
+    """ Channel for a user's following stream. """
+    return 'following:%d' % user_id
+
+def tag_channel(name):
+    """ Channel for the stream of posts with a tag (see nanoblog.tags). """
+    return 'tag:%s' % name
+
+def mentions_channel(user_id):
+    """ Channel for the stream of posts mentioning a user. """
+    return 'mentions:%d' % user_id
+
+def stream_channels(author_id, follower_ids):
+    """ Get every channel that shows the posts of `author_id`. """
+    channels = [global_channel(), user_channel(author_id)]
+    channels.extend(following_channel(follower_id) for follower_id in follower_ids)
+    return channels
+
+
+class LocalPubSub(object):
+    """ In-process backend, built on a single condition variable. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def version(self, channel):
+        with self._condition:
+            return self._versions.get(channel, 0)
+
+    def publish(self, channels):
+        with self._condition:
+            for channel in channels:
+                self._versions[channel] = self._versions.get(channel, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, channel, version, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._versions.get(channel, 0) == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._versions.get(channel, 0)
+
+
+class CachePubSub(object):
+    """ Backend sharing channel versions through the Django cache. """
+
+    # Seconds between two checks of the cache while waiting
+    poll_interval = 0.5
+
+    def __init__(self):
+        self._cache = caches[settings.PUBSUB_CACHE]
+
+    def _key(self, channel):
+        return 'pubsub:' + channel
+
+    def version(self, channel):
+        return self._cache.get(self._key(channel), 0)
+
+    def publish(self, channels):
+        for channel in channels:
+            key = self._key(channel)
+            # Channels never expire, a reset would look like a change anyway
+            if not self._cache.add(key, 1, None):
+                try:
+                    self._cache.incr(key)
+                except ValueError: # evicted in between
+                    self._cache.set(key, 1, None)
+
+    def wait(self, channel, version, timeout):
+        deadline = time.time() + timeout
+        current = self.version(channel)
+        while current == version and time.time() < deadline:
+            time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
+            current = self.version(channel)
+        return current
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """ Get the process-wide instance of settings.PUBSUB_BACKEND. """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.PUBSUB_BACKEND)()
+        return _backend
+
+def version(channel):
+    """ Get the current version of `channel`. """
+    return get_backend().version(channel)
+
+def publish(channels):
+    """ Signal that something new shows up in each of `channels`. """
+    get_backend().publish(channels)
+
+def wait(channel, version, timeout):
+    """ Block until `channel` is past `version` or `timeout` seconds have passed.
+    Returns the channel's version at that point.
+    """
+    return get_backend().wait(channel, version, timeout)
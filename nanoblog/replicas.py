@@ -0,0 +1,125 @@
+"""
+Read replicas for the streams.
+
+Stream pages and their refreshes only read, and are most of the traffic.
+Views decorated with replica_reads() send their queries to one of
+settings.DATABASE_REPLICAS, picked at random per request, when they answer
+a GET. Everything else goes to "default", the primary: writes, queries in a
+transaction, and the reads of every other view (sessions and users
+included, as they are loaded before the view is called). ReplicaRouter,
+in settings.DATABASE_ROUTERS, does the routing.
+
+Replicas lag behind the primary. So that users see their own posts,
+comments and follows right away, views decorated with pins_primary() set a
+cookie, and for settings.REPLICA_PIN_SECONDS after that the user's reads
+stay on the primary. Refreshes read from a replica also look for comments
+settings.REPLICA_MAX_LAG seconds further back (see lag_margin() and
+nanoblog.views.sync_margin), so other users' comments that had not reached
+the replica by the client's last refresh are not missed.
+
+Caches only refreshed when something is written (the post cards and the
+follow graph) are filled from the primary, in reading_from(None) blocks, so
+they never keep a replica's stale copy.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime   import timedelta
+from functools  import wraps
+
+from django.conf import settings
+from django.db   import DEFAULT_DB_ALIAS, connections
+
+# Cookie holding the time until which a user reads from the primary
+PIN_COOKIE = 'nb_primary_until'
+
+_local = threading.local()
+
+def current():
+    """ Get the replica this thread is reading from, if any. """
+    return getattr(_local, 'alias', None)
+
+@contextmanager
+def reading_from(alias):
+    """ Send the reads made in the block to the database `alias`
+    (None for the primary).
+    """
+    previous = current()
+    _local.alias = alias
+    try:
+        yield
+    finally:
+        _local.alias = previous
+
+def pinned(request):
+    """ Whether the user making `request` wrote recently enough to read
+    from the primary.
+    """
+    try:
+        return float(request.COOKIES[PIN_COOKIE]) > time.time()
+    except (KeyError, ValueError):
+        return False
+
+def read_alias(request):
+    """ Get the replica to answer `request` from, or None for the primary. """
+    replicas = settings.DATABASE_REPLICAS
+    if not replicas or request.method not in ('GET', 'HEAD') or pinned(request):
+        return None
+    return random.choice(replicas)
+
+def lag_margin():
+    """ Get how far behind the primary the database read from may be. """
+    if current() is None:
+        return timedelta(0)
+    return timedelta(seconds=settings.REPLICA_MAX_LAG)
+
+def replica_reads(view):
+    """ Decorate a view only reading from the database, so it reads from a
+    replica when it can (see read_alias()).
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with reading_from(read_alias(request)):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+def pins_primary(view):
+    """ Decorate a view writing to the database, so the user reads from the
+    primary for settings.REPLICA_PIN_SECONDS after calling it.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if settings.DATABASE_REPLICAS:
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, '%d' % (time.time() + seconds + 1),
+                                max_age=seconds, httponly=True)
+        return response
+    return wrapper
+
+class ReplicaRouter(object):
+    """ Sends the reads of replica_reads() views to their replica, and
+    everything else to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = current()
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Even for objects read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [DEFAULT_DB_ALIAS] + list(settings.DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, model):
+        # Replicas get the schema from the primary
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,231 @@
+"""
+Full-text search over posts and their comments.
+
+A post is found by the words in its text and in its comments; words in the
+post itself weigh more. Queries match the posts containing all their words,
+best matches first. There are two implementations of the inverted index,
+picked by the database in use:
+
+- PostgresIndex keeps a tsvector of every post in the search_vector column
+  of nanoblog_blogpost (added by migration 0014 on PostgreSQL only), with a
+  GIN index on it, and ranks with ts_rank_cd.
+- TermIndex is built by Python code and works on any database: every
+  (word, post) pair is a SearchTerm row holding the word's weighted count,
+  and queries look up the rows of their words by index, then score the
+  posts having all of them with tf-idf.
+
+Either way the index is updated incrementally as posts and comments are
+saved (index_post and index_comment, called in the saving transaction), and
+rebuilt from scratch with the rebuild_search_index command.
+"""
+
+import math
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, F
+
+from nanoblog.models import BlogPost, Comment, SearchTerm
+
+# Weight of a word in a post's text, and in one of its comments
+POST_WEIGHT = 2
+COMMENT_WEIGHT = 1
+
+# Longest word that is indexed; longer ones are cut
+MAX_TERM_LENGTH = 40
+
+STOP_WORDS = frozenset('''
+    a an and are as at be but by for from has have i if in is it its me my
+    of on or our so that the their this to was we were what with you your
+'''.split())
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Posts reindexed per statement by rebuild()
+BATCH_SIZE = 500
+
+def terms(text):
+    """ Get the list of index terms in `text`, in order, with repetitions. """
+    return [word[:MAX_TERM_LENGTH] for word in WORD_RE.findall(text.lower())
+            if word not in STOP_WORDS]
+
+class TermIndex(object):
+    """ Inverted index in the SearchTerm table. """
+
+    def index_post(self, post):
+        # A new post has no rows yet
+        self._add(post.id, terms(post.text), POST_WEIGHT, new=True)
+
+    def index_comment(self, comment):
+        self._add(comment.post_id, terms(comment.text), COMMENT_WEIGHT)
+
+    def _add(self, post_id, words, weight, new=False):
+        counts = defaultdict(int)
+        for word in words:
+            counts[word] += weight
+        existing = set()
+        if not new and counts:
+            existing.update(SearchTerm.objects.filter(post_id=post_id, term__in=counts.keys())
+                                              .values_list('term', flat=True))
+        for term in existing:
+            SearchTerm.objects.filter(post_id=post_id, term=term).update(
+                count=F('count') + counts[term])
+        missing = [term for term in counts if term not in existing]
+        try:
+            with transaction.atomic():
+                SearchTerm.objects.bulk_create(
+                    [SearchTerm(term=term, post_id=post_id, count=counts[term])
+                     for term in missing])
+        except IntegrityError:
+            # A concurrent comment on the post added some of these terms first
+            for term in missing:
+                self._add_term(post_id, term, counts[term])
+
+    def _add_term(self, post_id, term, count):
+        rows = SearchTerm.objects.filter(post_id=post_id, term=term)
+        if rows.update(count=F('count') + count):
+            return
+        try:
+            with transaction.atomic():
+                SearchTerm.objects.create(term=term, post_id=post_id, count=count)
+        except IntegrityError:
+            # Another transaction made the row first
+            rows.update(count=F('count') + count)
+
+    def rebuild(self, posts):
+        posts = list(posts.values_list('id', 'text'))
+        post_ids = [post_id for post_id, text in posts]
+        counts = dict((post_id, defaultdict(int)) for post_id in post_ids)
+        for post_id, text in posts:
+            for word in terms(text):
+                counts[post_id][word] += POST_WEIGHT
+        for start in range(0, len(post_ids), BATCH_SIZE):
+            batch = post_ids[start:start + BATCH_SIZE]
+            SearchTerm.objects.filter(post_id__in=batch).delete()
+            comments = Comment.objects.filter(post_id__in=batch).values_list('post_id', 'text')
+            for post_id, text in comments.iterator():
+                for word in terms(text):
+                    counts[post_id][word] += COMMENT_WEIGHT
+            rows = [SearchTerm(term=term, post_id=post_id, count=count)
+                    for post_id in batch for term, count in counts.pop(post_id).items()]
+            for row_start in range(0, len(rows), BATCH_SIZE):
+                SearchTerm.objects.bulk_create(rows[row_start:row_start + BATCH_SIZE])
+
+    # Posts having every one of the terms, scored by the sum of each term's
+    # count times its weight. Filled in with one placeholder per term, and
+    # for several terms RAREST_SQL, so only the posts having the rarest term
+    # are looked at.
+    SEARCH_SQL = '''
+        SELECT post_id FROM nanoblog_searchterm
+        WHERE term IN (%(terms)s) %(rarest)s
+        GROUP BY post_id
+        HAVING COUNT(*) = %%s
+        ORDER BY SUM(count * CASE term %(weights)s END) DESC, post_id DESC
+        LIMIT %%s OFFSET %%s
+    '''
+    RAREST_SQL = 'AND post_id IN (SELECT post_id FROM nanoblog_searchterm WHERE term = %s)'
+
+    def search(self, query, offset, limit):
+        words = sorted(set(terms(query)))
+        if not words:
+            return []
+        # Rare words tell more about a post than common ones (idf)
+        document_frequency = dict(SearchTerm.objects.filter(term__in=words)
+                                                    .values_list('term')
+                                                    .annotate(Count('post'))
+                                                    .order_by())
+        if len(document_frequency) < len(words):
+            return []
+        total = BlogPost.objects.count()
+        weights = []
+        for word in words:
+            weights.extend([word, math.log(1.0 + float(total) / document_frequency[word])])
+        params = list(words)
+        rarest_sql = ''
+        if len(words) > 1:
+            rarest_sql = self.RAREST_SQL
+            params.append(min(words, key=document_frequency.get))
+        sql = self.SEARCH_SQL % {
+            'terms': ', '.join(['%s'] * len(words)),
+            'rarest': rarest_sql,
+            'weights': ' '.join(['WHEN %s THEN %s'] * len(words)),
+        }
+        cursor = connection.cursor()
+        cursor.execute(sql, params + [len(words)] + weights + [limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+class PostgresIndex(object):
+    """ tsvector index in nanoblog_blogpost.search_vector, on PostgreSQL. """
+
+    UPDATE_SQL = '''
+        UPDATE nanoblog_blogpost SET search_vector =
+            setweight(to_tsvector(%s::regconfig, text), 'A') ||
+            setweight(to_tsvector(%s::regconfig, coalesce(
+                (SELECT string_agg(c.text, ' ') FROM nanoblog_comment c
+                 WHERE c.post_id = nanoblog_blogpost.id), '')), 'B')
+    '''
+
+    SEARCH_SQL = '''
+        SELECT id FROM nanoblog_blogpost, plainto_tsquery(%s::regconfig, %s) query
+        WHERE search_vector @@ query
+        ORDER BY ts_rank_cd(search_vector, query) DESC, id DESC
+        OFFSET %s LIMIT %s
+    '''
+
+    def _update(self, where, params):
+        config = settings.SEARCH_CONFIG
+        connection.cursor().execute(self.UPDATE_SQL + where, [config, config] + params)
+
+    def index_post(self, post):
+        self._update('WHERE id = %s', [post.id])
+
+    def index_comment(self, comment):
+        self._update('WHERE id = %s', [comment.post_id])
+
+    def rebuild(self, posts):
+        post_ids = list(posts.values_list('id', flat=True))
+        for start in range(0, len(post_ids), BATCH_SIZE):
+            self._update('WHERE id = ANY(%s)', [post_ids[start:start + BATCH_SIZE]])
+
+    def search(self, query, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute(self.SEARCH_SQL, [settings.SEARCH_CONFIG, query, offset, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+def get_index():
+    """ Get the index for the database in use. """
+    if connection.vendor == 'postgresql':
+        return PostgresIndex()
+    return TermIndex()
+
+def index_post(post):
+    """ Index the new `post`. Call this in the transaction that saves it. """
+    get_index().index_post(post)
+
+def index_comment(comment):
+    """ Index the new `comment` with its post. Call this in the transaction
+    that saves it.
+    """
+    get_index().index_comment(comment)
+
+def rebuild(posts=None):
+    """ Reindex `posts` (a BlogPost queryset, all posts by default). """
+    if posts is None:
+        posts = BlogPost.objects.all()
+    get_index().rebuild(posts)
+
+def search(query, page=1, page_size=None):
+    """
+    Get page `page` (counting from 1) of the posts matching `query`, best
+    first. Returns the list of BlogPosts, with their authors, and whether
+    there is a next page.
+    """
+    page_size = page_size or settings.STREAM_PAGE_SIZE
+    # One more than a page tells whether there is a next page
+    post_ids = get_index().search(query, (page - 1) * page_size, page_size + 1)
+    has_next = len(post_ids) > page_size
+    post_ids = post_ids[:page_size]
+    posts = BlogPost.objects.select_related('user__blogger').in_bulk(post_ids)
+    return [posts[post_id] for post_id in post_ids if post_id in posts], has_next
@@ -1,5 +1,118 @@
 var mostRecentPostTime;
 var refreshPeriodMS = 5000;
+// Whether updatePosts holds its request open on the server until there are
+// new posts, if the server allows it (longPollEnabled, set by the page).
+// Cleared on the first failure, after which we poll every refreshPeriodMS
+// instead.
+var longPoll = typeof longPollEnabled !== "undefined" && longPollEnabled;
+// Server time of our last refresh that brought something new. Each refresh
+// asks for the comments made since then on the posts we are showing. The
+// server keeps it while nothing changes, so our polls keep the same URL and
+// get 304 Not Modified.
+var commentsSyncedAt;
+
+// Escape text for use in HTML content or attribute values
+function escapeHtml(text) {
+	return String(text).replace(/&/g, "&amp;").replace(/</g, "&lt;")
+		.replace(/>/g, "&gt;").replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+}
+
+function formatDatetime(iso) {
+	// Some browsers can't parse more than millisecond precision
+	return new Date(iso.replace(/(\.\d{3})\d+/, "$1")).toLocaleString();
+}
+
+// A user's profile picture, for an image shown at most `size` pixels wide
+function userPicture(user, src, size, cssClass) {
+	var html = '<img class="left z-depth-2 ' + cssClass + '" src="' + escapeHtml(src) + '"';
+	if (user.srcset) {
+		html += ' srcset="' + escapeHtml(user.srcset) + '" sizes="' + size + 'px"';
+	}
+	return html + '>';
+}
+
+// Client-side version of the link_tags template filter: escape `text` and
+// link its #tags and @mentions to their streams
+function linkText(text) {
+	return escapeHtml(text)
+		.replace(/(^|[^\w&#])#(\w+)/g, function(match, before, name) {
+			return before + '<a href="/tag/' + name.toLowerCase().substring(0, 50) + '">#' + name + '</a>';
+		})
+		.replace(/(^|[^\w@])@([\w.@+\-]+)/g, function(match, before, name) {
+			var username = name.replace(/\.+$/, '');
+			return before + '<a href="/user/' + encodeURIComponent(username) + '">@' + username + '</a>' +
+				name.substring(username.length);
+		});
+}
+
+function userLink(user) {
+	return '<a href="/user/' + encodeURIComponent(user.username) + '">' +
+		escapeHtml(user.username) + '</a>';
+}
+
+// Client-side version of comment.html, for a comment record from the stream API
+function renderComment(comment, users) {
+	var user = users[comment.user];
+	var html = '<article class="comment card grey lighten-2 z-depth-3" comment_id="' + comment.id + '">';
+	if (user.picture) {
+		html += userPicture(user, user.thumb, 95, 'comment_thumbnail');
+	}
+	html += '<div class="card-action">' + userLink(user) +
+		'<span class="white-text right">' + escapeHtml(formatDatetime(comment.datetime)) + '</span></div>' +
+		'<div class="card-content darken-1"><form class="comment_form"><p class="comment_error"></p>' +
+		linkText(comment.text) + '</form></div></article>';
+	return html;
+}
+
+// Client-side version of blogposts.html, for post records from the stream API
+function renderPosts(posts, users) {
+	var html = '<div class="blogpost_page">';
+	$.each(posts, function(i, post) {
+		var user = users[post.user];
+		html += '<div class="container"><div class="row"><div class="col l8 offset-l2 m12 offset-m0 s12">' +
+			'<article class="card grey lighten-3 z-depth-2 postcard" last_updated="' + escapeHtml(post.last_updated) +
+			'" post_id="' + post.id + '"><article class="card blue darken-2 z-depth-3">';
+		if (user.picture) {
+			html += userPicture(user, user.card, 150, 'post_thumbnail');
+		}
+		html += '<div class="card-action">' + userLink(user) +
+			'<span class="grey-text right">' + escapeHtml(formatDatetime(post.datetime)) + '</span></div>' +
+			'<div class="card-content white-text">' + linkText(post.text) + '</div></article>' +
+			'<ul class="comment_list">';
+		$.each(post.comments, function(j, comment) {
+			html += renderComment(comment, users);
+		});
+		html += '</ul><article class="comment card grey lighten-2 z-depth-3"><div class="card-content darken-1">' +
+			'<form class="comment_form"><p class="comment_error"></p>' +
+			'<input type="hidden" name="postid" value="' + post.id + '">' +
+			'<textarea class="materialize-textarea" id="id_text" name="text" placeholder="Leave a comment..." rows="1"></textarea>' +
+			'<a class="btn waves-effect waves-light white-text aqua darken-3 right">Post' +
+			'<i class="mdi-content-send right"></i></a></form></div></article>' +
+			'</article></div></div></div>';
+	});
+	return html + '</div>';
+}
+
+function addComment(post_id, comment_html) {
+	var $comment = $($.trim(comment_html));
+	// We may already have it, e.g. if we posted it ourselves
+	if ($('.comment[comment_id="' + $comment.attr("comment_id") + '"]').length) {
+		return;
+	}
+	var $postcard = $('.postcard[post_id="' + post_id + '"]');
+	$comment.appendTo($postcard.find(".comment_list"));
+}
+
+// CSRF token for AJAX posts. Post cards are cached for everyone, so they hold
+// no token; Django keeps it in the csrftoken cookie, set by the token every
+// page renders (see base.html).
+function csrfToken() {
+	var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+	if (match) {
+		return decodeURIComponent(match[1]);
+	}
+	return $('input[name="csrfmiddlewaretoken"]').first().val();
+}
 
 function setCommentListeners() {
 	$("body").on("click", ".comment_form a", function(event) {
@@ -7,25 +120,22 @@ function setCommentListeners() {
 		var $textField = $form.find("#id_text");
 		var $errorField = $form.find(".comment_error");
 		var comment_text = $textField[0].value;
-		var csrf_token = $form.find('input[name="csrfmiddlewaretoken"]').val();
 		var post_id = $form.find('input[name="postid"]').val();
 
 		$textField.val("");
 		$errorField.text("Posting...");
 		$.ajax({
-			url: "add_comment",
+			url: "/add_comment",
 			type: "POST",
 			dataType: "json",
+			headers: {'X-CSRFToken': csrfToken()},
 			data: {
-				'csrfmiddlewaretoken': csrf_token,
 				'text': comment_text,
 				'post': post_id
 			},
 			success: function (json) {
 				if (json.success) {
-					var $commentList = $form.parents(".postcard").find(".comment_list");
-					var $comment = $(json.html);
-					$comment.appendTo($commentList);
+					addComment(post_id, json.html);
 					$errorField.text("");
 				} else {
 					$errorField.html(json.errors);
@@ -40,30 +150,131 @@ function setCommentListeners() {
 	});
 }
 
+// Post the new post form with AJAX, and show the post right away
+function setAddPostListener() {
+	$("#add_post_form").on("submit", function(event) {
+		event.preventDefault();
+		var $form = $(this);
+		var $textField = $form.find("#id_text");
+		var $errorField = $form.find("#add_post_error");
+		var data = $form.serialize();
+		var post_text = $textField.val();
+
+		$textField.val("");
+		$errorField.text("Posting...");
+		$.ajax({
+			url: $form.attr("action"),
+			type: "POST",
+			dataType: "json",
+			data: data,
+			success: function(json) {
+				if (json.success) {
+					// Marked as local until a refresh brings it in its place in the stream
+					var $card = $($.trim(json.html));
+					$card.find(".postcard").attr("local", "yes");
+					$card.insertBefore($("#blogpost_list"));
+					$errorField.text("");
+				} else {
+					$errorField.html(json.errors);
+					$textField.val(post_text);
+				}
+			},
+			error: function (xhr, status, err) {
+				$errorField.text("Network or server error - please try again.");
+				$textField.val(post_text);
+			}
+		});
+	});
+}
+
 function updatePosts() {
-	setTimeout(updatePosts, refreshPeriodMS);
-	var csrf_token = $('input[name="csrfmiddlewaretoken"]').first().val();
-	// Get the "last_updated" attribute of the first (chronologically newest) post
-	var last_updated = $('.postcard').first().attr("last_updated");
+	// Get the "last_updated" attribute of the first (chronologically newest)
+	// post, not counting our own posts shown before the server sent them
+	var last_updated = $('.postcard[local!="yes"]').first().attr("last_updated");
 	if (last_updated === undefined) {
 		// There are no posts yet. Use Python.datetime's minimum datetime value
 		last_updated = '0001-01-01 00:00:00'
 	}
+	var data = {
+		'last_updated': last_updated,
+		// Get new comments on every post from the oldest one we show
+		'oldest': $('.postcard').last().attr("last_updated"),
+		'comments_since': commentsSyncedAt
+	};
+	if (longPoll) {
+		// Ask the server to hold the request until there is something new
+		data['wait'] = 1;
+	}
 	$.ajax({
-		url: window.location.pathname,
+		url: streamApiUrl,
 		type: "GET",
-		data: {
-			'csrfmiddlewaretoken': csrf_token,
-			'last_updated': last_updated
+		data: data,
+		dataType: "json",
+		// Plain polls send If-None-Match and get 304 when nothing changed
+		ifModified: !longPoll,
+		success: function(json) {
+			// json is undefined on 304 Not Modified
+			if (json) {
+				$.each(json.posts, function(i, post) {
+					// Our own posts shown before the server sent them, and posts
+					// moving up the stream (tagged or mentioned in a new comment)
+					$('.postcard[post_id="' + post.id + '"]').closest(".container").remove();
+				});
+				$(renderPosts(json.posts, json.users)).insertBefore($("#blogpost_list"));
+				$.each(json.comments, function(i, comment) {
+					addComment(comment.post, renderComment(comment, json.users));
+				});
+				commentsSyncedAt = json.synced;
+			}
+			// Long-polls return as soon as there is news, so reconnect right away
+			setTimeout(updatePosts, longPoll ? 0 : refreshPeriodMS);
 		},
-		dataType: "html",
-		success: function(html) {
-			$(html).insertBefore($("#blogpost_list"));
+		error: function (xhr, status, err) {
+			// Fall back to plain polling
+			longPoll = false;
+			setTimeout(updatePosts, refreshPeriodMS);
 		}
 	});
 }
 
+function setLoadOlderListener() {
+	$("body").on("click", "#load_older", function(event) {
+		var $button = $(this);
+		// Cursor pointing past the oldest post on the page
+		var older_cursor = $button.attr("older_cursor");
+		if (!older_cursor) {
+			return;
+		}
+		$button.attr("visible", "no");
+		$.ajax({
+			url: streamApiUrl,
+			type: "GET",
+			data: {
+				'before': older_cursor
+			},
+			dataType: "json",
+			success: function(json) {
+				$(renderPosts(json.posts, json.users)).insertBefore($("#load_older_container"));
+				// A null cursor means we have reached the oldest post
+				older_cursor = json.older_cursor;
+				$button.attr("older_cursor", older_cursor);
+				$button.attr("visible", older_cursor ? "yes" : "no");
+			},
+			error: function (xhr, status, err) {
+				$button.attr("visible", "yes");
+			}
+		});
+	});
+}
+
 $(function() {
+	commentsSyncedAt = $("#blogpost_list").attr("synced");
 	setCommentListeners();
-	setTimeout(updatePosts, refreshPeriodMS);
+	setAddPostListener();
+	// Pages showing post cards without a stream (search results, trending
+	// posts) set no streamApiUrl, and only use the comment forms
+	if (typeof streamApiUrl !== "undefined") {
+		setLoadOlderListener();
+		updatePosts();
+	}
 });
\ No newline at end of file
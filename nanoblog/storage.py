@@ -0,0 +1,145 @@
+"""
+Storage backends for uploaded files (see nanoblog.uploads).
+
+settings.UPLOAD_STORAGE names the backend class; get_storage() returns the
+process-wide instance, shared by all threads. Backends don't connect to
+anything until they are first used, so importing and configuring them never
+needs the network.
+
+Every backend implements:
+- upload(name, data, content_type): store the string `data` as `name`,
+  replacing any file with that name, and return its public URL
+- delete(name): remove `name`; removing a missing file is not an error
+- delete_many(names): remove all of `names`, in as few requests as possible
+"""
+
+import os
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from nanoblog import metrics
+
+class Storage(object):
+    """ Base class for the storage backends. """
+
+    def upload(self, name, data, content_type):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def delete_many(self, names):
+        for name in names:
+            self.delete(name)
+
+class S3Storage(Storage):
+    """
+    Stores files as public objects in an S3 bucket, by default the one in
+    settings.S3_BUCKET, with the credentials in settings.S3_ACCESS_KEY and
+    settings.S3_SECRET_KEY.
+
+    Each thread opens its own connection the first time it needs one, and
+    keeps it (and its open HTTP connections) for the next requests: boto
+    connections must not be shared between threads.
+    """
+
+    # Most keys S3 deletes in one request
+    DELETE_BATCH_SIZE = 1000
+
+    def __init__(self, access_key=None, secret_key=None, bucket=None):
+        self.access_key = access_key or settings.S3_ACCESS_KEY
+        self.secret_key = secret_key or settings.S3_SECRET_KEY
+        self.bucket_name = bucket or settings.S3_BUCKET
+        self.local = threading.local()
+
+    def bucket(self):
+        """ Get this thread's handle on the bucket, connecting the first time. """
+        bucket = getattr(self.local, 'bucket', None)
+        if bucket is None:
+            import boto
+            connection = boto.connect_s3(self.access_key, self.secret_key)
+            # validate=False skips the extra request checking that the bucket exists
+            bucket = connection.get_bucket(self.bucket_name, validate=False)
+            self.local.bucket = bucket
+        return bucket
+
+    def upload(self, name, data, content_type):
+        from boto.s3.key import Key
+        k = Key(self.bucket())
+        k.key = name
+        k.content_type = content_type
+        with metrics.external('s3'):
+            k.set_contents_from_string(data, policy='public-read')
+        return k.generate_url(expires_in=0, query_auth=False)
+
+    def delete(self, name):
+        with metrics.external('s3'):
+            self.bucket().delete_key(name)
+
+    def delete_many(self, names):
+        names = list(names)
+        for start in range(0, len(names), self.DELETE_BATCH_SIZE):
+            with metrics.external('s3'):
+                self.bucket().delete_keys(names[start:start + self.DELETE_BATCH_SIZE], quiet=True)
+
+class FileSystemStorage(Storage):
+    """ Stores files in a directory, by default settings.MEDIA_ROOT, served
+    from settings.MEDIA_URL. For development and single server deployments.
+    """
+
+    def __init__(self, root=None, base_url=None):
+        self.root = root
+        self.base_url = base_url
+
+    def path(self, name):
+        return os.path.join(self.root or settings.MEDIA_ROOT, name)
+
+    def upload(self, name, data, content_type):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Write to a temporary file first, so nobody reads half a file
+        temporary_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.rename(temporary_path, path)
+        return (self.base_url or settings.MEDIA_URL) + name
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+class MemoryStorage(Storage):
+    """ Keeps files in a dict in memory, for tests and benchmarks.
+    `files` maps names to (data, content_type).
+    """
+
+    base_url = 'memory://'
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def upload(self, name, data, content_type):
+        with self.lock:
+            self.files[name] = (data, content_type)
+        return self.base_url + name
+
+    def delete(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """ Get the process-wide instance of settings.UPLOAD_STORAGE. """
+    global _storage
+    with _storage_lock:
+        if _storage is None or _storage[0] != settings.UPLOAD_STORAGE:
+            _storage = (settings.UPLOAD_STORAGE, import_string(settings.UPLOAD_STORAGE)())
+        return _storage[1]
@@ -0,0 +1,138 @@
+"""
+#hashtags and @mentions.
+
+They are parsed out of posts and comments when those are saved, and stored
+in the PostTag and Mention tables: a post is in the stream of every tag used
+in it or in its comments, and in the mentions stream of every user it or its
+comments mention, from the time of the post or comment that first did.
+Both streams are then index range scans, like the following streams (see
+nanoblog.timeline and nanoblog.pagination).
+"""
+
+import re
+
+from django.core.urlresolvers import reverse
+from django.db import transaction, IntegrityError
+from django.utils.html import escape
+
+from django.contrib.auth.models import User
+from nanoblog.models import Tag, PostTag, Mention
+from nanoblog import pubsub
+
+# Not preceded by a word character, nor by "&" so the "#39" of "&#39;" in
+# escaped text isn't taken for a tag
+TAG_RE = re.compile(r'(?<![\w&#])#(\w+)', re.UNICODE)
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.@+-]+)', re.UNICODE)
+
+MAX_TAG_LENGTH = 50
+
+def normalize(name):
+    """ Get the name a tag written as #`name` is stored under. """
+    return name.lower()[:MAX_TAG_LENGTH]
+
+def tag_names(text):
+    """ Get the set of (normalized) tag names used in `text`. """
+    return set(normalize(name) for name in TAG_RE.findall(text))
+
+def mentioned_usernames(text):
+    """ Get the set of usernames mentioned in `text`. """
+    # Sentence punctuation right after a username isn't part of it
+    return set(name.rstrip('.') for name in MENTION_RE.findall(text))
+
+def _insert(model, rows):
+    """ Insert the new `rows` of `model`, skipping those that another
+    transaction inserted first (they are all unique on something).
+    """
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(rows)
+    except IntegrityError:
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    row.save(force_insert=True)
+            except IntegrityError:
+                pass
+
+def get_tags(names):
+    """ Get the Tags with `names`, creating the missing ones. """
+    names = set(names)
+    existing = list(Tag.objects.filter(name__in=names))
+    missing = names - set(tag.name for tag in existing)
+    if missing:
+        _insert(Tag, [Tag(name=name) for name in missing])
+        existing.extend(Tag.objects.filter(name__in=missing))
+    return existing
+
+def _record(post, text, comment=None):
+    # When the post enters the streams
+    entered = comment.datetime if comment else post.datetime
+
+    names = tag_names(text)
+    if names:
+        tags = get_tags(names)
+        tagged = set(PostTag.objects.filter(post=post, tag__in=tags)
+                                    .values_list('tag_id', flat=True))
+        _insert(PostTag, [PostTag(tag=tag, post=post, datetime=entered)
+                          for tag in tags if tag.id not in tagged])
+
+    usernames = mentioned_usernames(text)
+    if usernames:
+        user_ids = set(User.objects.filter(username__in=usernames)
+                                   .exclude(id=post.user_id)
+                                   .values_list('id', flat=True))
+        user_ids -= set(Mention.objects.filter(post=post, user_id__in=user_ids)
+                                       .values_list('user_id', flat=True))
+        _insert(Mention, [Mention(user_id=user_id, post=post, comment=comment, datetime=entered)
+                          for user_id in user_ids])
+
+def record_post(post):
+    """ Store the tags and mentions of the new `post`. Call this in the
+    transaction that saves it.
+    """
+    _record(post, post.text)
+
+def record_comment(comment):
+    """ Store the tags and mentions of the new `comment` against its post.
+    Call this in the transaction that saves it.
+    """
+    _record(comment.post, comment.text, comment)
+
+def new_post_channels(post):
+    """ Get the pubsub channels of the tag and mentions streams the new
+    `post` is in. Only looks at the database if the post mentions anyone.
+    """
+    channels = [pubsub.tag_channel(name) for name in tag_names(post.text)]
+    if mentioned_usernames(post.text):
+        channels.extend(pubsub.mentions_channel(user_id)
+                        for user_id in Mention.objects.filter(post=post)
+                                                      .values_list('user_id', flat=True))
+    return channels
+
+def post_channels(post):
+    """ Get the pubsub channels of the tag and mentions streams `post` is in. """
+    channels = [pubsub.tag_channel(name)
+                for name in Tag.objects.filter(post_tags__post=post)
+                                       .values_list('name', flat=True)]
+    channels.extend(pubsub.mentions_channel(user_id)
+                    for user_id in Mention.objects.filter(post=post)
+                                                  .values_list('user_id', flat=True))
+    return channels
+
+def _tag_link(match):
+    name = match.group(1)
+    return '<a href="%s">#%s</a>' % (reverse('tag', kwargs={'name': normalize(name)}), name)
+
+def _mention_link(match):
+    username = match.group(1).rstrip('.')
+    rest = match.group(1)[len(username):]
+    return '<a href="%s">@%s</a>%s' % (reverse('user', kwargs={'username': username}),
+                                       username, rest)
+
+def link_text(text):
+    """ Get `text` as HTML, escaped, with its tags and mentions linked to
+    their streams.
+    """
+    html = escape(text)
+    html = TAG_RE.sub(_tag_link, html)
+    return MENTION_RE.sub(_mention_link, html)
@@ -0,0 +1,11 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from nanoblog import tags
+
+register = template.Library()
+
+@register.filter
+def link_tags(text):
+    """ Escape `text` and link its #tags and @mentions to their streams. """
+    return mark_safe(tags.link_text(text))
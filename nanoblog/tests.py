@@ -1,3 +1,1374 @@
-from django.test import TestCase
+import asyncore
+import json
+import os
+import re
+import smtpd
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from io import BytesIO
 
-# Create your tests here.
+from PIL import Image
+
+from django.test       import TestCase, SimpleTestCase, RequestFactory, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection
+from django.db.models.signals import pre_save
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core import mail
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.core.mail.backends.base import BaseEmailBackend
+
+from django.contrib.auth.models import User
+from nanoblog.models import (BlogPost, Blogger, Comment, UploadJob, Tag, PostTag, Mention,
+                             TrendingCount, OutboundEmail, SearchTerm)
+from nanoblog.pubsub import LocalPubSub
+from nanoblog.pagination import encode_cursor, decode_cursor, older_page, newer_page
+from nanoblog import (activity, uploads, imaging, batching, follow_graph, search, tags,
+                      trending, outbox, metrics, replicas, timeline, fragments,
+                      conditional)
+from nanoblog.storage import Storage, FileSystemStorage, MemoryStorage
+from nanoblog.auth import BloggerBackend
+
+
+def create_blogger(username):
+    """ Create an active User with a linked Blogger and password 'password'. """
+    user = User.objects.create_user(username=username, password='password',
+                                    email=username + '@example.com')
+    Blogger.objects.create(user=user)
+    return user
+
+
+def image_data(width, height, format='PNG', mode='RGB'):
+    """ Encode a blank image of the given size. """
+    output = BytesIO()
+    Image.new(mode, (width, height)).save(output, format)
+    return output.getvalue()
+
+
+def create_comment(user, post, text):
+    """ Create a Comment the way add_comment does, keeping the post's counts. """
+    comment = Comment.objects.create(user=user, post=post, text=text)
+    activity.record_comment(comment)
+    return comment
+
+
+# The manifest storage used in production needs collectstatic to have run.
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class NanoblogTestCase(TestCase):
+
+    def setUp(self):
+        # Cached post cards would outlive the rows of the previous test
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        # So are the trending counters
+        trending.reset()
+
+
+class PaginationTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        self.user = create_blogger('pager')
+        self.posts = [BlogPost.objects.create(user=self.user, text='post %d' % i)
+                      for i in range(5)]
+
+    def same_datetime(self):
+        """ Give every post the same datetime, so pages only differ by id. """
+        BlogPost.objects.update(datetime=self.posts[0].datetime)
+
+    def test_cursor_round_trip(self):
+        post = self.posts[0]
+        self.assertEqual(decode_cursor(encode_cursor(post)), (post.datetime, post.id))
+
+    def test_malformed_cursors(self):
+        # Not base64, not a cursor, a cursor with a bad date, and with a bad id
+        for token in ['', 'garbage', u'\xe9t\xe9', 'bm90IGEgY3Vyc29y',
+                      'eWVzdGVyZGF5fDE', 'MjAxNS0wMS0wMVQwMDowMDowMHxvbmU']:
+            self.assertRaises(ValueError, decode_cursor, token)
+
+    def test_malformed_cursor_is_not_found(self):
+        self.client.login(username='pager', password='password')
+        self.assertEqual(self.client.get('/', {'before': 'garbage'}).status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/streams/global',
+                                         {'before': 'garbage'}).status_code, 404)
+
+    def test_older_pages_break_ties_on_id(self):
+        self.same_datetime()
+        seen = []
+        cursor = None
+        for i in range(3):
+            posts, cursor = older_page(BlogPost.objects.all(), 2, cursor)
+            seen.extend(post.id for post in posts)
+        self.assertEqual(seen, sorted((post.id for post in self.posts), reverse=True))
+        self.assertIsNone(cursor)
+
+    def test_last_page_has_no_cursor(self):
+        posts, cursor = older_page(BlogPost.objects.all(), 5)
+        self.assertEqual(len(posts), 5)
+        self.assertIsNone(cursor)
+        posts, cursor = older_page(BlogPost.objects.all(), 4)
+        self.assertEqual(len(posts), 4)
+        self.assertEqual(cursor, encode_cursor(posts[-1]))
+
+    def test_newer_page_returns_the_oldest_new_posts_first(self):
+        posts = newer_page(BlogPost.objects.all(), 2, self.posts[0].datetime)
+        self.assertEqual([post.id for post in posts], [self.posts[2].id, self.posts[1].id])
+
+
+# Sessions are cached, as they are with a shared cache in production
+@override_settings(STREAM_PAGE_SIZE=50,
+                   SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+class StreamQueryCountTest(NanoblogTestCase):
+    """ Rendering a page of a stream must not issue queries per post or per comment. """
+
+    # The user with their profile (the session is cached), posts and
+    # comments, plus a couple of lookups specific to each stream.
+    MAX_QUERIES = 7
+
+    def setUp(self):
+        super(StreamQueryCountTest, self).setUp()
+        self.users = [create_blogger('user%d' % i) for i in range(5)]
+        self.users[0].blogger.following.add(*self.users[1:])
+        for i in range(50):
+            post = BlogPost.objects.create(user=self.users[i % 5], text='post %d' % i)
+            for j in range(3):
+                create_comment(self.users[j], post, 'comment %d' % j)
+        self.client.login(username='user0', password='password')
+
+    def assertPageQueries(self, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, data or {})
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), self.MAX_QUERIES,
+                             '%s took %d queries' % (path, len(queries)))
+
+    def test_global_stream(self):
+        self.assertPageQueries('/')
+
+    def test_following_stream(self):
+        self.assertPageQueries('/following')
+
+    def test_own_user_stream(self):
+        self.assertPageQueries('/user/user0')
+
+    def test_other_user_stream(self):
+        self.assertPageQueries('/user/user1')
+
+    def test_incremental_refresh(self):
+        self.assertPageQueries('/', {'last_updated': '2000-01-01 00:00:00+00:00'})
+
+
+class SessionAuthTest(NanoblogTestCase):
+    """ Authenticated requests load the session from the cache when it is
+    shared, and the user with their profile in one query.
+    """
+
+    def setUp(self):
+        super(SessionAuthTest, self).setUp()
+        self.user = create_blogger('session')
+        self.client.login(username='session', password='password')
+
+    def test_database_sessions_without_a_shared_cache(self):
+        self.assertFalse(settings.SHARED_CACHE)
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.db')
+
+    def test_logout_ends_the_session(self):
+        session_key = self.client.session.session_key
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        self.assertTrue(store().exists(session_key))
+        self.client.get('/logout')
+        self.assertFalse(store().exists(session_key))
+        self.assertEqual(store(session_key).load(), {})
+        self.assertEqual(self.client.get('/following')['Location'],
+                         'http://testserver/login?next=/following')
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_one_query_before_the_stream(self):
+        # Log in again so the session is in the cache
+        self.client.login(username='session', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/following')
+        self.assertEqual(response.context['user'].blogger, self.user.blogger)
+        sql = [query['sql'] for query in queries]
+        self.assertFalse([query for query in sql if 'django_session' in query])
+        self.assertIn('"auth_user"', sql[0])
+        self.assertIn('"nanoblog_blogger"', sql[0])
+        self.assertIn('"nanoblog_blogpost"', sql[1])
+
+    def test_blogger_is_loaded_with_user(self):
+        with self.assertNumQueries(1):
+            user = BloggerBackend().get_user(self.user.id)
+            self.assertEqual(user.blogger.id, self.user.blogger.id)
+
+
+class TimelineTest(NanoblogTestCase):
+    """ The materialized following stream tracks posts, follows and unfollows. """
+
+    def setUp(self):
+        super(TimelineTest, self).setUp()
+        self.reader = create_blogger('reader')
+        self.author = create_blogger('author')
+        self.old_post = BlogPost.objects.create(user=self.author, text='before following')
+        self.client.login(username='reader', password='password')
+
+    def following_texts(self):
+        response = self.client.get('/following')
+        return [pac['post'].text for pac in response.context['posts_and_comments']]
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        self.client.post('/follow/author')
+        self.assertEqual(self.following_texts(), ['before following'])
+        self.client.post('/unfollow/author')
+        self.assertEqual(self.following_texts(), [])
+
+    def test_new_posts_fan_out_to_followers(self):
+        self.client.post('/follow/author')
+        author_client = self.client_class()
+        author_client.login(username='author', password='password')
+        author_client.post('/add', {'text': 'after following'})
+        self.assertEqual(self.following_texts(), ['after following', 'before following'])
+
+    def test_pages_on_timeline_entries(self):
+        self.client.post('/follow/author')
+        newer = [BlogPost.objects.create(user=self.author, text='post %d' % i) for i in range(3)]
+        timeline.rebuild(self.reader.blogger)
+        entries = timeline.timeline_entries(self.reader)
+        posts, cursor = older_page(entries, 3)
+        self.assertEqual(posts, newer[::-1])
+        posts, cursor = older_page(entries, 3, cursor)
+        self.assertEqual(posts, [self.old_post])
+        self.assertIsNone(cursor)
+        self.assertEqual(newer_page(entries, 2, self.old_post.datetime), newer[1::-1])
+
+
+class LocalPubSubTest(SimpleTestCase):
+
+    def test_publish_wakes_waiter(self):
+        backend = LocalPubSub()
+        version = backend.version('global')
+        publisher = threading.Timer(0.05, backend.publish, [['global']])
+        publisher.start()
+        started = time.time()
+        self.assertEqual(backend.wait('global', version, 5), version + 1)
+        self.assertLess(time.time() - started, 5)
+
+    def test_wait_times_out(self):
+        backend = LocalPubSub()
+        backend.publish(['user:1'])
+        self.assertEqual(backend.wait('global', 0, 0.05), 0)
+
+
+@override_settings(LONGPOLL=True, LONGPOLL_TIMEOUT=0.2, LONGPOLL_RECHECK=0.1)
+class LongPollTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(LongPollTest, self).setUp()
+        self.user = create_blogger('poller')
+        self.client.login(username='poller', password='password')
+
+    def test_returns_new_posts_immediately(self):
+        BlogPost.objects.create(user=self.user, text='already here')
+        response = self.client.get('/', {'last_updated': '2000-01-01 00:00:00+00:00', 'wait': 1})
+        self.assertContains(response, 'already here')
+
+    def test_times_out_without_new_posts(self):
+        response = self.client.get('/', {'last_updated': '2000-01-01 00:00:00+00:00', 'wait': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['posts_and_comments'], [])
+
+    def test_comments_already_sent_do_not_end_the_wait(self):
+        post = BlogPost.objects.create(user=self.user, text='post')
+        create_comment(self.user, post, 'seen')
+        synced = self.client.get('/').context['synced']
+        started = time.time()
+        response = self.client.get('/', {'last_updated': str(post.datetime),
+                                         'oldest': str(post.datetime),
+                                         'comments_since': synced, 'wait': 1})
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        # Sent again, as it is within COMMENT_SYNC_MARGIN
+        self.assertEqual(len(json.loads(response.content)['comments']), 1)
+
+    def test_off_by_default(self):
+        with self.settings(LONGPOLL=False, LONGPOLL_TIMEOUT=5):
+            self.assertContains(self.client.get('/'), 'var longPollEnabled = false;')
+            started = time.time()
+            response = self.client.get('/', {'last_updated': '2000-01-01 00:00:00+00:00',
+                                             'wait': 1})
+            self.assertLess(time.time() - started, 1)
+        self.assertEqual(response.context['posts_and_comments'], [])
+        self.assertContains(self.client.get('/'), 'var longPollEnabled = true;')
+
+
+class CommentDeltaTest(NanoblogTestCase):
+    """ Refreshes carry the comments made since the last one on posts already shown. """
+
+    def setUp(self):
+        super(CommentDeltaTest, self).setUp()
+        self.user = create_blogger('reader')
+        self.client.login(username='reader', password='password')
+
+    def test_refresh_returns_new_comments_on_shown_posts(self):
+        response = self.client.get('/')
+        synced = response.context['synced']
+        shown = BlogPost.objects.create(user=self.user, text='shown')
+        first_refresh = json.loads(self.client.get('/', {
+            'last_updated': '2000-01-01 00:00:00+00:00',
+            'oldest': '2000-01-01 00:00:00+00:00',
+            'comments_since': synced,
+        }).content)
+        self.assertIn('shown', first_refresh['html'])
+
+        comment = create_comment(self.user, shown, 'new comment')
+        delta = json.loads(self.client.get('/', {
+            'last_updated': str(shown.datetime),
+            'oldest': str(shown.datetime),
+            'comments_since': first_refresh['synced'],
+        }).content)
+        self.assertNotIn('postcard', delta['html'])
+        self.assertEqual([(c[0], c[1]) for c in delta['comments']], [(shown.id, comment.id)])
+        self.assertIn('new comment', delta['comments'][0][2])
+
+    def test_refresh_returns_comments_committed_after_the_last_one(self):
+        shown = BlogPost.objects.create(user=self.user, text='shown')
+        synced = self.client.get('/').context['synced']
+        # Saved before that refresh, but committed after it
+        comment = create_comment(self.user, shown, 'slow comment')
+        Comment.objects.filter(id=comment.id).update(
+            datetime=parse_datetime(synced) - timedelta(seconds=1))
+        delta = json.loads(self.client.get('/', {
+            'last_updated': str(shown.datetime),
+            'oldest': str(shown.datetime),
+            'comments_since': synced,
+        }).content)
+        self.assertEqual([c[1] for c in delta['comments']], [comment.id])
+
+    def test_malformed_sync_time(self):
+        response = self.client.get('/', {'last_updated': '2000-01-01 00:00:00+00:00',
+                                         'oldest': '2000-01-01 00:00:00+00:00',
+                                         'comments_since': 'yesterday'})
+        self.assertEqual(response.status_code, 404)
+
+
+class StreamApiTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(StreamApiTest, self).setUp()
+        self.author = create_blogger('author')
+        self.reader = create_blogger('reader')
+        self.post = BlogPost.objects.create(user=self.author, text='first')
+        BlogPost.objects.create(user=self.author, text='second')
+        create_comment(self.reader, self.post, 'reply')
+        self.client.login(username='reader', password='password')
+
+    def test_page_lists_each_author_once(self):
+        data = json.loads(self.client.get('/api/v1/streams/global').content)
+        self.assertEqual(data['version'], 1)
+        self.assertEqual([post['text'] for post in data['posts']], ['second', 'first'])
+        self.assertEqual(data['posts'][1]['comments'][0]['text'], 'reply')
+        self.assertEqual(sorted(user['username'] for user in data['users'].values()),
+                         ['author', 'reader'])
+        self.assertIsNone(data['older_cursor'])
+
+    def test_refresh_returns_new_comments(self):
+        since = json.loads(self.client.get('/api/v1/streams/user/author').content)['synced']
+        create_comment(self.author, self.post, 'late reply')
+        newest = BlogPost.objects.latest('datetime')
+        data = json.loads(self.client.get('/api/v1/streams/user/author', {
+            'last_updated': newest.datetime.isoformat(),
+            'oldest': self.post.datetime.isoformat(),
+            'comments_since': since,
+        }).content)
+        self.assertEqual(data['posts'], [])
+        # "reply" was made within COMMENT_SYNC_MARGIN of the last refresh
+        self.assertEqual([(c['post'], c['text']) for c in data['comments']],
+                         [(self.post.id, 'reply'), (self.post.id, 'late reply')])
+        with self.settings(COMMENT_SYNC_MARGIN=0):
+            data = json.loads(self.client.get('/api/v1/streams/user/author', {
+                'last_updated': newest.datetime.isoformat(),
+                'oldest': self.post.datetime.isoformat(),
+                'comments_since': since,
+            }).content)
+        self.assertEqual([c['text'] for c in data['comments']], ['late reply'])
+
+
+class FragmentCacheTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(FragmentCacheTest, self).setUp()
+        self.user = create_blogger('reader')
+        self.post = BlogPost.objects.create(user=self.user, text='cached')
+        self.client.login(username='reader', password='password')
+
+    def test_cards_are_reused_until_a_comment_is_added(self):
+        self.client.get('/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/')
+        self.assertFalse([q for q in queries if 'nanoblog_comment' in q['sql']])
+
+        self.client.post('/add_comment', {'post': self.post.id, 'text': 'fresh comment'})
+        self.assertContains(self.client.get('/'), 'fresh comment')
+
+    def test_cards_of_posts_from_a_lagging_replica(self):
+        fragments.postcards([self.post])
+        create_comment(self.user, self.post, 'fresh comment')
+        fragments.invalidate_posts([self.post.id])
+        # As read from a replica that has the new card version but not the comment
+        self.post.comment_count = 0
+        with replicas.reading_from('default'):
+            [pac] = fragments.postcards([self.post])
+        self.assertIn('fresh comment', pac['html'])
+        self.assertContains(self.client.get('/'), 'fresh comment')
+
+
+class ConditionalRefreshTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(ConditionalRefreshTest, self).setUp()
+        self.user = create_blogger('poller')
+        self.client.login(username='poller', password='password')
+        self.client.post('/add', {'text': 'first'})
+        self.refresh = {'last_updated': '2000-01-01 00:00:00+00:00'}
+
+    def test_unchanged_stream_is_not_modified(self):
+        response = self.client.get('/api/v1/streams/global', self.refresh)
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/streams/global', self.refresh,
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in queries if 'nanoblog_blogpost' in q['sql']])
+
+    def test_new_post_changes_etag(self):
+        etag = self.client.get('/user/poller', self.refresh)['ETag']
+        self.client.post('/add', {'text': 'second'})
+        response = self.client.get('/user/poller', self.refresh, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'second')
+
+    def test_consecutive_refreshes_like_stream_js(self):
+        post = BlogPost.objects.get()
+        synced = json.loads(self.client.get('/api/v1/streams/global').content)['synced']
+        refresh = {'last_updated': str(post.datetime), 'oldest': str(post.datetime)}
+
+        def poll(etag=None):
+            headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+            return self.client.get('/api/v1/streams/global',
+                                   dict(refresh, comments_since=synced), **headers)
+
+        response = poll()
+        self.assertEqual(response.status_code, 200)
+        # Nothing new: the next refresh asks for the same URL
+        self.assertEqual(json.loads(response.content)['synced'], synced)
+        response = poll(response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        create_comment(self.user, post, 'news')
+        conditional.mark_changed([self.user.id])
+        response = poll(response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([comment['text'] for comment in data['comments']], ['news'])
+        self.assertNotEqual(data['synced'], synced)
+        synced = data['synced']
+        self.assertEqual(poll(response['ETag']).status_code, 304)
+
+
+class EditProfileTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(EditProfileTest, self).setUp()
+        self.user = create_blogger('editor')
+        self.client.login(username='editor', password='password')
+
+    def test_only_writes_the_form_fields(self):
+        changed = timezone.now()
+
+        def concurrent_write(sender, instance, **kwargs):
+            # Set while the request holds its copy of the Blogger
+            Blogger.objects.filter(id=instance.id).update(
+                stream_changed=changed, profile_picture_url='http://example.com/new.jpg')
+        pre_save.connect(concurrent_write, sender=Blogger)
+        try:
+            response = self.client.post('/edit_profile', {'bio': 'new bio', 'age': 30})
+        finally:
+            pre_save.disconnect(concurrent_write, sender=Blogger)
+        self.assertEqual(response.status_code, 302)
+        blogger = Blogger.objects.get(user=self.user)
+        self.assertEqual((blogger.bio, blogger.age), ('new bio', 30))
+        self.assertEqual(blogger.stream_changed, changed)
+        self.assertEqual(blogger.profile_picture_url, 'http://example.com/new.jpg')
+
+
+class ActivityTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(ActivityTest, self).setUp()
+        self.user = create_blogger('commenter')
+        self.post = BlogPost.objects.create(user=self.user, text='post')
+        self.client.login(username='commenter', password='password')
+
+    def test_add_comment_updates_counts(self):
+        self.client.post('/add_comment', {'post': self.post.id, 'text': 'one'})
+        self.client.post('/add_comment', {'post': self.post.id, 'text': 'two'})
+        post = BlogPost.objects.get(id=self.post.id)
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(post.last_activity, Comment.objects.latest('datetime').datetime)
+
+    def test_reconcile_fixes_drift(self):
+        Comment.objects.create(user=self.user, post=self.post, text='unrecorded')
+        self.assertEqual(activity.reconcile(), 1)
+        self.assertEqual(BlogPost.objects.get(id=self.post.id).comment_count, 1)
+        self.assertEqual(activity.reconcile(), 0)
+
+    def test_new_posts_need_no_reconciling(self):
+        self.assertIsNone(self.post.last_activity)
+        self.assertEqual(activity.reconcile(), 0)
+        create_comment(self.user, self.post, 'recorded')
+        self.assertEqual(activity.reconcile(), 0)
+
+
+class FailingStorage(Storage):
+    def upload(self, name, data, content_type):
+        raise IOError('storage is down')
+
+
+@override_settings(UPLOAD_STORAGE='nanoblog.storage.FileSystemStorage', UPLOAD_THREADS=0)
+class UploadTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = self.settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = create_blogger('pictured')
+        self.client.login(username='pictured', password='password')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super(UploadTest, self).tearDown()
+
+    def upload(self, data):
+        picture = SimpleUploadedFile('picture.png', data, content_type='image/png')
+        return self.client.post('/edit_profile', {'bio': 'hi', 'age': 30, 'profile_picture': picture})
+
+    def blogger(self):
+        return Blogger.objects.get(user=self.user)
+
+    def test_edit_profile_queues_upload(self):
+        response = self.upload(image_data(800, 400))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.blogger().bio, 'hi')
+        self.assertIsNone(self.blogger().profile_picture_url)
+        self.assertEqual(UploadJob.objects.get().status, UploadJob.PENDING)
+
+        self.assertEqual(uploads.process_pending(), 1)
+        job = UploadJob.objects.get()
+        self.assertEqual(job.status, UploadJob.DONE)
+        self.assertIsNone(job.data)
+        blogger = self.blogger()
+        self.assertEqual(blogger.profile_picture_url, settings.MEDIA_URL + job.name + '-full.jpg')
+        self.assertEqual(blogger.thumb_picture_url, settings.MEDIA_URL + job.name + '-thumb.jpg')
+        self.assertEqual(blogger.card_picture_url, settings.MEDIA_URL + job.name + '-card.jpg')
+        self.assertEqual(blogger.profile_picture_srcset, ', '.join([
+            blogger.thumb_picture_url + ' 96w', blogger.card_picture_url + ' 160w',
+            blogger.profile_picture_url + ' 640w']))
+        thumbnail = Image.open(os.path.join(self.media_root, job.name + '-thumb.jpg'))
+        self.assertEqual((thumbnail.format, thumbnail.size), ('JPEG', (96, 48)))
+
+    def test_not_an_image_is_rejected(self):
+        response = self.upload('not an image')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(UploadJob.objects.exists())
+
+    def test_newest_picture_wins(self):
+        self.upload(image_data(10, 10))
+        self.upload(image_data(20, 20))
+        first, second = UploadJob.objects.order_by('id')
+        self.assertTrue(uploads.process(second.id))
+        self.assertTrue(uploads.process(first.id))
+        second = UploadJob.objects.get()
+        self.assertEqual(self.blogger().profile_picture_url, second.url)
+        self.assertEqual(sorted(os.listdir(self.media_root)),
+                         sorted(uploads.variant_name(second.name, variant)
+                                for variant in imaging.VARIANT_NAMES))
+
+    def test_failed_upload_is_retried(self):
+        self.upload(image_data(10, 10))
+        job = UploadJob.objects.get()
+        with self.settings(UPLOAD_STORAGE='nanoblog.tests.FailingStorage', UPLOAD_MAX_ATTEMPTS=2):
+            self.assertFalse(uploads.process(job.id))
+            self.assertEqual(UploadJob.objects.get().status, UploadJob.PENDING)
+            self.assertFalse(uploads.process(job.id))
+            self.assertEqual(UploadJob.objects.get().status, UploadJob.FAILED)
+        self.assertIsNone(self.blogger().profile_picture_url)
+
+    def test_unexpected_errors_are_retried(self):
+        self.upload(image_data(10, 10))
+        job = UploadJob.objects.get()
+        variants = imaging.variants
+
+        def crash(data):
+            raise MemoryError()
+        imaging.variants = crash
+        try:
+            with self.settings(UPLOAD_MAX_ATTEMPTS=2):
+                self.assertFalse(uploads.process(job.id))
+                self.assertEqual(UploadJob.objects.get().status, UploadJob.PENDING)
+                self.assertFalse(uploads.process(job.id))
+        finally:
+            imaging.variants = variants
+        job = UploadJob.objects.get()
+        self.assertEqual((job.status, job.error), (UploadJob.FAILED, 'MemoryError()'))
+
+    def test_abandoned_jobs_are_retried_until_out_of_attempts(self):
+        self.upload(image_data(10, 10))
+        self.upload(image_data(20, 20))
+        first, second = UploadJob.objects.order_by('id')
+        # As if their workers died while processing them
+        abandoned = timezone.now() - timedelta(seconds=settings.UPLOAD_STALE_AFTER + 1)
+        UploadJob.objects.filter(id=first.id).update(
+            status=UploadJob.RUNNING, attempts=settings.UPLOAD_MAX_ATTEMPTS, updated=abandoned)
+        UploadJob.objects.filter(id=second.id).update(
+            status=UploadJob.RUNNING, attempts=1, updated=abandoned)
+        self.assertEqual(uploads.process_pending(), 1)
+        self.assertEqual(UploadJob.objects.get(id=first.id).status, UploadJob.FAILED)
+        self.assertEqual(UploadJob.objects.get(id=second.id).status, UploadJob.DONE)
+
+    def test_pool_looks_for_pending_jobs(self):
+        processed = []
+        uploads.UploadPool(1, function=processed.append, pending=lambda: [1, 2], interval=60)
+        deadline = time.time() + 5
+        while len(processed) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(processed, [1, 2])
+
+    def test_pool_runs_submitted_jobs(self):
+        processed = []
+        pool = uploads.UploadPool(2, function=processed.append)
+        for job_id in range(10):
+            pool.submit(job_id)
+        pool.join()
+        self.assertEqual(sorted(processed), range(10))
+
+
+class ImagingTest(SimpleTestCase):
+
+    def test_variants_are_small_jpegs(self):
+        variants = imaging.variants(image_data(2000, 1000, mode='RGBA'))
+        self.assertEqual([(name, width) for name, width, data in variants],
+                         [('thumb', 96), ('card', 160), ('full', 640)])
+        for name, width, data in variants:
+            image = Image.open(BytesIO(data))
+            self.assertEqual((image.format, image.mode), ('JPEG', 'RGB'))
+            self.assertNotIn('exif', image.info)
+
+    def test_small_pictures_are_not_enlarged(self):
+        widths = [width for name, width, data in imaging.variants(image_data(50, 50, 'GIF', 'P'))]
+        self.assertEqual(widths, [50, 50, 50])
+
+    def test_exif_orientation_is_applied(self):
+        image = Image.new('RGB', (40, 20))
+        exif = image.getexif()
+        exif[imaging.EXIF_ORIENTATION] = 6
+        output = BytesIO()
+        image.save(output, 'JPEG', exif=exif.tobytes())
+        variants = imaging.variants(output.getvalue())
+        self.assertEqual(Image.open(BytesIO(variants[0][2])).size, (20, 40))
+
+    def test_garbage_is_rejected(self):
+        self.assertRaises(imaging.ImageError, imaging.variants, 'not an image')
+        self.assertRaises(imaging.ImageError, imaging.check, 'not an image')
+
+
+class StorageTest(SimpleTestCase):
+
+    def check_storage(self, storage, exists):
+        url = storage.upload('a/picture.jpg', 'data', 'image/jpeg')
+        self.assertTrue(url.endswith('a/picture.jpg'))
+        self.assertTrue(exists('a/picture.jpg'))
+        storage.upload('b.jpg', 'data', 'image/jpeg')
+        storage.upload('c.jpg', 'data', 'image/jpeg')
+        storage.delete('a/picture.jpg')
+        storage.delete('a/picture.jpg')
+        storage.delete_many(['b.jpg', 'c.jpg', 'missing.jpg'])
+        for name in ('a/picture.jpg', 'b.jpg', 'c.jpg'):
+            self.assertFalse(exists(name))
+
+    def test_memory_storage(self):
+        storage = MemoryStorage()
+        self.check_storage(storage, lambda name: name in storage.files)
+
+    def test_file_system_storage(self):
+        root = tempfile.mkdtemp()
+        try:
+            storage = FileSystemStorage(root=root, base_url='/media/')
+            self.check_storage(storage, lambda name: os.path.exists(os.path.join(root, name)))
+        finally:
+            shutil.rmtree(root)
+
+
+class WriteBatcherTest(SimpleTestCase):
+
+    def write_concurrently(self, batcher, functions):
+        """ Call batcher.write on each of `functions` from its own thread. """
+        results = [None] * len(functions)
+
+        def writer(i):
+            try:
+                results[i] = batcher.write(functions[i])
+            except Exception as e:
+                results[i] = e
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(len(functions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_writes_share_a_transaction(self):
+        writing_threads = set()
+
+        def function(i):
+            def write():
+                writing_threads.add(threading.current_thread())
+                return i
+            return write
+        batcher = batching.WriteBatcher(delay=0.1, max_size=100)
+        results = self.write_concurrently(batcher, [function(i) for i in range(10)])
+        self.assertEqual(results, range(10))
+        # All writes arrive within the delay, so one leader runs them all
+        self.assertEqual(len(writing_threads), 1)
+
+    def test_full_batches_hand_over_to_a_new_leader(self):
+        batcher = batching.WriteBatcher(delay=0.05, max_size=3)
+        results = self.write_concurrently(batcher, [lambda i=i: i for i in range(10)])
+        self.assertEqual(results, range(10))
+        self.assertEqual(batcher.pending, [])
+        self.assertFalse(batcher.leader_active)
+
+    def test_failing_write_only_fails_its_caller(self):
+        def fail():
+            raise ValueError('bad write')
+        batcher = batching.WriteBatcher(delay=0.05, max_size=100)
+        results = self.write_concurrently(batcher, [lambda: 1, fail, lambda: 3])
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 3)
+
+
+@override_settings(WRITE_COALESCING_DELAY=0.001)
+class CoalescedWriteTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(CoalescedWriteTest, self).setUp()
+        self.author = create_blogger('author')
+        self.follower = create_blogger('follower')
+        self.follower.blogger.following.add(self.author)
+        self.client.login(username='author', password='password')
+
+    def test_add_and_add_comment(self):
+        self.client.post('/add', {'text': 'coalesced post'})
+        post = BlogPost.objects.get()
+        self.assertTrue(post.timeline_entries.filter(owner=self.follower).exists())
+        response = self.client.post('/add_comment', {'post': post.id, 'text': 'coalesced comment'})
+        self.assertTrue(json.loads(response.content)['success'])
+        self.assertEqual(BlogPost.objects.get().comment_count, 1)
+
+
+class AddPostTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(AddPostTest, self).setUp()
+        self.user = create_blogger('poster')
+        self.client.login(username='poster', password='password')
+
+    def test_form_post_redirects_to_stream(self):
+        response = self.client.post('/add', {'text': 'hello', 'redirect': 'following'})
+        self.assertRedirects(response, '/following')
+        response = self.client.post('/add', {'text': 'hello', 'redirect': 'user',
+                                             'redirect_user': 'poster'})
+        self.assertRedirects(response, '/user/poster')
+        self.assertEqual(BlogPost.objects.count(), 2)
+
+    def test_invalid_form_post_shows_errors(self):
+        response = self.client.post('/add', {'text': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['blog_post_form'].errors)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_ajax_post_returns_card(self):
+        self.client.login(username='poster', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/add', {'text': 'hello'},
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        result = json.loads(response.content)
+        post = BlogPost.objects.get()
+        self.assertTrue(result['success'])
+        self.assertEqual(result['id'], post.id)
+        self.assertIn('post_id="%d"' % post.id, result['html'])
+        # No stream query: session, user, the INSERT, its search index rows,
+        # the follower lookup, marking the stream as changed, the author's
+        # profile for the card, and the savepoint around the write
+        self.assertLessEqual(len(queries), 9)
+
+    def test_ajax_post_returns_errors(self):
+        response = self.client.post('/add', {'text': ''}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertFalse(json.loads(response.content)['success'])
+        self.assertFalse(BlogPost.objects.exists())
+
+
+class FollowGraphTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(FollowGraphTest, self).setUp()
+        self.users = [create_blogger('graph%d' % i) for i in range(4)]
+        self.users[0].blogger.following.add(self.users[1], self.users[2])
+        self.users[3].blogger.following.add(self.users[1])
+        self.client.login(username='graph0', password='password')
+
+    def test_cached_lookups(self):
+        ids = [user.id for user in self.users]
+        self.assertEqual(follow_graph.following_many(ids[0], ids),
+                         {ids[0]: False, ids[1]: True, ids[2]: True, ids[3]: False})
+        self.assertEqual(follow_graph.follower_counts(ids),
+                         {ids[0]: 0, ids[1]: 2, ids[2]: 1, ids[3]: 0})
+        with self.assertNumQueries(0):
+            self.assertTrue(follow_graph.is_following(ids[0], ids[1]))
+            self.assertEqual(follow_graph.following_count(ids[0]), 2)
+            self.assertEqual(follow_graph.follower_count(ids[1]), 2)
+
+    def test_follow_and_unfollow_invalidate(self):
+        follower, followed = self.users[0], self.users[3]
+        self.assertFalse(follow_graph.is_following(follower.id, followed.id))
+        self.assertEqual(follow_graph.follower_count(followed.id), 0)
+        self.client.post('/follow/graph3')
+        self.assertTrue(follow_graph.is_following(follower.id, followed.id))
+        self.assertEqual(follow_graph.follower_count(followed.id), 1)
+        self.client.post('/unfollow/graph3')
+        self.assertFalse(follow_graph.is_following(follower.id, followed.id))
+        self.assertEqual(follow_graph.follower_count(followed.id), 0)
+
+    def test_follow_committed_while_a_reader_queries(self):
+        follower, followed = self.users[0], self.users[3]
+        cache = follow_graph.get_cache()
+        interleaved = []
+
+        class InterleavingCache(object):
+            """ Follows, as another request would, between the reader's
+            query and its cache write.
+            """
+            def __getattr__(self, name):
+                return getattr(cache, name)
+
+            def set(self, *args, **kwargs):
+                self.follow()
+                return cache.set(*args, **kwargs)
+
+            def set_many(self, *args, **kwargs):
+                self.follow()
+                return cache.set_many(*args, **kwargs)
+
+            def follow(self):
+                if not interleaved:
+                    interleaved.append(True)
+                    follower.blogger.following.add(followed)
+                    follow_graph.invalidate(follower.id, followed.id)
+
+        get_cache = follow_graph.get_cache
+        follow_graph.get_cache = InterleavingCache
+        try:
+            self.assertFalse(follow_graph.is_following(follower.id, followed.id))
+            self.client.post('/unfollow/graph3')
+            del interleaved[:]
+            self.assertEqual(follow_graph.follower_count(followed.id), 0)
+        finally:
+            follow_graph.get_cache = get_cache
+        self.assertTrue(follow_graph.is_following(follower.id, followed.id))
+        self.assertEqual(follow_graph.follower_count(followed.id), 1)
+
+    def test_profile_page(self):
+        response = self.client.get('/user/graph1')
+        self.assertTrue(response.context['following'])
+        self.assertEqual(response.context['follower_count'], 2)
+        response = self.client.get('/user/graph3')
+        self.assertFalse(response.context['following'])
+        self.assertEqual(response.context['following_count'], 1)
+
+    def test_api_marks_followed_authors(self):
+        for user in self.users:
+            BlogPost.objects.create(user=user, text='post')
+        users = json.loads(self.client.get('/api/v1/streams/global').content)['users']
+        self.assertEqual(dict((user['username'], user['following']) for user in users.values()),
+                         {'graph0': False, 'graph1': True, 'graph2': True, 'graph3': False})
+
+
+class SearchTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.user = create_blogger('searcher')
+        self.client.login(username='searcher', password='password')
+
+    def add(self, text):
+        self.client.post('/add', {'text': text})
+        return BlogPost.objects.latest('id')
+
+    def test_terms(self):
+        self.assertEqual(search.terms(u'The quick, quick Fox!'), ['quick', 'quick', 'fox'])
+
+    def test_term_added_concurrently(self):
+        post = BlogPost.objects.create(user=self.user, text='post')
+        index = search.TermIndex()
+        index.index_comment(Comment(post=post, text='fox'))
+        # As if another comment added "fox" between our lookup and our insert
+        index._add(post.id, ['fox', 'dog'], search.COMMENT_WEIGHT, new=True)
+        self.assertEqual(dict(SearchTerm.objects.filter(post=post).values_list('term', 'count')),
+                         {'fox': 2, 'dog': 1})
+
+    def test_posts_and_comments_are_indexed(self):
+        fox = self.add('The quick brown fox')
+        dog = self.add('A lazy dog')
+        self.client.post('/add_comment', {'post': dog.id, 'text': 'chased by a fox'})
+        self.add('Nothing to see here')
+        posts, has_next = search.search('fox')
+        # Words in the post itself count more than words in its comments
+        self.assertEqual(posts, [fox, dog])
+        self.assertFalse(has_next)
+        self.assertEqual(search.search('lazy fox')[0], [dog])
+        self.assertEqual(search.search('cat')[0], [])
+        self.assertEqual(search.search('the')[0], [])
+
+    def test_pages(self):
+        posts = [self.add('fox number %d' % i) for i in range(5)]
+        first, has_next = search.search('fox', page=1, page_size=3)
+        self.assertTrue(has_next)
+        second, has_next = search.search('fox', page=2, page_size=3)
+        self.assertFalse(has_next)
+        self.assertEqual(sorted(post.id for post in first + second), [post.id for post in posts])
+
+    def test_rebuild(self):
+        post = BlogPost.objects.create(user=self.user, text='unindexed words')
+        self.assertEqual(search.search('unindexed')[0], [])
+        search.rebuild()
+        self.assertEqual(search.search('unindexed')[0], [post])
+
+    def test_views(self):
+        post = self.add('searchable post')
+        response = self.client.get('/search', {'q': 'searchable'})
+        self.assertEqual([pac['post'] for pac in response.context['posts_and_comments']], [post])
+        # For the comment forms of the cards
+        self.assertContains(response, 'nanoblog/js/stream.js')
+        response = self.client.get('/api/v1/search', {'q': 'searchable'})
+        self.assertEqual([record['id'] for record in json.loads(response.content)['posts']],
+                         [post.id])
+
+
+class TagTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(TagTest, self).setUp()
+        self.author = create_blogger('author')
+        self.reader = create_blogger('reader')
+        self.client.login(username='author', password='password')
+
+    def add(self, text):
+        self.client.post('/add', {'text': text})
+        return BlogPost.objects.latest('id')
+
+    def test_parsing(self):
+        text = u"#Django and #django, &#39; mail@example.com @reader. @author's"
+        self.assertEqual(tags.tag_names(text), set(['django']))
+        self.assertEqual(tags.mentioned_usernames(text), set(['reader', "author"]))
+
+    def test_posts_and_comments_are_recorded(self):
+        post = self.add('Hello #World, @reader and @nobody')
+        self.assertEqual([tag.name for tag in Tag.objects.all()], ['world'])
+        self.assertEqual(list(Mention.objects.values_list('user__username', 'post')),
+                         [('reader', post.id)])
+        self.client.post('/add_comment', {'post': post.id, 'text': '#world #news @reader'})
+        self.assertEqual(sorted(PostTag.objects.values_list('tag__name', flat=True)),
+                         ['news', 'world'])
+        self.assertEqual(Mention.objects.count(), 1)
+
+    def test_streams(self):
+        tagged = self.add('About #python')
+        self.add('Nothing here')
+        mention = self.add('Hi @reader')
+        response = self.client.get('/tag/Python')
+        self.assertEqual([pac['post'] for pac in response.context['posts_and_comments']], [tagged])
+        self.assertIn('<a href="/tag/python">#python</a>', response.content)
+        # For the comment forms of the cards
+        self.assertContains(response, 'nanoblog/js/stream.js')
+        response = self.client.get('/api/v1/streams/tag/python')
+        self.assertEqual([post['id'] for post in json.loads(response.content)['posts']],
+                         [tagged.id])
+
+        self.client.login(username='reader', password='password')
+        response = self.client.get('/mentions')
+        self.assertEqual([pac['post'] for pac in response.context['posts_and_comments']], [mention])
+        self.assertIn('<a href="/user/reader">@reader</a>', response.content)
+        response = self.client.get('/api/v1/streams/mentions')
+        self.assertEqual([post['id'] for post in json.loads(response.content)['posts']],
+                         [mention.id])
+
+    def test_comment_moves_old_post_up_the_stream(self):
+        old = self.add('Old post')
+        BlogPost.objects.filter(id=old.id).update(datetime=old.datetime - timedelta(days=1))
+        newer = self.add('Newer post')
+        self.client.post('/add_comment', {'post': old.id, 'text': 'cc @reader #news'})
+        comment = Comment.objects.get(post=old)
+        self.assertEqual(Mention.objects.get(post=old).datetime, comment.datetime)
+        self.assertEqual(PostTag.objects.get(post=old).datetime, comment.datetime)
+
+        self.client.login(username='reader', password='password')
+        # A refresh from before the comment sees the post again
+        data = json.loads(self.client.get('/api/v1/streams/mentions', {
+            'last_updated': str(newer.datetime)}).content)
+        self.assertEqual([post['id'] for post in data['posts']], [old.id])
+        self.assertEqual(data['posts'][0]['last_updated'], comment.datetime.isoformat())
+        response = self.client.get('/mentions')
+        self.assertIn('last_updated="%s"' % comment.datetime, response.content)
+
+    def test_streams_without_the_post_form_have_a_csrf_token(self):
+        post = self.add('Hello #news @reader')
+        client = Client(enforce_csrf_checks=True)
+        client.login(username='reader', password='password')
+        for path in ('/tag/news', '/mentions'):
+            response = client.get(path)
+            self.assertContains(response, "name='csrfmiddlewaretoken'")
+            # As stream.js posts comments from the cards
+            token = response.cookies[settings.CSRF_COOKIE_NAME].value
+            response = client.post('/add_comment', {'post': post.id, 'text': 'from ' + path},
+                                   HTTP_X_CSRFTOKEN=token)
+            self.assertTrue(json.loads(response.content)['success'])
+        self.assertEqual(post.comment_set.count(), 2)
+
+    def test_rows_inserted_concurrently(self):
+        post = self.add('Hello #world @reader')
+        tag = Tag.objects.get(name='world')
+        # As if another transaction inserted these between our lookups and our inserts
+        tags._insert(Tag, [Tag(name='world'), Tag(name='news')])
+        tags._insert(PostTag, [PostTag(tag=tag, post=post, datetime=post.datetime)])
+        tags._insert(Mention, [Mention(user=self.reader, post=post, datetime=post.datetime)])
+        self.assertEqual(sorted(Tag.objects.values_list('name', flat=True)), ['news', 'world'])
+        self.assertEqual(PostTag.objects.count(), 1)
+        self.assertEqual(Mention.objects.count(), 1)
+
+
+class WindowedCounterTest(SimpleTestCase):
+
+    def test_windows_slide(self):
+        counter = trending.WindowedCounter()
+        start = 1000 * trending.BUCKET_SECONDS
+        counter.add('old', 3, start)
+        counter.add('new', 1, start + 30 * 60)
+        counter.add('new', 1, start + 50 * 60)
+        self.assertEqual(counter.top('hour', 10, start + 50 * 60), [('old', 3), ('new', 2)])
+        self.assertEqual(counter.top('hour', 10, start + 65 * 60), [('new', 2)])
+        self.assertEqual(counter.top('day', 1, start + 65 * 60), [('old', 3)])
+        self.assertEqual(counter.top('day', 10, start + 24 * 60 * 60 + 40 * 60), [('new', 1)])
+        self.assertEqual(counter.top('day', 10, start + 48 * 60 * 60), [])
+        self.assertEqual(counter.buckets, {})
+
+
+class TrendingTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(TrendingTest, self).setUp()
+        self.user = create_blogger('trender')
+        self.client.login(username='trender', password='password')
+
+    def add(self, text):
+        self.client.post('/add', {'text': text})
+        return BlogPost.objects.latest('id')
+
+    def test_posts_and_comments_are_counted(self):
+        quiet = self.add('#python')
+        busy = self.add('#django and #python')
+        for text in ['#django', '#django again', 'great']:
+            self.client.post('/add_comment', {'post': busy.id, 'text': text})
+        self.client.post('/add_comment', {'post': quiet.id, 'text': 'ok'})
+        self.assertEqual(trending.top_tags('hour'), [('django', 3), ('python', 2)])
+        self.assertEqual(trending.top_posts('day'), [(busy, 3), (quiet, 1)])
+
+        response = self.client.get('/trending', {'window': 'day'})
+        self.assertEqual([pac['post'] for pac in response.context['posts_and_comments']],
+                         [busy, quiet])
+        self.assertIn('<a href="/tag/python">#python</a>', response.content)
+        # For the comment forms of the cards
+        self.assertContains(response, 'nanoblog/js/stream.js')
+        result = json.loads(self.client.get('/api/v1/trending').content)
+        self.assertEqual([(post['id'], post['activity']) for post in result['posts']],
+                         [(busy.id, 3), (quiet.id, 1)])
+        self.assertEqual([(tag['name'], tag['count']) for tag in result['tags']],
+                         [('django', 3), ('python', 2)])
+        self.assertEqual(self.client.get('/trending', {'window': 'year'}).status_code, 404)
+
+    def test_snapshots(self):
+        now = time.time()
+        counters = trending.Trending(0)
+        counters.record('tag', 'python', timestamp=now)
+        counters.record('post', 42, amount=2, timestamp=now)
+        counters.snapshot(now)
+        counters.record('tag', 'python', timestamp=now)
+        counters.snapshot(now)
+        self.assertEqual(sorted(TrendingCount.objects.values_list('kind', 'key', 'count')),
+                         [('post', '42', 2), ('tag', 'python', 2)])
+        # Another process, or this one after a restart, starts from the snapshot
+        restarted = trending.Trending(0)
+        self.assertEqual(restarted.top('tag', 'hour', 10, now), [('python', 2)])
+        self.assertEqual(restarted.top('post', 'day', 10, now), [(42, 2)])
+        # Rows out of every window are dropped
+        counters.snapshot(now + 2 * 24 * 60 * 60)
+        self.assertFalse(TrendingCount.objects.exists())
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """ SMTP server on a free local port, keeping the messages it receives
+    and counting the connections made to it.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+
+class FailingEmailBackend(BaseEmailBackend):
+
+    def send_messages(self, messages):
+        raise IOError('mail server down')
+
+
+@override_settings(EMAIL_BACKGROUND_SENDER=False)
+class OutboxTest(NanoblogTestCase):
+
+    def queue(self, n):
+        for i in range(n):
+            outbox.queue('Subject %d' % i, 'Body', 'from@example.com', ['to%d@example.com' % i])
+
+    def test_register_queues_mail(self):
+        response = self.client.post('/register', {
+            'first_name': 'New', 'last_name': 'User', 'email': 'new@example.com',
+            'username': 'newuser', 'password1': 'secret', 'password2': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(User.objects.get(username='newuser').is_active)
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.PENDING)
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(outbox.send_pending(), 1)
+        self.assertEqual(OutboundEmail.objects.get().status, OutboundEmail.SENT)
+        self.assertEqual(mail.outbox[0].to, ['new@example.com'])
+        self.assertIn('/confirm-registration/newuser/', mail.outbox[0].body)
+
+    def test_batches_share_a_connection(self):
+        server = LocalSMTPServer()
+        try:
+            with self.settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port,
+                               EMAIL_USE_SSL=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''):
+                self.queue(5)
+                self.assertEqual(outbox.send_pending(batch_size=3), 5)
+        finally:
+            server.stop()
+        self.assertEqual(sorted(rcpttos for rcpttos, data in server.messages),
+                         [['to%d@example.com' % i] for i in range(5)])
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 5)
+
+    @override_settings(EMAIL_BACKEND='nanoblog.tests.FailingEmailBackend',
+                       EMAIL_MAX_ATTEMPTS=2, EMAIL_RETRY_DELAY=60)
+    def test_failures_are_retried_later(self):
+        self.queue(1)
+        self.assertEqual(outbox.send_pending(), 0)
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.PENDING, 1))
+        self.assertGreater(email.next_attempt, timezone.now())
+        # Not due yet
+        self.assertEqual(outbox.send_pending(), 0)
+        self.assertEqual(OutboundEmail.objects.get().attempts, 1)
+        OutboundEmail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(outbox.send_pending(), 0)
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.FAILED, 2))
+        self.assertIn('mail server down', email.error)
+
+
+    @override_settings(EMAIL_BACKGROUND_SENDER=True, UPLOAD_THREADS=0)
+    def test_gunicorn_workers_start_the_sender(self):
+        from webapps import gunicorn_conf
+        sender = outbox._sender
+        outbox._sender = None
+        try:
+            gunicorn_conf.post_fork(None, None)
+            self.assertIsNotNone(outbox._sender)
+        finally:
+            outbox._sender = sender
+
+
+class BenchmarkStreamsTest(NanoblogTestCase):
+
+    def test_small_run(self):
+        output = BytesIO()
+        call_command('benchmark_streams', users=5, posts=30, follows=2, repeat=2,
+                     json='-', stdout=output, stderr=BytesIO())
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual([result['scenario'] for result in results],
+                         ['global_stream', 'following', 'user', 'refresh', 'add', 'add_comment'])
+        for result in results:
+            self.assertEqual((result['mode'], result['requests'], result['errors']),
+                             ('client', 2, 0))
+            self.assertGreater(result['queries_per_request'], 0)
+        self.assertEqual(BlogPost.objects.filter(text__startswith='Benchmark post').count(), 2)
+
+
+class MetricsTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.user = create_blogger('measured')
+        BlogPost.objects.create(user=self.user, text='post')
+        self.client.login(username='measured', password='password')
+
+    def value(self, exported, name, view, **labels):
+        """ Get the value of metric `name` for `view` in `exported`. """
+        pattern = r'^%s\{view="%s",%s' % (name, re.escape(view), ''.join(
+            '%s="%s",' % (label, value) for label, value in sorted(labels.items())))
+        pattern += r'pid="\d+"\} (\S+)$'
+        match = re.search(pattern, exported, re.MULTILINE)
+        return float(match.group(1)) if match else 0
+
+    def test_requests_are_recorded(self):
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        view = 'nanoblog.views.global_stream'
+        before = metrics.registry.export()
+        self.client.get('/')
+        self.client.get('/')
+        exported = self.client.get('/metrics').content
+        self.assertIn('# TYPE nanoblog_request_seconds histogram', exported)
+        self.assertEqual(self.value(exported, 'nanoblog_requests_total', view) -
+                         self.value(before, 'nanoblog_requests_total', view), 2)
+        self.assertGreater(self.value(exported, 'nanoblog_db_queries_total', view),
+                           self.value(before, 'nanoblog_db_queries_total', view))
+        self.assertGreater(self.value(exported, 'nanoblog_template_seconds_total', view), 0)
+        # The second request found the post card in the cache
+        self.assertGreater(self.value(exported, 'nanoblog_cache_hits_total', view,
+                                      cache='fragments'), 0)
+
+    def test_server_timing(self):
+        with self.settings(METRICS_SERVER_TIMING=True):
+            response = self.client.get('/')
+        self.assertRegexpMatches(response['Server-Timing'],
+                                 r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+')
+        self.assertFalse(self.client.get('/').has_header('Server-Timing'))
+
+    def test_external_calls_outside_requests(self):
+        with metrics.external('test-service'):
+            pass
+        self.assertGreater(self.value(metrics.registry.export(), 'nanoblog_external_calls_total',
+                                      'background', service='test-service'), 0)
+
+    def test_token(self):
+        self.client.logout()
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    def test_staff_only_without_a_token(self):
+        self.assertIsNone(settings.METRICS_TOKEN)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer None')
+        self.assertEqual(response.status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        self.client.login(username='measured', password='password')
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_PIN_SECONDS=10)
+class ReplicaRouterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.router = replicas.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def test_reads_go_to_the_replica_in_replica_blocks(self):
+        self.assertEqual(self.router.db_for_read(BlogPost), 'default')
+        with replicas.reading_from('replica1'):
+            self.assertEqual(self.router.db_for_read(BlogPost), 'replica1')
+            self.assertEqual(self.router.db_for_write(BlogPost), 'default')
+            with replicas.reading_from(None):
+                self.assertEqual(self.router.db_for_read(BlogPost), 'default')
+            self.assertEqual(self.router.db_for_read(BlogPost), 'replica1')
+        self.assertEqual(self.router.db_for_read(BlogPost), 'default')
+        self.assertFalse(self.router.allow_migrate('replica1', BlogPost))
+
+    def test_read_alias(self):
+        self.assertEqual(replicas.read_alias(self.factory.get('/')), 'replica1')
+        self.assertIsNone(replicas.read_alias(self.factory.post('/')))
+        request = self.factory.get('/')
+        request.COOKIES[replicas.PIN_COOKIE] = str(int(time.time()) + 10)
+        self.assertIsNone(replicas.read_alias(request))
+        request.COOKIES[replicas.PIN_COOKIE] = str(int(time.time()) - 1)
+        self.assertEqual(replicas.read_alias(request), 'replica1')
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertIsNone(replicas.read_alias(self.factory.get('/')))
+
+    def test_lag_margin(self):
+        with self.settings(REPLICA_MAX_LAG=5):
+            self.assertEqual(replicas.lag_margin().total_seconds(), 0)
+            with replicas.reading_from('replica1'):
+                self.assertEqual(replicas.lag_margin().total_seconds(), 5)
+
+
+# The replica is the test database itself, so the views can be run
+@override_settings(DATABASE_REPLICAS=['default'], REPLICA_PIN_SECONDS=10)
+class ReplicaPinTest(NanoblogTestCase):
+
+    def setUp(self):
+        super(ReplicaPinTest, self).setUp()
+        self.user = create_blogger('writer')
+        self.client.login(username='writer', password='password')
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        self.assertNotIn(replicas.PIN_COOKIE, self.client.get('/').cookies)
+        response = self.client.post('/add', {'text': 'new post'})
+        cookie = response.cookies[replicas.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 10)
+        self.assertGreater(float(cookie.value), time.time())
+        create_blogger('followed')
+        self.assertIn(replicas.PIN_COOKIE, self.client.get('/follow/followed').cookies)
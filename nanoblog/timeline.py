@@ -0,0 +1,69 @@
+"""
+Materialized following streams ("home timelines").
+
+Instead of joining BlogPost against the follow graph on every request, each
+new post is copied into a TimelineEntry for every follower of its author when
+it is written (fan-out on write). Following or unfollowing someone backfills
+or prunes the follower's timeline, and rebuild() recomputes timelines from
+scratch (see the rebuild_timelines management command).
+"""
+
+from django.conf import settings
+
+from nanoblog.models import BlogPost, Blogger, TimelineEntry
+
+# Rows per bulk INSERT when writing many entries at once. Django splits
+# these further where the database needs it (e.g. SQLite's variable limit).
+BATCH_SIZE = 500
+
+def _bulk_create(entries):
+    entries = list(entries)
+    for start in range(0, len(entries), BATCH_SIZE):
+        TimelineEntry.objects.bulk_create(entries[start:start + BATCH_SIZE])
+
+def timeline_entries(owner):
+    """ Get `owner`'s following stream, as a TimelineEntry queryset (see
+    nanoblog.pagination). Pages are range scans on (owner, datetime, post).
+    """
+    return TimelineEntry.objects.filter(owner=owner)
+
+def follower_ids(author):
+    """ Get the ids of the Users following `author`. """
+    return Blogger.objects.filter(following=author).values_list('user_id', flat=True)
+
+def fan_out(post):
+    """ Add a newly created post to the timeline of every follower of its author.
+    Returns the ids of the Users whose timelines were updated.
+    """
+    owner_ids = list(follower_ids(post.user_id))
+    _bulk_create(
+        [TimelineEntry(owner_id=owner_id, post=post, datetime=post.datetime)
+         for owner_id in owner_ids])
+    return owner_ids
+
+def backfill(owner, author):
+    """ Add `author`'s most recent posts (at most settings.TIMELINE_BACKFILL_SIZE)
+    to `owner`'s timeline. Called when `owner` starts following `author`.
+    """
+    prune(owner, author)
+    posts = (BlogPost.objects.filter(user=author)
+                             .order_by('-datetime', '-id')
+                             .values_list('id', 'datetime'))
+    _bulk_create(
+        [TimelineEntry(owner=owner, post_id=post_id, datetime=post_datetime)
+         for post_id, post_datetime in posts[:settings.TIMELINE_BACKFILL_SIZE]])
+
+def prune(owner, author):
+    """ Remove all of `author`'s posts from `owner`'s timeline.
+    Called when `owner` stops following `author`.
+    """
+    TimelineEntry.objects.filter(owner=owner, post__user=author).delete()
+
+def rebuild(blogger):
+    """ Recompute the timeline of `blogger`'s User from their following set. """
+    owner = blogger.user
+    TimelineEntry.objects.filter(owner=owner).delete()
+    posts = BlogPost.objects.filter(user__followers=blogger).values_list('id', 'datetime')
+    _bulk_create(
+        [TimelineEntry(owner=owner, post_id=post_id, datetime=post_datetime)
+         for post_id, post_datetime in posts.iterator()])
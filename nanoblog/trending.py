@@ -0,0 +1,269 @@
+"""
+Trending hashtags and posts over the last hour and the last day.
+
+Tags are ranked by how often they were used in new posts and comments, posts
+by how many comments they got. Nothing is counted at read time: every new
+post and comment bumps in-memory counters (see nanoblog.events), and reading
+the top entries of a window only looks at those counters.
+
+Counts are kept in buckets of BUCKET_SECONDS, so a window slides by a bucket
+at a time: the "hour" is the current bucket and the ones before it, i.e.
+between 55 and 60 minutes. Each window keeps running totals, which buckets
+are subtracted from as they fall out of it, so a read costs O(keys in the
+window) and an update O(windows).
+
+Counters are per process. Every settings.TRENDING_SNAPSHOT_INTERVAL seconds
+the counts recorded since the last snapshot are added to the TrendingCount
+table, and the counters are reloaded from it, so processes see each other's
+counts within an interval and a restarted process starts from the last
+snapshot.
+"""
+
+import calendar
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime    import datetime
+
+from django.conf import settings
+from django.db   import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from nanoblog.models import BlogPost, TrendingCount
+from nanoblog import tags
+
+WINDOWS = (('hour', 60 * 60), ('day', 24 * 60 * 60))
+
+BUCKET_SECONDS = 5 * 60
+
+KINDS = ('tag', 'post')
+
+def bucket_index(timestamp):
+    """ Get the index of the bucket holding the UNIX time `timestamp`. """
+    return int(timestamp // BUCKET_SECONDS)
+
+def bucket_start(index):
+    """ Get the aware datetime the bucket `index` starts at. """
+    return datetime.fromtimestamp(index * BUCKET_SECONDS, timezone.utc)
+
+def oldest_bucket(timestamp):
+    """ Get the index of the oldest bucket in any window at `timestamp`. """
+    longest = max(seconds for name, seconds in WINDOWS) // BUCKET_SECONDS
+    return bucket_index(timestamp) - longest + 1
+
+def _timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+class WindowedCounter(object):
+    """ Counts of keys over each of the sliding `windows`, a sequence of
+    (name, seconds) pairs.
+    """
+
+    def __init__(self, windows=WINDOWS):
+        self.windows = dict((name, seconds // BUCKET_SECONDS) for name, seconds in windows)
+        self.buckets = {}
+        self.totals = dict((name, Counter()) for name in self.windows)
+        # Index of the newest bucket seen
+        self.current = None
+
+    def first_bucket(self, name, current=None):
+        """ Get the index of the oldest bucket in window `name`. """
+        if current is None:
+            current = self.current
+        return current - self.windows[name] + 1
+
+    def advance(self, timestamp):
+        """ Slide the windows forward to `timestamp`. """
+        current = bucket_index(timestamp)
+        if self.current is not None and current <= self.current:
+            return
+        previous, self.current = self.current, current
+        if previous is None:
+            return
+        for name, totals in self.totals.items():
+            start, end = self.first_bucket(name, previous), self.first_bucket(name)
+            for index in [index for index in self.buckets if start <= index < end]:
+                bucket = self.buckets[index]
+                totals.subtract(bucket)
+                for key in bucket:
+                    if totals[key] <= 0:
+                        del totals[key]
+        oldest = min(self.first_bucket(name) for name in self.windows)
+        for index in [index for index in self.buckets if index < oldest]:
+            del self.buckets[index]
+
+    def add(self, key, amount, timestamp):
+        """ Count `amount` more of `key` at `timestamp`. """
+        self.advance(timestamp)
+        index = bucket_index(timestamp)
+        windows = [name for name in self.windows if index >= self.first_bucket(name)]
+        if not windows:
+            return
+        self.buckets.setdefault(index, Counter())[key] += amount
+        for name in windows:
+            self.totals[name][key] += amount
+
+    def top(self, name, n, timestamp):
+        """ Get the `n` keys with the highest counts in window `name`, as
+        a list of (key, count) pairs, highest first.
+        """
+        self.advance(timestamp)
+        return self.totals[name].most_common(n)
+
+class Trending(object):
+    """ Counters for each of KINDS, snapshotted to the TrendingCount table
+    every `snapshot_interval` seconds (never if it is 0).
+    """
+
+    def __init__(self, snapshot_interval):
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.counters = self.new_counters()
+        # (kind, key, bucket index) -> count recorded since the last snapshot
+        self.unsaved = defaultdict(int)
+        self.loaded = False
+        self.last_snapshot = time.time()
+
+    def new_counters(self):
+        return dict((kind, WindowedCounter()) for kind in KINDS)
+
+    def record(self, kind, key, amount=1, timestamp=None):
+        """ Count `amount` more of `key` (a tag name or a post id). """
+        timestamp = timestamp or time.time()
+        with self.lock:
+            self.counters[kind].add(key, amount, timestamp)
+            self.unsaved[(kind, key, bucket_index(timestamp))] += amount
+        self.snapshot_if_due(timestamp)
+
+    def top(self, kind, window, n, timestamp=None):
+        """ Get the `n` most counted keys of `kind` in `window`, as a list
+        of (key, count) pairs, highest first.
+        """
+        timestamp = timestamp or time.time()
+        if not self.loaded:
+            self.load(timestamp)
+        else:
+            self.snapshot_if_due(timestamp)
+        with self.lock:
+            return self.counters[kind].top(window, n, timestamp)
+
+    def snapshot_if_due(self, timestamp):
+        if (self.snapshot_interval and
+                timestamp - self.last_snapshot >= self.snapshot_interval):
+            self.snapshot(timestamp)
+
+    def snapshot(self, timestamp=None):
+        """ Add the counts recorded since the last snapshot to the database,
+        then reload the counters from it. Does nothing if another thread is
+        already taking a snapshot.
+        """
+        timestamp = timestamp or time.time()
+        if not self.snapshot_lock.acquire(False):
+            return
+        try:
+            with self.lock:
+                unsaved, self.unsaved = self.unsaved, defaultdict(int)
+                self.last_snapshot = timestamp
+            try:
+                self.save(unsaved, timestamp)
+            except Exception:
+                # Keep the counts for the next snapshot
+                with self.lock:
+                    for item, count in unsaved.items():
+                        self.unsaved[item] += count
+                raise
+            self.load(timestamp)
+        finally:
+            self.snapshot_lock.release()
+
+    def save(self, counts, timestamp):
+        """ Add `counts`, as in self.unsaved, to the TrendingCount rows, and
+        delete the rows that are out of every window.
+        """
+        with transaction.atomic():
+            for (kind, key, index), count in counts.items():
+                key, start = '%s' % key, bucket_start(index)
+                rows = TrendingCount.objects.filter(kind=kind, key=key, start=start)
+                if rows.update(count=F('count') + count):
+                    continue
+                try:
+                    with transaction.atomic():
+                        TrendingCount.objects.create(kind=kind, key=key, start=start, count=count)
+                except IntegrityError:
+                    # Another process made the row first
+                    rows.update(count=F('count') + count)
+            oldest = bucket_start(oldest_bucket(timestamp))
+            TrendingCount.objects.filter(start__lt=oldest).delete()
+
+    def load(self, timestamp=None):
+        """ Rebuild the counters from the TrendingCount rows and the counts
+        not saved yet.
+        """
+        timestamp = timestamp or time.time()
+        oldest = bucket_start(oldest_bucket(timestamp))
+        rows = (TrendingCount.objects.filter(start__gte=oldest)
+                                     .values_list('kind', 'key', 'start', 'count'))
+        counters = self.new_counters()
+        for counter in counters.values():
+            counter.advance(timestamp)
+        for kind, key, start, count in rows:
+            if kind == 'post':
+                key = int(key)
+            counters[kind].add(key, count, _timestamp(start))
+        with self.lock:
+            for (kind, key, index), count in self.unsaved.items():
+                counters[kind].add(key, count, index * BUCKET_SECONDS)
+            self.counters = counters
+            self.loaded = True
+
+_trending = None
+_trending_lock = threading.Lock()
+
+def get_trending():
+    """ Get the process-wide Trending counters. """
+    global _trending
+    with _trending_lock:
+        if _trending is None or _trending.snapshot_interval != settings.TRENDING_SNAPSHOT_INTERVAL:
+            _trending = Trending(settings.TRENDING_SNAPSHOT_INTERVAL)
+        return _trending
+
+def reset():
+    """ Forget the counts held in memory. They are reloaded from the last
+    snapshot on the next read.
+    """
+    global _trending
+    with _trending_lock:
+        _trending = None
+
+def record_post(post):
+    """ Count the tags of the new `post`. Call this once it is committed. """
+    trending = get_trending()
+    for name in tags.tag_names(post.text):
+        trending.record('tag', name)
+
+def record_comment(comment):
+    """ Count the new `comment` for its post, and its tags. Call this once it
+    is committed.
+    """
+    trending = get_trending()
+    trending.record('post', comment.post_id)
+    for name in tags.tag_names(comment.text):
+        trending.record('tag', name)
+
+def top_tags(window, n=None):
+    """ Get the list of the `n` (settings.TRENDING_SIZE by default) most used
+    tag names in `window`, as (name, count) pairs, most used first.
+    """
+    return get_trending().top('tag', window, n or settings.TRENDING_SIZE)
+
+def top_posts(window, n=None):
+    """ Get the list of the `n` (settings.TRENDING_SIZE by default) most
+    commented BlogPosts in `window`, with their authors, as (post, count)
+    pairs, most commented first.
+    """
+    counts = get_trending().top('post', window, n or settings.TRENDING_SIZE)
+    posts = BlogPost.objects.select_related('user__blogger').in_bulk(
+        [post_id for post_id, count in counts])
+    return [(posts[post_id], count) for post_id, count in counts if post_id in posts]
@@ -0,0 +1,231 @@
+"""
+Background uploads of profile pictures.
+
+edit_profile doesn't talk to storage itself. It saves the picture in an
+UploadJob row and hands the job to a pool of worker threads, then returns
+right away. A worker resizes the picture (see nanoblog.imaging), uploads
+every size to storage (see nanoblog.storage) and
+sets the new URLs as the user's picture once the uploads are done. Until
+then the user keeps their previous picture.
+
+Jobs live in the database, so nothing is lost when a process exits with
+jobs still queued. Every settings.UPLOAD_RETRY_INTERVAL seconds, and when
+they are started (see start()), the threads look for jobs left pending,
+failed attempts to retry and jobs abandoned by a worker that died. A job is
+marked failed after settings.UPLOAD_MAX_ATTEMPTS attempts, so a picture
+that crashes its worker isn't tried forever. With settings.UPLOAD_THREADS
+= 0 no threads are started and the process_uploads management command
+does all the uploading, e.g. from a separate worker process.
+"""
+
+import logging
+import threading
+import time
+import Queue
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from nanoblog.models import Blogger, UploadJob
+from nanoblog import events, imaging
+from nanoblog.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+def enqueue(blogger, uploaded_file):
+    """ Save `uploaded_file` in a new UploadJob for `blogger`'s picture.
+    Pass the job to submit() once the transaction saving it has committed.
+    """
+    data = ''.join(uploaded_file.chunks())
+    return UploadJob.objects.create(blogger=blogger, data=data,
+                                    content_type=uploaded_file.content_type or '')
+
+def submit(job):
+    """ Have `job` uploaded by this process' worker threads, if there are any. """
+    if settings.UPLOAD_THREADS > 0:
+        get_pool().submit(job.id)
+
+def start():
+    """ Start this process' worker threads, if there are any, so they pick up
+    the jobs left pending without waiting for a new one to be submitted.
+    """
+    if settings.UPLOAD_THREADS > 0:
+        get_pool()
+
+def variant_name(job_name, variant):
+    """ Get the storage name of size `variant` of an UploadJob's picture. """
+    return '%s-%s.jpg' % (job_name, variant)
+
+def delete_files(job_names):
+    """ Remove every size of the pictures of UploadJobs from storage. """
+    names = [variant_name(job_name, variant)
+             for job_name in job_names for variant in imaging.VARIANT_NAMES]
+    try:
+        get_storage().delete_many(names)
+    except Exception:
+        logger.exception('Deleting %s failed', ', '.join(names))
+
+def _attempt_failed(job_id, error):
+    """ Put the running UploadJob with id `job_id` back in the queue after
+    `error`, or mark it failed if it has used up its attempts.
+    """
+    running = UploadJob.objects.filter(id=job_id, status=UploadJob.RUNNING)
+    now = timezone.now()
+    if not (running.filter(attempts__lt=settings.UPLOAD_MAX_ATTEMPTS)
+                   .update(status=UploadJob.PENDING, error=repr(error), updated=now)):
+        running.update(status=UploadJob.FAILED, error=repr(error), updated=now)
+
+def process(job_id):
+    """ Resize and upload the UploadJob with id `job_id` unless another
+    worker has claimed it. Returns whether the picture was uploaded.
+    """
+    claimed = (UploadJob.objects.filter(id=job_id, status=UploadJob.PENDING)
+                                .update(status=UploadJob.RUNNING,
+                                        attempts=F('attempts') + 1,
+                                        updated=timezone.now()))
+    if not claimed:
+        return False
+    try:
+        return _upload(job_id)
+    except Exception as e:
+        # Storage errors, but also anything else going wrong with the picture
+        logger.exception('Upload job %d failed', job_id)
+        _attempt_failed(job_id, e)
+        return False
+
+def _upload(job_id):
+    """ Do the work of process() for the claimed UploadJob `job_id`. """
+    job = UploadJob.objects.select_related('blogger__user').get(id=job_id)
+    # Every upload gets a new name, so browsers and caches never show a
+    # stale picture, and a slow upload can't overwrite a newer one.
+    name = 'id-%d-%d' % (job.blogger_id, job.id)
+
+    try:
+        variants = imaging.variants(bytes(job.data))
+    except imaging.ImageError as e:
+        # No point in trying again
+        UploadJob.objects.filter(id=job.id).update(
+            status=UploadJob.FAILED, data=None, error=str(e), updated=timezone.now())
+        return False
+
+    urls = {}
+    srcset = []
+    for variant, width, data in variants:
+        url = get_storage().upload(variant_name(name, variant), data, imaging.CONTENT_TYPE)
+        urls[variant] = url
+        srcset.append((url, width))
+
+    with transaction.atomic():
+        UploadJob.objects.filter(id=job.id).update(
+            status=UploadJob.DONE, name=name, url=urls['full'], data=None, error='',
+            updated=timezone.now())
+        # Jobs may finish out of order: the newest picture wins, and the
+        # files of older ones are removed.
+        done = list(UploadJob.objects.select_for_update()
+                                     .filter(blogger_id=job.blogger_id, status=UploadJob.DONE)
+                                     .order_by('-id'))
+        latest, superseded = done[0], done[1:]
+        if latest.id == job.id:
+            Blogger.objects.filter(id=job.blogger_id).update(
+                profile_picture_url=urls['full'],
+                profile_picture_card_url=urls['card'],
+                profile_picture_thumb_url=urls['thumb'],
+                profile_picture_srcset=imaging.srcset(srcset))
+        UploadJob.objects.filter(id__in=[old.id for old in superseded]).delete()
+
+    if superseded:
+        delete_files([old.name for old in superseded])
+    events.profile_updated(job.blogger.user)
+    return True
+
+def pending_ids(limit=None):
+    """ Get the ids of the pending jobs, oldest first, after putting back
+    in the queue the jobs whose worker has not been heard of in
+    settings.UPLOAD_STALE_AFTER seconds (or failing them, if they have used
+    up their attempts).
+    """
+    now = timezone.now()
+    stale = (UploadJob.objects.filter(status=UploadJob.RUNNING,
+                                      updated__lt=now - timedelta(seconds=settings.UPLOAD_STALE_AFTER)))
+    stale.filter(attempts__gte=settings.UPLOAD_MAX_ATTEMPTS).update(
+        status=UploadJob.FAILED, error='Abandoned by its worker', updated=now)
+    stale.update(status=UploadJob.PENDING, updated=now)
+    job_ids = (UploadJob.objects.filter(status=UploadJob.PENDING)
+                                .order_by('id').values_list('id', flat=True))
+    if limit is not None:
+        job_ids = job_ids[:limit]
+    return list(job_ids)
+
+def process_pending(limit=None):
+    """ Upload the pending jobs (see pending_ids()). Returns the number of
+    pictures uploaded.
+    """
+    return sum(1 for job_id in pending_ids(limit) if process(job_id))
+
+class UploadPool(object):
+    """ Threads calling `function` on the job ids submitted to them, and,
+    every `interval` seconds if it is given, on the ids `pending` returns.
+    """
+
+    def __init__(self, threads, function=process, pending=pending_ids, interval=None):
+        self.function = function
+        self.pending = pending
+        self.interval = interval
+        self.queue = Queue.Queue()
+        for i in range(threads):
+            thread = threading.Thread(target=self.work, name='upload-%d' % i)
+            thread.daemon = True
+            thread.start()
+        if interval:
+            thread = threading.Thread(target=self.sweep, name='upload-sweeper')
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, job_id):
+        self.queue.put(job_id)
+
+    def join(self):
+        """ Wait until every submitted job has been processed. """
+        self.queue.join()
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                # Each thread has its own database connection. Treat every
+                # job like a request, so broken or expired ones get replaced.
+                close_old_connections()
+                self.function(job_id)
+            except Exception:
+                logger.exception('Upload job %s failed', job_id)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def sweep(self):
+        while True:
+            try:
+                close_old_connections()
+                # A job still queued from the last time is just not claimed twice
+                for job_id in self.pending():
+                    self.submit(job_id)
+            except Exception:
+                logger.exception('Looking for pending upload jobs failed')
+            finally:
+                close_old_connections()
+            time.sleep(self.interval)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """ Get this process' UploadPool, starting its threads the first time. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = UploadPool(settings.UPLOAD_THREADS,
+                               interval=settings.UPLOAD_RETRY_INTERVAL)
+        return _pool
@@ -8,10 +8,22 @@ urlpatterns = patterns('',
     url(r'^follow/(?P<username>.*)$', 'nanoblog.views.follow', name="follow"),
     url(r'^unfollow/(?P<username>.*)$', 'nanoblog.views.unfollow', name="unfollow"),
     url(r'^add$', 'nanoblog.views.add', name="add"),
+    url(r'^search$', 'nanoblog.views.search_posts', name="search"),
+    url(r'^tag/(?P<name>\w+)$', 'nanoblog.views.tag', name="tag"),
+    url(r'^mentions$', 'nanoblog.views.mentions', name="mentions"),
+    url(r'^trending$', 'nanoblog.views.trending_topics', name="trending"),
     url(r'^login$', 'django.contrib.auth.views.login', {'template_name':'nanoblog/login.html'}, name="login"),
     url(r'^logout$', 'django.contrib.auth.views.logout_then_login', name="logout"),
     url(r'^register$', 'nanoblog.views.register', name="register"),
     url(r'^edit_profile$', 'nanoblog.views.edit_profile', name="edit_profile"),
     url(r'^add_comment$', 'nanoblog.views.add_comment', name='add_comment'),
+    url(r'^api/v1/streams/global$', 'nanoblog.api.global_stream', name='api_global_stream'),
+    url(r'^api/v1/streams/following$', 'nanoblog.api.following', name='api_following'),
+    url(r'^api/v1/streams/user/(?P<username>.*)$', 'nanoblog.api.user', name='api_user'),
+    url(r'^api/v1/streams/tag/(?P<name>\w+)$', 'nanoblog.api.tag', name='api_tag'),
+    url(r'^api/v1/streams/mentions$', 'nanoblog.api.mentions', name='api_mentions'),
+    url(r'^api/v1/search$', 'nanoblog.api.search_posts', name='api_search'),
+    url(r'^api/v1/trending$', 'nanoblog.api.trending_topics', name='api_trending'),
+    url(r'^metrics$', 'nanoblog.metrics.metrics_view', name='metrics'),
     url(r'^confirm-registration/(?P<username>[a-zA-Z0-9_@\+\-]+)/(?P<token>[a-z0-9\-]+)$', 'nanoblog.views.confirm_registration', name='confirm'),
 )
\ No newline at end of file
@@ -1,10 +1,16 @@
 import json
+import time
+from datetime import timedelta
 
 from django.shortcuts         import render, redirect, get_object_or_404
 from django.template.loader   import render_to_string
+from django.template          import RequestContext
 from django.core.urlresolvers import reverse
 from django.core.exceptions   import ObjectDoesNotExist
 from django.http              import HttpResponse, Http404
+from django.conf              import settings
+from django.utils             import timezone
+from django.utils.dateparse   import parse_datetime
 
 # User authentication
 from django.contrib.auth.models     import User
@@ -14,22 +20,60 @@ from django.contrib.auth.decorators import login_required
 # Used to generate a one-time-use token to verify a user's email address
 from django.contrib.auth.tokens import default_token_generator
 
-# Used to send mail from within Django
-from django.core.mail import send_mail
+# Outgoing mail is queued and sent in the background
+from nanoblog import outbox
 
 # Django transaction system so we can use @transaction.atomic
 from django.db import transaction
 
 # Custom models and forms
-from nanoblog.models import User, BlogPost, Blogger, Comment
+from nanoblog.models import User, BlogPost, Blogger, Comment, PostTag, Mention
 from nanoblog.forms  import RegistrationForm, ProfileForm, BlogPostForm, CommentForm
 
-# Amazon S3 file hosting
-from nanoblog.s3 import s3_upload, s3_delete
+# Profile pictures are uploaded in the background
+from nanoblog import uploads
 
+# Keyset pagination for the streams
+from nanoblog.pagination import (older_page, newer_page, with_authors, post_field,
+                                 stream_datetime)
 
+# Materialized following streams
+from nanoblog import timeline
 
-def comments_for_posts(posts):
+# Change notifications for long-polling clients
+from nanoblog import pubsub, events
+
+# Cache of rendered post cards
+from nanoblog import fragments
+
+# 304 Not Modified for stream refreshes
+from nanoblog import conditional
+
+# Denormalized comment counts
+from nanoblog import activity
+
+# Optional group commit of new posts and comments
+from nanoblog import batching
+
+# Cached follow graph
+from nanoblog import follow_graph
+
+# Full-text search
+from nanoblog import search
+
+# Hashtags and mentions
+from nanoblog import tags
+
+# Trending tags and posts
+from nanoblog import trending
+
+# Read replicas
+from nanoblog import replicas
+from nanoblog.replicas import replica_reads, pins_primary
+
+
+
+def comments_for_posts(posts, trust_counts=True):
     """
     Given a sequence of BlogPost objects, get a list of dictionaries with the following components:
     - post: the original post
@@ -37,34 +81,209 @@ def comments_for_posts(posts):
                     The most recent update on the whole stream can be found
                     by inspecting the last_updated field of the top post of the stream.
     - comments: A list of Comment objects on this post.
+
+    The comments for every post are fetched in a single query, along with
+    their authors and the authors' Blogger profiles, and grouped in memory.
+    Posts whose comment_count says they have no comments are left out of it,
+    unless trust_counts is False (for posts read from a replica, whose count
+    may predate their first comment).
     """
+    posts = list(posts)
+    comments_by_post = {}
+    commented_posts = [post for post in posts if post.comment_count or not trust_counts]
+    if commented_posts:
+        comments = (Comment.objects.filter(post__in=commented_posts)
+                                   .select_related('user__blogger')
+                                   .order_by('datetime', 'id'))
+        for comment in comments:
+            comments_by_post.setdefault(comment.post_id, []).append(comment)
+
     posts_and_comments = []
     for post in posts:
         group = {}
         group["post"] = post
-        group["last_updated"] = str(post.datetime)
-        group["comments"] = Comment.objects.filter(post=post).order_by('datetime')
+        group["last_updated"] = str(stream_datetime(post))
+        group["comments"] = comments_by_post.get(post.id, [])
         posts_and_comments.append(group)
     return posts_and_comments
 
-def stream_html(request, template_name, blog_posts, context):
+def sync_margin():
     """
-    Check for GET["last_updated"]. If present, treat this as an incremental AJAX
-    request and only return the HTML for new posts, which should be inserted at
-    the top of the post list. If absent, treat this as a regular page GET and return
-    the entire HTML page.
+    Get how long before a refresh's GET["comments_since"] comments are still
+    looked for. A comment's datetime is set when it is saved, before its
+    transaction (and its write batch, see nanoblog.batching) commits, so it
+    can show up after a refresh that should have seen it. Reading from a
+    replica adds its lag (see nanoblog.replicas). stream.js skips the
+    comments it already shows.
+    """
+    return timedelta(seconds=settings.COMMENT_SYNC_MARGIN) + replicas.lag_margin()
+
+def new_comments(blog_posts, oldest, newest, since):
+    """
+    Get the comments made after `since` (less sync_margin()) on the posts of
+    the stream `blog_posts` (see nanoblog.pagination) that were made between
+    `oldest` and `newest`, i.e. on the posts a client already has on screen.
+    Returns a list in chronological order.
+    """
+    shown_posts = (blog_posts.filter(datetime__gte=oldest, datetime__lte=newest)
+                             .values(post_field(blog_posts)))
+    return list(Comment.objects.filter(post__in=shown_posts,
+                                       datetime__gt=since - sync_margin())
+                               .select_related('user__blogger')
+                               .order_by('datetime', 'id'))
+
+def is_long_poll(request):
+    """ Whether `request` is a refresh to hold open until there is news. """
+    return settings.LONGPOLL and "wait" in request.GET
+
+def poll_stream(request, blog_posts, channel):
+    """
+    Find what is new in a stream for an incremental refresh. GET["last_updated"]
+    is the time of the newest post the client has. At most
+    settings.STREAM_PAGE_SIZE posts made after that are returned.
+
+    If GET["comments_since"] is present, the client also wants the comments
+    made since its last refresh on the posts it already shows, i.e. those
+    between GET["oldest"] and GET["last_updated"] (see new_comments).
+
+    If GET["wait"] is present and settings.LONGPOLL is on, this is a
+    long-poll: when there is nothing new yet, the request is held open until
+    something is published on the stream's pubsub `channel` (see
+    nanoblog.pubsub), or until settings.LONGPOLL_TIMEOUT seconds have passed.
+
+    Returns a (posts, comments, synced) triple, where synced is the value the
+    client should pass as comments_since on its next refresh. It only moves
+    on when there is news, so an idle client keeps asking for the same URL,
+    and can be answered with 304 Not Modified (see nanoblog.conditional).
+    """
+    page_size = settings.STREAM_PAGE_SIZE
+    last_updated = request.GET["last_updated"]
+    oldest = request.GET.get("oldest", None)
+    since = None
+    if request.GET.get("comments_since") and oldest:
+        try:
+            since = parse_datetime(request.GET["comments_since"])
+        except ValueError:
+            pass
+        if since is None:
+            raise Http404
+
+    def query():
+        posts = newer_page(with_authors(blog_posts),
+                           page_size, last_updated)
+        comments = []
+        if since is not None:
+            comments = new_comments(blog_posts, oldest, last_updated, since)
+        return posts, comments
+
+    def news(posts, comments):
+        # The comments made within sync_margin() before `since` may be ones
+        # the client has already
+        return posts or any(comment.datetime > since for comment in comments)
+
+    # Take the sync time and the channel version before querying, so nothing
+    # published while we query or wait can be missed.
+    synced = str(timezone.now())
+    version = pubsub.version(channel)
+    posts, comments = query()
+    if is_long_poll(request):
+        deadline = time.time() + settings.LONGPOLL_TIMEOUT
+        while not news(posts, comments) and time.time() < deadline:
+            # Wake up every LONGPOLL_RECHECK seconds even without a
+            # notification, in case the pubsub backend can't see events
+            # from other processes.
+            timeout = min(deadline - time.time(), settings.LONGPOLL_RECHECK)
+            version = pubsub.wait(channel, version, timeout)
+            synced = str(timezone.now())
+            posts, comments = query()
+    if request.GET.get("comments_since") and not news(posts, comments):
+        synced = request.GET["comments_since"]
+    return posts, comments, synced
+
+def stream_updates(request, blog_posts, context, channel):
+    """
+    Handle an incremental AJAX refresh for stream_html (see poll_stream).
 
-    This is used by global_stream, following, and user to render initial page loads
-    and incremental updates.
+    If GET["comments_since"] is present, the response is a JSON object with
+    the following components:
+    - html: the HTML for the new posts, to insert at the top of the post list
+    - comments: a list of [post id, comment id, comment HTML] triples
+    - synced: the value to pass as comments_since on the next refresh
+    Otherwise the response is just the HTML for the new posts.
+
+    Refreshes that don't wait are answered with 304 Not Modified when nothing
+    changed since the client's last one (see nanoblog.conditional).
+    """
+    return conditional.refresh_response(
+        request, channel, lambda: render_stream_updates(request, blog_posts, context, channel))
+
+def render_stream_updates(request, blog_posts, context, channel):
+    """ Build the response to an incremental refresh (see stream_updates). """
+    posts, comments, synced = poll_stream(request, blog_posts, channel)
+
+    context['posts_and_comments'] = fragments.postcards(posts)
+    if "comments_since" not in request.GET:
+        return render(request, "nanoblog/blogposts.html", context)
+
+    response = {
+        'html': render_to_string("nanoblog/blogposts.html", context,
+                                 RequestContext(request)),
+        'comments': [[comment.post_id, comment.id,
+                      render_to_string("nanoblog/comment.html", {"comment": comment})]
+                     for comment in comments],
+        'synced': synced,
+    }
+    response_json = json.dumps(response)
+    return HttpResponse(response_json, content_type='application/json')
+
+def stream_page(request, blog_posts):
+    """
+    Get the page of `blog_posts` after the cursor in GET["before"], or the
+    newest page if there is none, with authors and their profiles loaded.
+    Returns a (posts, older_cursor) pair (see nanoblog.pagination.older_page).
+    """
+    # The post cards show each author's name and profile picture
+    blog_posts = with_authors(blog_posts)
+    try:
+        return older_page(blog_posts, settings.STREAM_PAGE_SIZE,
+                          request.GET.get("before", None))
+    except ValueError: # cursor was tampered with
+        raise Http404
+
+def stream_html(request, template_name, blog_posts, context, channel):
+    """
+    Check for GET["last_updated"]. If present, treat this as an incremental AJAX
+    request and only return the new posts and comments (see stream_updates).
+    If GET["before"] is present instead, treat this as a "load older" AJAX
+    request and return the HTML for the page of posts after that cursor. If both
+    are absent, treat this as a regular page GET and return the entire HTML page
+    with the newest page of posts.
+
+    Every response holds at most settings.STREAM_PAGE_SIZE posts. Pages are
+    found with keyset pagination on (datetime, id) (see nanoblog.pagination),
+    so the cost of a page does not depend on the size of the stream.
+
+    This is used by global_stream, following, user, tag and mentions to render
+    initial page loads and incremental updates.
     """
     if "last_updated" in request.GET:
-        template_name = "nanoblog/blogposts.html"
-        blog_posts = blog_posts.filter(datetime__gt=request.GET["last_updated"])
+        return stream_updates(request, blog_posts, context, channel)
 
-    context['posts_and_comments'] = comments_for_posts(blog_posts)
+    if "before" in request.GET:
+        template_name = "nanoblog/blogposts.html"
+    else:
+        # Clients ask for the comments made after this on their next refresh
+        context['synced'] = str(timezone.now())
+
+    blog_posts, older_cursor = stream_page(request, blog_posts)
+    # Post cards are mostly served from the cache (see nanoblog.fragments)
+    context['posts_and_comments'] = fragments.postcards(blog_posts)
+    context['older_cursor'] = older_cursor
+    context['longpoll'] = settings.LONGPOLL
     return render(request, template_name, context)
 
 @login_required
+@replica_reads
 def global_stream(request, blog_post_form=None):
     """ View posts from all users.
     If kwarg blog_post_form is not None, it will be used instead of a blank
@@ -74,18 +293,20 @@ def global_stream(request, blog_post_form=None):
     if blog_post_form is None:
         blog_post_form = BlogPostForm()
 
-    # DB request for all blog posts in reverse chronological order.
-    # If we were worried about scaling, we would set a limit here as well.
-    blog_posts = BlogPost.objects.all().order_by('-datetime')
+    # All blog posts. stream_html orders these and fetches a single page.
+    blog_posts = BlogPost.objects.all()
 
     context = {
         'blog_post_form': blog_post_form,
         'comment_form': CommentForm(),
+        'api_url': reverse('api_global_stream'),
     }
-    return stream_html(request, 'nanoblog/global_stream.html', blog_posts, context)
+    return stream_html(request, 'nanoblog/global_stream.html', blog_posts, context,
+                       pubsub.global_channel())
 
 
 @login_required
+@replica_reads
 def following(request, blog_post_form=None):
     """ View all posts by users whom the logged in user follows.
     If kwarg blog_post_form is not None, it will be used instead of a blank
@@ -95,20 +316,22 @@ def following(request, blog_post_form=None):
     if blog_post_form is None:
         blog_post_form = BlogPostForm()
 
-    # DB request for all posts, filtered by whether post's user (i.e., its author)
-    # has a follower set (post.user.followers) that contains the logged in user.
-    # To make sure this scales, we would need to (1) put a limit on the number of
-    # results returned and (2) ensure there is an index on followers.
-    blog_posts = BlogPost.objects.filter(user__followers__user=request.user).order_by('-datetime')
+    # The logged in user's materialized timeline, which holds the posts of
+    # everyone they follow (see nanoblog.timeline). stream_html only fetches a
+    # single page of these.
+    blog_posts = timeline.timeline_entries(request.user)
 
     context = {
         'blog_post_form': blog_post_form,
-        'comment_form': CommentForm()
+        'comment_form': CommentForm(),
+        'api_url': reverse('api_following'),
     }
-    return stream_html(request, 'nanoblog/following_stream.html', blog_posts, context)
+    return stream_html(request, 'nanoblog/following_stream.html', blog_posts, context,
+                       pubsub.following_channel(request.user.id))
 
 
 @login_required
+@replica_reads
 def user(request, username=None, blog_post_form=None):
     """ View all posts by user with username `username`.
     If kwarg blog_post_form is not None, it will be used instead of a blank
@@ -118,40 +341,119 @@ def user(request, username=None, blog_post_form=None):
     if blog_post_form is None:
         blog_post_form = BlogPostForm()
 
-    try:
-        profile_user = User.objects.get(username=username)
-    except ObjectDoesNotExist: # invalid username
-        return redirect(reverse('home'))
+    if username == request.user.username:
+        # Already loaded with its profile (see nanoblog.auth)
+        profile_user = request.user
+    else:
+        try:
+            profile_user = User.objects.select_related('blogger').get(username=username)
+        except ObjectDoesNotExist: # invalid username
+            return redirect(reverse('home'))
 
-    # DB request to get all posts from this user.
-    blog_posts = BlogPost.objects.filter(user=profile_user).order_by('-datetime')
+    # All posts from this user. stream_html only fetches a single page of these.
+    blog_posts = BlogPost.objects.filter(user=profile_user)
 
     context = {
         'profile_user': profile_user,
         'blog_post_form': blog_post_form,
-        'comment_form': CommentForm()
+        'comment_form': CommentForm(),
+        'api_url': reverse('api_user', kwargs={'username': profile_user.username}),
+        'follower_count': follow_graph.follower_count(profile_user.id),
+        'following_count': follow_graph.following_count(profile_user.id),
     }
 
     if profile_user.username == request.user.username:
         # The logged in user is viewing their own page.
-        return stream_html(request, 'nanoblog/own_user.html', blog_posts, context)
+        return stream_html(request, 'nanoblog/own_user.html', blog_posts, context,
+                           pubsub.user_channel(profile_user.id))
     else:
         # The logged in user is viewing another user's page.
-        blogger = request.user.blogger
-        following = blogger.following.filter(id=profile_user.id)
-        # Determine whether profile_user is in the blogger's following set.
-        context['following'] = bool(following)
-        return stream_html(request, 'nanoblog/other_user.html', blog_posts, context)
+        # Determine whether profile_user is in the logged in user's following set.
+        context['following'] = follow_graph.is_following(request.user.id, profile_user.id)
+        return stream_html(request, 'nanoblog/other_user.html', blog_posts, context,
+                           pubsub.user_channel(profile_user.id))
 
 
 @login_required
-@transaction.atomic
+@replica_reads
+def tag(request, name=None):
+    """ View all posts using the tag #`name`, in their text or in comments. """
+    name = tags.normalize(name)
+    # Index range scan on PostTag (tag, datetime, post), see nanoblog.tags
+    blog_posts = PostTag.objects.filter(tag__name=name)
+    context = {
+        'tag_name': name,
+        'comment_form': CommentForm(),
+        'api_url': reverse('api_tag', kwargs={'name': name}),
+    }
+    return stream_html(request, 'nanoblog/tag_stream.html', blog_posts, context,
+                       pubsub.tag_channel(name))
+
+
+@login_required
+@replica_reads
+def mentions(request):
+    """ View all posts mentioning the logged in user, in their text or in comments. """
+    blog_posts = Mention.objects.filter(user=request.user)
+    context = {
+        'comment_form': CommentForm(),
+        'api_url': reverse('api_mentions'),
+    }
+    return stream_html(request, 'nanoblog/mentions_stream.html', blog_posts, context,
+                       pubsub.mentions_channel(request.user.id))
+
+
+@login_required
+def search_posts(request):
+    """ Posts matching the words in GET["q"], best matches first, a page
+    (GET["page"], from 1) at a time. See nanoblog.search.
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        raise Http404
+    posts, has_next = search.search(query, page) if query else ([], False)
+    context = {
+        'query': query,
+        'page': page,
+        'has_next': has_next,
+        'posts_and_comments': fragments.postcards(posts),
+        'comment_form': CommentForm(),
+    }
+    return render(request, 'nanoblog/search.html', context)
+
+
+@login_required
+def trending_topics(request):
+    """ The most used tags and the most commented posts over the window
+    GET["window"] ("hour" by default, or "day"). See nanoblog.trending.
+    """
+    window = request.GET.get('window', 'hour')
+    if window not in dict(trending.WINDOWS):
+        raise Http404
+    top_posts = trending.top_posts(window)
+    context = {
+        'window': window,
+        'windows': [name for name, seconds in trending.WINDOWS],
+        'tags': trending.top_tags(window),
+        'posts_and_comments': fragments.postcards([post for post, count in top_posts]),
+        'comment_form': CommentForm(),
+    }
+    return render(request, 'nanoblog/trending.html', context)
+
+
+@login_required
+@pins_primary
 def follow(request, username=None):
     """ Make the logged in user follow the user with username `username` """
     blogger = request.user.blogger
     try:
         profile_user = User.objects.get(username=username)
-        blogger.following.add(profile_user)
+        with transaction.atomic():
+            blogger.following.add(profile_user)
+            timeline.backfill(request.user, profile_user)
+        events.follow_changed(request.user, profile_user)
         return redirect(reverse('user', kwargs={'username': username}))
     except ObjectDoesNotExist:
         # Trying to follow someone who doesn't exist
@@ -159,13 +461,16 @@ def follow(request, username=None):
 
 
 @login_required
-@transaction.atomic
+@pins_primary
 def unfollow(request, username=None):
     """ Make the logged in user unfollow the user with username `username` """
     blogger = request.user.blogger
     try:
         profile_user = User.objects.get(username=username)
-        blogger.following.remove(profile_user)
+        with transaction.atomic():
+            blogger.following.remove(profile_user)
+            timeline.prune(request.user, profile_user)
+        events.follow_changed(request.user, profile_user)
         return redirect(reverse('user', kwargs={'username': username}))
     except ObjectDoesNotExist:
         # Trying to unfollow someone who doesn't exist
@@ -173,20 +478,46 @@ def unfollow(request, username=None):
 
 
 @login_required
-@transaction.atomic
+@pins_primary
 def add(request):
     """ Add a new blog post. The form validation is done by BlogPostForm.
-    When done, dispatch to the calling stream view to render either a new,
-    empty form, or the same form with error messages.
+
+    AJAX requests get a JSON object back: the new post's card in "html"
+    and its "id", or the errors with the form. Plain form submissions are
+    redirected to the calling stream when the post is saved, so that page
+    is fetched with a GET. Otherwise the calling stream view is rendered
+    with the error messages.
     """
     new_post = BlogPost(user=request.user)
     form = BlogPostForm(request.POST, instance=new_post)
 
     if form.is_valid():
-        form.save()
-        form = BlogPostForm()
+        def save_post():
+            form.save()
+            search.index_post(new_post)
+            tags.record_post(new_post)
+            # Push the post into the following stream of each of the author's followers
+            return timeline.fan_out(new_post)
+        follower_ids = batching.write(save_post)
+        # Only notify waiting clients once the post is committed
+        events.post_created(new_post, follower_ids)
+        if request.is_ajax():
+            response = {
+                'success': True,
+                'id': new_post.id,
+                'html': fragments.postcards([new_post])[0]['html'],
+            }
+            return HttpResponse(json.dumps(response), content_type='application/json')
+        return redirect(stream_url(request))
+
+    if request.is_ajax():
+        response = {
+            'success': False,
+            'errors': str(form.errors),
+        }
+        return HttpResponse(json.dumps(response), content_type='application/json')
 
-    # Determine which view to re-render (with or without errors)
+    # Determine which view to re-render with the errors
     redirect_name = request.POST.get('redirect', 'home')
     redirect_user = request.POST.get('redirect_user', None)
     if redirect_name == 'following':
@@ -196,8 +527,19 @@ def add(request):
     else:
         return global_stream(request, blog_post_form=form)
 
+def stream_url(request):
+    """ Get the URL of the stream a post form was submitted from. """
+    redirect_name = request.POST.get('redirect', 'home')
+    redirect_user = request.POST.get('redirect_user', None)
+    if redirect_name == 'following':
+        return reverse('following')
+    elif redirect_name == 'user' and redirect_user is not None:
+        return reverse('user', kwargs={'username': redirect_user})
+    else:
+        return reverse('home')
+
 @login_required
-@transaction.atomic
+@pins_primary
 def add_comment(request):
     """ Add a new comment. Basic validation is done in this
     function: the fields are parsed out of the AJAX request's
@@ -223,7 +565,13 @@ def add_comment(request):
         valid = form.is_valid()
         
     if valid:
-        form.save()
+        def save_comment():
+            form.save()
+            activity.record_comment(new_comment)
+            search.index_comment(new_comment)
+            tags.record_comment(new_comment)
+        batching.write(save_comment)
+        events.comment_created(new_comment)
         comment_html = render_to_string("nanoblog/comment.html", {"comment": new_comment})
         response = {
             'success': True,
@@ -238,7 +586,7 @@ def add_comment(request):
     return HttpResponse(response_json, content_type='application/json')
 
 @login_required
-@transaction.atomic
+@pins_primary
 def edit_profile(request):
     """ Either get the edit_profile page (GET request), or submit the ProfileForm
     (POST request) and redirect to the user's page.
@@ -258,16 +606,20 @@ def edit_profile(request):
         context['edit_profile_form'] = form
         return render(request, 'nanoblog/edit_profile.html', context)
     else:
-        # Update the user's profile and redirect to their user stream.
-        #url = s3_upload(create_form.cleaned_data['picture'], entry.id)
-        #entry.picture_url = url
-        #entry.save()
-        #
-        #
-        profile_picture_url = s3_upload(form.cleaned_data['profile_picture'], blogger.id)
-        blogger.profile_picture_url = profile_picture_url
-        form.save()
-        blogger.save()
+        # Update the user's profile and redirect to their user stream. A new
+        # picture is queued, and shows up once it has been uploaded.
+        profile_picture = form.cleaned_data['profile_picture']
+        upload_job = None
+        with transaction.atomic():
+            # Only write the form's fields: the Blogger was loaded at the start
+            # of the request, and its stream_changed marker and picture URLs
+            # may have been set since (see nanoblog.events and nanoblog.uploads)
+            form.save(commit=False).save(update_fields=ProfileForm.Meta.fields)
+            if profile_picture:
+                upload_job = uploads.enqueue(blogger, profile_picture)
+        if upload_job:
+            uploads.submit(upload_job)
+        events.profile_updated(request.user)
 
         #profile_picture = form.cleaned_data['profile_picture']
         #if profile_picture and len(request.FILES):
@@ -275,7 +627,14 @@ def edit_profile(request):
         #form.save()
         return redirect(reverse('user', kwargs={'username': request.user.username}))
 
-@transaction.atomic
+EMAIL_BODY_TEMPLATE = """Welcome to Nanoblog!
+
+Please click the link below to verify your email address and activate
+your account:
+
+  http://%s%s
+"""
+
 def register(request):
     """ Either get the register page or handle a RegistrationForm POST request. """
     context = {}
@@ -291,33 +650,34 @@ def register(request):
     if not form.is_valid():
         return render(request, 'nanoblog/register.html', context)
 
-    # The form is valid; create a new user
-    new_user = User.objects.create_user(username=request.POST['username'],
-                                        password=request.POST['password1'],
-                                        email=request.POST['email'],
-                                        first_name=request.POST['first_name'],
-                                        last_name=request.POST['last_name'])
-
-    new_user.is_active = False
-
-    new_user.save()
-    # Create a new blogger and link to the user
-    new_blogger = Blogger(user=new_user)
-    new_blogger.save()
-
-    # Generate a one-time use token and an email message body
-    token = default_token_generator.make_token(new_user)
-
-    email_body = EMAIL_BODY_TEMPLATE % (request.get_host(), 
-       reverse('confirm', args=(new_user.username, token)))
-
-    print 'Sending mail to', new_user.email
-
-    send_mail(subject="Verify your email address",
-              message= email_body,
-              from_email="cmbarker@andrew.cmu.edu",
-              recipient_list=[new_user.email],
-              fail_silently=False)
+    # The form is valid; create a new user, and queue their confirmation
+    # email in the same transaction
+    with transaction.atomic():
+        new_user = User.objects.create_user(username=request.POST['username'],
+                                            password=request.POST['password1'],
+                                            email=request.POST['email'],
+                                            first_name=request.POST['first_name'],
+                                            last_name=request.POST['last_name'])
+
+        new_user.is_active = False
+
+        new_user.save()
+        # Create a new blogger and link to the user
+        new_blogger = Blogger(user=new_user)
+        new_blogger.save()
+
+        # Generate a one-time use token and an email message body
+        token = default_token_generator.make_token(new_user)
+
+        email_body = EMAIL_BODY_TEMPLATE % (request.get_host(),
+           reverse('confirm', args=(new_user.username, token)))
+
+        outbox.queue(subject="Verify your email address",
+                     body=email_body,
+                     from_email="cmbarker@andrew.cmu.edu",
+                     recipients=[new_user.email])
+    # Sent in the background, once the user is committed
+    outbox.wake()
 
     context['email'] = form.cleaned_data['email']
     return render(request, 'nanoblog/needs-confirmation.html', context)
@@ -0,0 +1,53 @@
+"""
+gunicorn configuration for production (see the Procfile).
+
+Stream pages refresh every few seconds, and long-polls (see
+nanoblog.views.poll_stream) hold a request open for up to
+settings.LONGPOLL_TIMEOUT seconds. With the default sync workers each of
+those takes a whole process, so a handful of open tabs can starve everyone
+else. gthread workers serve one request per thread instead: a process per
+core, each with NB_GUNICORN_THREADS threads. gevent would allow more open
+polls per process, but needs the database driver and boto patched, which
+Django 1.7 and psycopg2 don't do for us.
+
+Every setting can be overridden from the environment.
+"""
+
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapps.settings_production')
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+
+# The gthread worker (gunicorn 19 has no short name for it; on Python 2 it
+# needs the futures package)
+worker_class = os.environ.get('NB_GUNICORN_WORKER_CLASS', 'gunicorn.workers.gthread.ThreadWorker')
+# WEB_CONCURRENCY is set by Heroku to suit the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Requests served at once by each worker, long-polls included. Each thread
+# keeps a database connection (see CONN_MAX_AGE).
+threads = int(os.environ.get('NB_GUNICORN_THREADS', 16))
+
+# Long-polls last up to 25 seconds, plus the query after them
+timeout = int(os.environ.get('NB_GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+# Keep connections from the router open between a tab's polls
+keepalive = int(os.environ.get('NB_GUNICORN_KEEPALIVE', 5))
+
+# Restart workers now and then, at different times, to bound leaks
+max_requests = 5000
+max_requests_jitter = 500
+
+# Load the app before forking, so workers share its memory
+preload_app = True
+
+accesslog = os.environ.get('NB_GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+def post_fork(server, worker):
+    # Threads don't survive the fork, so background work is started in each
+    # worker. The app is already loaded (preload_app).
+    from nanoblog import outbox, uploads
+    uploads.start()
+    outbox.start()
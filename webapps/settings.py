@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 import dj_database_url
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -39,6 +41,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'nanoblog.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -50,6 +53,21 @@ MIDDLEWARE_CLASSES = (
 
 ROOT_URLCONF = 'webapps.urls'
 
+# Per-view query counts, timings and cache hits are served to Prometheus at
+# /metrics (see nanoblog.metrics), only to staff users and to requests with
+# the bearer token METRICS_TOKEN, if it is set. With METRICS_SERVER_TIMING, every response
+# gets a Server-Timing header with its own numbers.
+METRICS_TOKEN = os.environ.get('NB_METRICS_TOKEN')
+METRICS_SERVER_TIMING = os.environ.get('NB_METRICS_SERVER_TIMING', '0') == '1'
+
+# Users are loaded with their Blogger profile (see nanoblog.auth). Sessions
+# made before it was added name ModelBackend, which keeps them valid.
+AUTHENTICATION_BACKENDS = (
+    'nanoblog.auth.BloggerBackend',
+    'django.contrib.auth.backends.ModelBackend',
+)
+
+
 # Used by the authentication system for the private-todo-list application.
 # URL to use if the authentication system requires a user to log in.
 LOGIN_URL = '/login'
@@ -65,6 +83,131 @@ DATABASES = {
     'default': dj_database_url.config()
 }
 
+# Read replicas of the default database, as space separated database URLs in
+# NB_REPLICA_URLS. Stream GETs read from them (see nanoblog.replicas), except
+# for REPLICA_PIN_SECONDS after the user posts, comments or follows someone.
+# REPLICA_MAX_LAG is how many seconds a replica may be behind the primary.
+DATABASE_REPLICAS = []
+for number, url in enumerate(os.environ.get('NB_REPLICA_URLS', '').split(), 1):
+    alias = 'replica%d' % number
+    DATABASES[alias] = dj_database_url.parse(url)
+    # Tests read the replicas' data from the test default database
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['nanoblog.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('NB_REPLICA_PIN_SECONDS', 10))
+REPLICA_MAX_LAG = int(os.environ.get('NB_REPLICA_MAX_LAG', 5))
+
+# Caches. "fragments" holds rendered post cards (see nanoblog.fragments).
+# Local memory caches are per process; point NB_CACHE_BACKEND and
+# NB_CACHE_LOCATION at memcached or similar to share them between workers.
+CACHE_BACKEND = os.environ.get('NB_CACHE_BACKEND',
+                               'django.core.cache.backends.locmem.LocMemCache')
+SHARED_CACHE = CACHE_BACKEND not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('NB_CACHE_LOCATION', 'default'),
+    },
+    'fragments': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('NB_CACHE_LOCATION', 'fragments'),
+        'KEY_PREFIX': 'fragments',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+FRAGMENT_CACHE = 'fragments'
+
+# Sessions are kept in the database. With a cache shared between workers
+# (see CACHES below) they are also read from it, saving a query per request.
+# A per-process cache can't be used for them: a worker would go on reading a
+# session that was logged out through another one.
+SESSION_ENGINE = os.environ.get('NB_SESSION_ENGINE', (
+    'django.contrib.sessions.backends.cached_db' if SHARED_CACHE
+    else 'django.contrib.sessions.backends.db'))
+if SESSION_ENGINE.startswith('django.contrib.sessions.backends.cache') and not SHARED_CACHE:
+    raise ImproperlyConfigured('%s needs NB_CACHE_BACKEND set to a cache shared between '
+                               'processes' % SESSION_ENGINE)
+
+# Text search configuration used on PostgreSQL (see nanoblog.search)
+SEARCH_CONFIG = 'english'
+
+# Cache holding each user's following set and follower count (see
+# nanoblog.follow_graph), and how long entries live in it, in seconds.
+FOLLOW_GRAPH_CACHE = 'default'
+FOLLOW_GRAPH_TIMEOUT = 24 * 60 * 60
+
+# Seconds between snapshots of the trending counters to the database (see
+# nanoblog.trending), and number of tags and posts shown as trending.
+TRENDING_SNAPSHOT_INTERVAL = int(os.environ.get('NB_TRENDING_SNAPSHOT_INTERVAL', 60))
+TRENDING_SIZE = 10
+
+# Number of posts shown per page of a stream. Older pages are fetched
+# with "load older" requests (see nanoblog.pagination).
+STREAM_PAGE_SIZE = int(os.environ.get('NB_STREAM_PAGE_SIZE', 20))
+
+# Number of an author's most recent posts copied into a user's following
+# stream when they start following that author (see nanoblog.timeline).
+TIMELINE_BACKFILL_SIZE = int(os.environ.get('NB_TIMELINE_BACKFILL_SIZE', 1000))
+
+# Change notifications for long-polling stream clients (see nanoblog.pubsub).
+# LocalPubSub only sees posts made in the same process; use CachePubSub with
+# a shared cache when running several worker processes.
+PUBSUB_BACKEND = os.environ.get('NB_PUBSUB_BACKEND', 'nanoblog.pubsub.LocalPubSub')
+PUBSUB_CACHE = 'default'
+
+# Whether stream refreshes may be long-polls. Each open long-poll holds a
+# worker (a process with the default sync gunicorn workers) for up to
+# LONGPOLL_TIMEOUT seconds, so only turn this on with threaded or async
+# workers. Otherwise clients poll every few seconds.
+LONGPOLL = os.environ.get('NB_LONGPOLL', '0') == '1'
+
+# Seconds a long-poll request is held open waiting for new posts, and the
+# interval at which it re-checks the database while it waits.
+LONGPOLL_TIMEOUT = 25
+LONGPOLL_RECHECK = 5
+
+# Seconds before the sync time of a client's last refresh that the next one
+# still looks for comments, so comments committed a little after they were
+# saved are not missed (see nanoblog.views.sync_margin). Keep it above
+# WRITE_COALESCING_DELAY plus the time a write transaction takes.
+COMMENT_SYNC_MARGIN = int(os.environ.get('NB_COMMENT_SYNC_MARGIN', 5))
+
+# Seconds new posts and comments wait for others to be committed with
+# (see nanoblog.batching), at most WRITE_BATCH_SIZE at a time. 0 commits
+# each one on its own. A few milliseconds help under bursts of writes.
+WRITE_COALESCING_DELAY = float(os.environ.get('NB_WRITE_COALESCING_DELAY', 0))
+WRITE_BATCH_SIZE = 100
+
+# Profile pictures are uploaded to UPLOAD_STORAGE by UPLOAD_THREADS
+# background threads per process (see nanoblog.uploads), started with each
+# gunicorn worker. With 0 threads, run the process_uploads management
+# command instead. The storage backends
+# are in nanoblog.storage: S3Storage, FileSystemStorage (keeps pictures in
+# MEDIA_ROOT) and MemoryStorage.
+UPLOAD_STORAGE = os.environ.get('NB_UPLOAD_STORAGE', 'nanoblog.storage.S3Storage')
+UPLOAD_THREADS = int(os.environ.get('NB_UPLOAD_THREADS', 2))
+UPLOAD_MAX_ATTEMPTS = 3
+# Seconds between the threads' looks for jobs to retry or left behind
+UPLOAD_RETRY_INTERVAL = int(os.environ.get('NB_UPLOAD_RETRY_INTERVAL', 60))
+# Seconds after which an unfinished upload is assumed to have been abandoned
+UPLOAD_STALE_AFTER = 10 * 60
+
+S3_ACCESS_KEY = os.environ.get('NB_S3_ACCESS_KEY')
+S3_SECRET_KEY = os.environ.get('NB_S3_SECRET_KEY')
+S3_BUCKET = os.environ.get('NB_S3_BUCKET')
+
+MEDIA_ROOT = os.environ.get('NB_MEDIA_ROOT', os.path.join(BASE_DIR, 'media'))
+MEDIA_URL = '/media/'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -93,3 +236,17 @@ EMAIL_PORT = os.environ['EMAIL_PORT']
 EMAIL_HOST_USER = os.environ['EMAIL_USER']
 EMAIL_HOST_PASSWORD = os.environ['EMAIL_PASSWORD']
 EMAIL_USE_SSL = True
+EMAIL_BACKEND = os.environ.get('NB_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+
+# Outgoing mail is queued and sent in the background (see nanoblog.outbox),
+# EMAIL_BATCH_SIZE messages per connection, by a thread in each web process
+# if EMAIL_BACKGROUND_SENDER is on (started with each gunicorn worker), or
+# else by the send_queued_mail command.
+# Failed messages are retried after EMAIL_RETRY_DELAY seconds, then twice as
+# long each time, EMAIL_MAX_ATTEMPTS times in all.
+EMAIL_BACKGROUND_SENDER = os.environ.get('NB_EMAIL_BACKGROUND_SENDER', '1') == '1'
+EMAIL_BATCH_SIZE = 50
+EMAIL_MAX_ATTEMPTS = 5
+EMAIL_RETRY_DELAY = 60
+# Seconds after which a message still being sent is assumed abandoned
+EMAIL_STALE_AFTER = 10 * 60
@@ -0,0 +1,66 @@
+"""
+Settings for serving nanoblog in production, on top of webapps.settings.
+Used by the gunicorn configuration (webapps/gunicorn_conf.py).
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+
+from webapps.settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+
+ALLOWED_HOSTS = os.environ.get('NB_ALLOWED_HOSTS', 'nanoblogg.herokuapp.com').split(',')
+
+# gunicorn runs several worker processes (see webapps/gunicorn_conf.py), so
+# the post cards, the follow graph, sessions and change notifications must
+# live in a cache they all share: set NB_CACHE_BACKEND and
+# NB_CACHE_LOCATION to memcached or similar.
+if not SHARED_CACHE:
+    raise ImproperlyConfigured('NB_CACHE_BACKEND must be a cache shared between '
+                               'processes in production, not %s' % CACHE_BACKEND)
+PUBSUB_BACKEND = os.environ.get('NB_PUBSUB_BACKEND', 'nanoblog.pubsub.CachePubSub')
+if PUBSUB_BACKEND == 'nanoblog.pubsub.LocalPubSub':
+    raise ImproperlyConfigured('LocalPubSub only notifies the process posting; use '
+                               'CachePubSub in production')
+
+# The threaded workers can hold long-polls open
+LONGPOLL = os.environ.get('NB_LONGPOLL', '1') == '1'
+
+# Keep database connections open between requests instead of opening one
+# per request. Each gunicorn thread holds its own connection, so workers
+# times threads must stay below the database's connection limit (the
+# replicas' too).
+for database in DATABASES.values():
+    database['CONN_MAX_AGE'] = int(os.environ.get('NB_CONN_MAX_AGE', 600))
+
+# Compile templates once per process
+TEMPLATE_LOADERS = (
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    )),
+)
+
+# Profile pictures are served from S3; only static files are served by the
+# app, by WhiteNoise (see webapps/wsgi.py), with far-future cache headers
+# for the hashed names made by collectstatic.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'django.request': {
+            'handlers': ['console'],
+            'level': 'ERROR',
+        },
+        'nanoblog': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
@@ -1,5 +1,10 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
+from django.conf.urls.static import static
 
 urlpatterns = patterns('',
     url(r'^', include('nanoblog.urls')),
 )
+
+# Pictures kept by nanoblog.storage.FileSystemStorage, in development
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
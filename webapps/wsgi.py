@@ -11,13 +11,9 @@ import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapps.settings")
 
 from django.core.wsgi import get_wsgi_application
+from whitenoise.django import DjangoWhiteNoise
 
-#from whitenoise.django import DjangoWhiteNoise
-
-#application = get_wsgi_application()
-#application = DjangoWhiteNoise(application)
-
-from django.core.wsgi import get_wsgi_application
-from dj_static import Cling
-
-application = Cling(get_wsgi_application())
\ No newline at end of file
+# WhiteNoise serves the files collected in STATIC_ROOT, with far-future
+# cache headers for the ones with a hash in their name
+application = get_wsgi_application()
+application = DjangoWhiteNoise(application)